@@ -1,5 +1,5 @@
 # app.py
-from flask import Flask, jsonify, send_file, request, Response, abort, make_response
+from flask import Flask, jsonify, request, Response, abort, make_response
 from flask_cors import CORS
 import os
 import json
@@ -7,11 +7,30 @@ import subprocess
 import threading
 from pathlib import Path
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date, parse_date, parse_etags, unquote_etag
+from urllib.parse import quote
 import mimetypes
 import re
 import platform
+import sys
+import base64
+import bisect
+import shutil
+import collections
+import contextlib
+import sqlite3
+import time
+import gzip
+import hashlib
+import uuid
 from functools import wraps
 
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 # เปิด CORS กว้างไว้ (เสิร์ฟโดเมนเดียวกันผ่าน Apache ก็ไม่เป็นไร)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -20,8 +39,8 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 # CONFIG
 # ==============================
 # ปรับ path ให้ตรงระบบจริง
-app.config['VIDEO_FOLDER'] = r'D:\NewSoftware\videostreaming\video'
-app.config['PROCESSED_FOLDER'] = r'D:\NewSoftware\videostreaming\video_process'
+app.config['VIDEO_FOLDER'] = os.environ.get('VIDEO_FOLDER', r'D:\NewSoftware\videostreaming\video')
+app.config['PROCESSED_FOLDER'] = os.environ.get('PROCESSED_FOLDER', r'D:\NewSoftware\videostreaming\video_process')
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024 * 1024  # 20GB
 
 # >>> Basic Auth เฉพาะหน้า index <<<
@@ -32,17 +51,299 @@ app.config['INDEX_PASSWORD'] = 'StrongPass!'     # เปลี่ยนได
 Path(app.config['VIDEO_FOLDER']).mkdir(parents=True, exist_ok=True)
 Path(app.config['PROCESSED_FOLDER']).mkdir(parents=True, exist_ok=True)
 
+# cache ผล ffprobe (ถาวร) + จำกัดจำนวน ffprobe ที่รันพร้อมกัน
+app.config['METADATA_DB'] = str(Path(app.config['PROCESSED_FOLDER']) / 'metadata.sqlite3')
+app.config['FFPROBE_MAX_CONCURRENCY'] = 4
+
+# ดัชนีไฟล์วิดีโอในหน่วยความจำ: ตรวจ mtime โฟลเดอร์ทุกกี่วินาที / stat ไฟล์ทั้งหมดทุกกี่วินาที
+app.config['LIBRARY_RESCAN_SECONDS'] = 10
+app.config['LIBRARY_FULL_RESCAN_SECONDS'] = 600
+
+# คิวงานแปลงไฟล์: จำนวน encode พร้อมกัน (แต่ละงานได้ core เท่าๆ กัน) / จำนวนงานรอสูงสุด
+app.config['TRANSCODE_WORKERS'] = max(1, (os.cpu_count() or 1) // 8)
+app.config['TRANSCODE_QUEUE_LIMIT'] = 1000
+# สถานะงานถาวร (ใช้ร่วมกันหลาย process) / งาน processing ที่ไม่มี heartbeat นานเท่านี้ถือว่าค้าง -> คืนเข้าคิว
+app.config['JOBS_DB'] = str(Path(app.config['PROCESSED_FOLDER']) / 'jobs.sqlite3')
+app.config['JOB_STALE_SECONDS'] = 60
+
 # สตรีมไฟล์ใหญ่
 CHUNK_SIZE = 1024 * 1024  # 1MB
-HLS_SEGMENT_SECONDS = 6
+
+# วิธีส่ง byte ของไฟล์วิดีโอ
+#   'generator'        : อ่านทีละ CHUNK_SIZE ใน Python (แบบเดิม)
+#   'file_wrapper'     : ส่ง file object ให้ wsgi.file_wrapper ของ server (gunicorn/mod_wsgi ใช้ sendfile แบบ zero-copy)
+#   'x-accel-redirect' : ให้ nginx ส่งไฟล์เอง (ต้องตั้ง X_ACCEL_LOCATIONS)
+#   'x-sendfile'       : ให้ Apache (mod_xsendfile) ส่งไฟล์เอง
+app.config['STREAM_TRANSFER_MODE'] = os.environ.get('STREAM_TRANSFER_MODE', 'file_wrapper')
+# { โฟลเดอร์จริง: internal location ของ nginx } เช่น {r'D:\video_process': '/_protected/processed/'}
+app.config['X_ACCEL_LOCATIONS'] = {}
+HLS_SEGMENT_SECONDS = int(os.environ.get('HLS_SEGMENT_SECONDS', '6'))
+FFMPEG_STDERR_TAIL_LINES = 50  # เก็บ stderr ของ ffmpeg ไว้แค่นี้ (แสดงตอน error)
+HLS_SEGMENT_TYPE = 'fmp4'  # 'fmp4' (CMAF, .m4s) หรือ 'mpegts' (.ts แบบเดิม)
+# ช่วง keyframe ที่ ladder บังคับ (ทุก rendition ตรงกัน) = หน่วยเล็กที่สุดที่ตัด segment / สลับ rendition ได้
+# ต้องหาร HLS_SEGMENT_SECONDS ลงตัว -> เปลี่ยนความยาว segment ภายหลังได้ด้วยการแพ็ก HLS ใหม่ ไม่ต้อง encode ใหม่
+HLS_PART_SECONDS = int(os.environ.get('HLS_PART_SECONDS', '2'))
+# (ตัวเลือก) fMP4 แบบไฟล์เดียวต่อ rendition (media.mp4) + playlist แบบ #EXT-X-BYTERANGE แทน seg_NNNNN.m4s หลายร้อยไฟล์
+# -> ไฟล์บนดิสก์น้อย แต่ media.mp4 ใหญ่เกิน HOT_CACHE_MAX_ITEM_BYTES: segment กลางเรื่องที่คนดูพร้อมกันมาก
+#    อ่านจากดิสก์ทุกครั้ง (cache ในหน่วยความจำได้แค่ส่วนหัวไฟล์ใน block_cache) และส่ง Link preload ไม่ได้
+#    ค่าเริ่มต้นจึงเป็น segment แยกไฟล์ที่ hot_cache เก็บได้ทีละ segment
+HLS_SINGLE_FILE = os.environ.get('HLS_SINGLE_FILE', '0') == '1'
+# segment แรกของ playlist แบบ byte-range ยาวแค่ HLS_PART_SECONDS จำนวนเท่านี้ (เริ่มเล่นเร็วขึ้น) ที่เหลือยาว HLS_SEGMENT_SECONDS
+HLS_STARTUP_PARTS = 2
+
+# Just-in-time HLS: ไฟล์ที่ยังไม่ได้ process -> /hls/<key>/master.m3u8 สร้าง playlist จากผล probe
+# แล้ว encode แต่ละ segment (.ts) เฉพาะช่วงเวลานั้นตอนถูกขอครั้งแรก
+# segment เก็บใน cache บนดิสก์ที่จำกัดขนาดรวม (LRU) -> พื้นที่ใช้ตามที่มีคนดูจริง
+app.config['HLS_JIT'] = True
+app.config['JIT_CACHE_DIR'] = str(Path(app.config['PROCESSED_FOLDER']) / '.jit_cache')
+app.config['JIT_CACHE_MAX_BYTES'] = 20 * 1024**3  # 20GB
+app.config['JIT_MAX_CONCURRENCY'] = max(1, (os.cpu_count() or 1) // 4)  # ffmpeg JIT ที่รันพร้อมกันได้
+app.config['JIT_PRESET'] = 'veryfast'  # ต้องเร็วพอให้ encode 1 segment ทันก่อน player buffer หมด
+
+# cache ในหน่วยความจำสำหรับ playlist/segment HLS ที่ถูกขอบ่อย (เช่น คลาสสดที่คนดูพร้อมกันหลายร้อยคน)
+app.config['HOT_CACHE_MAX_BYTES'] = 512 * 1024**2   # ขนาดรวมสูงสุด (LRU)
+app.config['HOT_CACHE_MAX_ITEM_BYTES'] = 16 * 1024**2  # ไฟล์ใหญ่กว่านี้ส่งจากดิสก์ตามปกติ
+app.config['HOT_CACHE_REVALIDATE_SECONDS'] = 1.0  # stat ไฟล์ซ้ำไม่บ่อยกว่านี้ (ไฟล์ถูกเขียนแบบ os.replace เสมอ)
+
+# หน้า /hlsplayer: ฝัง master + playlist ของ rendition แรกในหน้า, ใส่ Link: rel=preload
+# และอุ่น playlist + init + segment แรกๆ (HLS_STARTUP_PARTS) ของทุก rendition เข้า hot_cache/block_cache
+# Link: rel=preload ส่งเฉพาะ HLS_SINGLE_FILE=0 (init.mp4 / segment แยกไฟล์) -- preload ระบุ byte range ไม่ได้
+# และการ preload media.mp4 ทั้งไฟล์ = โหลดทั้ง rendition จึงไม่ส่งเลยเมื่อ HLS_SINGLE_FILE=1 (เหลือ inline + อุ่น cache)
+app.config['HLS_STARTUP_HINTS'] = True
+
+# cache ส่วนหัวของไฟล์วิดีโอ (moov + buffer ตอนเริ่มเล่น) เป็น block ขนาด CHUNK_SIZE
+# หลายคนเปิดไฟล์เดียวกันพร้อมกัน -> อ่านดิสก์/NAS ครั้งเดียวต่อ block แล้วแชร์กัน
+app.config['BLOCK_CACHE_HEAD_BYTES'] = 8 * 1024**2    # cache เฉพาะ N byte แรกของแต่ละไฟล์ (0 = ปิด)
+app.config['BLOCK_CACHE_MAX_BYTES'] = 256 * 1024**2   # ขนาดรวมสูงสุด (LRU)
+
+# จำผลการเลือกไฟล์ของ /api/video_path และ /api/video (relpath + quality -> ไฟล์, stat, MIME, ETag)
+# seek ทุกครั้ง = request ใหม่ -> ไม่ต้อง resolve / glob / exists / stat บน NAS ซ้ำ
+app.config['RENDITION_CACHE_ENTRIES'] = 4096
+app.config['RENDITION_CACHE_REVALIDATE_SECONDS'] = 1.0  # stat ไฟล์ที่เลือกซ้ำไม่บ่อยกว่านี้
+app.config['RENDITION_CACHE_TTL'] = 60  # เลือกไฟล์ใหม่ทั้งหมดอย่างน้อยทุกเท่านี้ (ไฟล์ที่ถูกวางเองนอกคิว)
+
+# จำกัด bandwidth ขาออก (byte/วินาที, 0 = ไม่จำกัด) กันคนดาวน์โหลดทั้งไฟล์แย่ง uplink จนคนอื่นกระตุก
+# stream ที่ active แบ่ง SHAPING_GLOBAL_BPS กันเท่าๆ กัน และแต่ละ stream ได้ส่ง SHAPING_BURST_BYTES แรกเต็มความเร็ว
+# (buffer ตอนเริ่มเล่น) เปิดใช้แล้ว response ที่ถูกจำกัดจะส่งด้วย generator แทน sendfile
+app.config['SHAPING_GLOBAL_BPS'] = int(os.environ.get('SHAPING_GLOBAL_BPS', '0'))
+app.config['SHAPING_CLIENT_BPS'] = int(os.environ.get('SHAPING_CLIENT_BPS', '0'))  # ต่อ client (ทุก stream รวมกัน)
+app.config['SHAPING_BURST_BYTES'] = 8 * 1024**2
+app.config['SHAPING_CLIENT_KEY'] = 'ip'  # 'ip' หรือ 'session' (?sid= / cookie vs_sid, ไม่มีใช้ ip)
+app.config['SHAPING_TRUST_X_FORWARDED_FOR'] = True  # อยู่หลัง Apache/nginx reverse proxy -> ip จริงอยู่ใน header นี้
+SHAPING_SLICE = 64 * 1024  # ส่งทีละชิ้นเล็กๆ ตอนถูกจำกัด -> ไหลสม่ำเสมอ ไม่กระตุกเป็นช่วง
+
+# ?quality=auto (MP4 progressive): เลือก rendition ตามความเร็วของผู้ชมแต่ละ session (?sid= / cookie vs_sid)
+app.config['ABR_SAFETY'] = 0.7  # เลือก rendition ที่บิตเรตไม่เกิน 70% ของความเร็วที่วัดได้
+# วัดความเร็วจากเวลาที่ใช้ส่ง ABR_SAMPLE_BYTES ต่อจาก ABR_SKIP_BYTES แรกของ response (ช่วงที่ browser โหลดเต็มที่)
+# ข้ามส่วนแรกเพราะ socket buffer ของ OS รับไว้ได้หลาย MB ทันที -> วัดได้เร็วเกินจริง
+ABR_SKIP_BYTES = 8 * 1024**2
+ABR_SAMPLE_BYTES = 8 * 1024**2
+ABR_EWMA_ALPHA = 0.3
+ABR_SESSION_TTL = 1800  # ลืม session ที่ไม่มี request นานกว่านี้ (วินาที)
+# วัดไม่เกิน 1 response ต่อ session ทุกกี่วินาที (response ที่วัดต้องส่งด้วย generator, ที่เหลือใช้ sendfile)
+ABR_SAMPLE_INTERVAL = 10
+ABR_MAX_SESSIONS = 10000
+
+# ladder ของ rendition ที่จะ encode (height = ความสูง, ความกว้างคำนวณตาม aspect ratio ของต้นฉบับ)
+# rung ที่สูงกว่าหรือบิตเรตสูงกว่าต้นฉบับจะถูกตัดทิ้ง (ไม่ upscale)
+RENDITION_LADDER = [
+    {'name': '480p',  'height': 480,  'video_bitrate': '1000k', 'audio_bitrate': '96k'},
+    {'name': '720p',  'height': 720,  'video_bitrate': '2500k', 'audio_bitrate': '128k'},
+    {'name': '1080p', 'height': 1080, 'video_bitrate': '4000k', 'audio_bitrate': '192k'},
+]
+# ladder แยกตามโฟลเดอร์ (relpath ใต้ VIDEO_FOLDER, โฟลเดอร์ที่ยาวที่สุดที่ตรงกันชนะ)
+# ค่าเป็น list ของชื่อใน RENDITION_LADDER หรือ dict แบบเดียวกัน เช่น {'lectures': ['480p', '720p']}
+app.config['RENDITION_LADDERS'] = {}
+# ต้นฉบับเป็น H.264/AAC ที่เบราว์เซอร์เล่นได้อยู่แล้ว -> ทำ rendition 'source' ด้วย stream copy (ไม่ encode)
+# และไม่ encode rung ที่ความสูงเท่าต้นฉบับซ้ำ
+app.config['SOURCE_COPY_RENDITION'] = True
+
+# โปรไฟล์ encode ของ ladder (libx264) วัดผลเทียบกันด้วย bench_encode.py แล้วเลือกใน ENCODE_PROFILE
+# rate_control:
+#   'capped_crf' = คุณภาพคงที่ (-crf) แต่ไม่เกิน video_bitrate ของ rung (-maxrate/-bufsize, VBV)
+#   'abr'        = บิตเรตเฉลี่ยตาม video_bitrate (-b:v + -maxrate) ขนาดไฟล์คาดเดาได้
+#   'crf'        = คุณภาพคงที่ ไม่จำกัดบิตเรต
+# threads: 0 = แบ่ง core ตาม TRANSCODE_WORKERS (ค่าเดิม)
+ENCODE_PROFILES = {
+    'fast':     {'preset': 'veryfast', 'rate_control': 'capped_crf', 'crf': 23, 'threads': 0},
+    'balanced': {'preset': 'medium',   'rate_control': 'capped_crf', 'crf': 23, 'threads': 0},
+    'quality':  {'preset': 'slow',     'rate_control': 'capped_crf', 'crf': 21, 'threads': 0},
+    'abr':      {'preset': 'medium',   'rate_control': 'abr',        'crf': 23, 'threads': 0},
+}
+app.config['ENCODE_PROFILE'] = os.environ.get('ENCODE_PROFILE', 'balanced')
+
+# ภาพตัวอย่างสำหรับ player: poster + sprite sheet + WebVTT (แสดงภาพตอนลากแถบเวลา แทนการโหลดวิดีโอ)
+# ทำพร้อมการประมวลผล จาก decode ครั้งเดียวของ rendition ที่เล็กที่สุด
+app.config['THUMBNAILS'] = True
+THUMB_INTERVAL_SECONDS = 10
+THUMB_WIDTH = 160            # ความกว้างภาพเล็ก 1 ช่อง (ความสูงตาม aspect ratio)
+THUMB_GRID = (10, 10)        # คอลัมน์ x แถว ต่อ sprite sheet 1 ไฟล์ (วิดีโอยาวได้หลาย sheet)
+POSTER_AT_SECONDS = 10       # poster = เฟรมที่วินาทีนี้ (วิดีโอสั้น -> 10% ของความยาว)
+THUMBS_MAX_AGE = 30 * 86400  # URL มี ?v= ตามเวลาที่สร้าง -> cache ได้นาน
 
 # MIME สำคัญ
 mimetypes.add_type('application/vnd.apple.mpegURL', '.m3u8')
 mimetypes.add_type('video/MP2T', '.ts')
 mimetypes.add_type('video/mp4', '.m4s')
+mimetypes.add_type('text/vtt', '.vtt')
+
+# แบ่งหน้า /api/videos และ /api/browse (?limit=&cursor=)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# /api/browse: JSON ที่ serialize แล้วต่อโฟลเดอร์/หน้า (ใช้ซ้ำจนดัชนีหรือสถานะงานเปลี่ยน) + ETag -> 304
+BROWSE_CACHE_ENTRIES = 512
+COMPRESS_MIN_BYTES = 1024  # listing เล็กกว่านี้ไม่บีบอัด
 
 VIDEO_EXTS = {'.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm', '.m4v'}
 
+# ==============================
+# METRICS (Prometheus text format ที่ /metrics)
+# ==============================
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+def _label_value(v) -> str:
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Metric:
+    """
+    metric 1 ตัว แยกค่าตาม label (ส่ง label เป็นลำดับตาม labels ตอนเรียก inc/observe)
+    fn = ฟังก์ชันที่คืนค่าตอน scrape (ตัวเลข หรือ { (label, ...): ตัวเลข }) สำหรับค่าที่มีอยู่แล้วที่อื่น
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=(), fn=None):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._values = {}  # { (label, ...): ค่า }
+
+    def _label_str(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_label_value(v)}"' for k, v in pairs) + '}'
+
+    def _samples(self):
+        if self.fn is None:
+            with self._lock:
+                return list(self._values.items())
+        value = self.fn()
+        if isinstance(value, dict):
+            return [(k if isinstance(k, tuple) else (k,), v) for k, v in value.items()]
+        return [((), value)]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, value in self._samples():
+            lines.append(f'{self.name}{self._label_str(values)} {value}')
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # ..., +Inf, sum
+            counts[i] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for values, counts in self._samples():
+            cumulative = 0
+            for le, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{self._label_str(values, [("le", le)])} {cumulative}')
+            lines.append(f'{self.name}_sum{self._label_str(values)} {counts[-1]}')
+            lines.append(f'{self.name}_count{self._label_str(values)} {cumulative}')
+        return lines
+
+class MetricsRegistry:
+    """
+    ที่รวม metric ทั้งหมดของ process นี้ (ไม่ต้องมี prometheus_client)
+    หลาย worker process = แต่ละ process มีค่าของตัวเอง (label instance ของ Prometheus แยกให้)
+    """
+    def __init__(self, prefix='videostream_'):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=(), fn=None) -> Counter:
+        return self._add(Counter(self.prefix + name, help_text, labels, fn))
+
+    def gauge(self, name, help_text, labels=(), fn=None) -> Gauge:
+        return self._add(Gauge(self.prefix + name, help_text, labels, fn))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:  # ค่าจาก fn พัง (เช่น DB lock) ไม่ให้ทั้ง /metrics ล้ม
+                print(f"[METRICS] {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+stream_requests_total = metrics.counter(
+    'stream_requests_total', 'คำขอไฟล์วิดีโอ/HLS/ภาพตัวอย่าง แยกตาม endpoint และ status', ('endpoint', 'status'))
+stream_plan_seconds = metrics.histogram(
+    'stream_plan_seconds', 'เวลาตัดสิน Range/conditional จนได้ header (ก่อนส่ง body)', ('endpoint',))
+stream_response_bytes_total = metrics.counter(
+    'stream_response_bytes_total', 'byte ของ body ที่ตอบ (ตาม Content-Length ของ 200/206)', ('endpoint',))
+active_streams = metrics.gauge(
+    'active_streams', 'response ที่กำลังส่ง body จากไฟล์อยู่', ('endpoint',))
+file_read_bytes_total = metrics.counter(
+    'file_read_bytes_total', 'byte ที่ _file_iter ส่งออก แยกตามแหล่ง (head_cache = block_cache)', ('source',))
+ffprobe_calls_total = metrics.counter('ffprobe_calls_total', 'จำนวนครั้งที่รัน ffprobe', ('result',))
+ffprobe_seconds = metrics.histogram('ffprobe_seconds', 'เวลาที่ ffprobe ใช้ต่อไฟล์', buckets=DURATION_BUCKETS)
+hls_request_seconds = metrics.histogram(
+    'hls_request_seconds', 'เวลาตอบ /hls/ (jit รวมเวลา encode segment ถ้ายังไม่มีใน cache)', ('mode',))
+ffmpeg_seconds = metrics.histogram(
+    'ffmpeg_seconds', 'เวลาจริงของ ffmpeg แต่ละขั้น (remux/encode/thumbs/hls/jit)', ('stage',), DURATION_BUCKETS)
+ffmpeg_failures_total = metrics.counter('ffmpeg_failures_total', 'ffmpeg ที่จบด้วย error', ('stage',))
+transcode_jobs_total = metrics.counter('transcode_jobs_total', 'งานแปลงไฟล์ที่จบแล้ว แยกตามผล', ('result',))
+transcode_job_seconds = metrics.histogram(
+    'transcode_job_seconds', 'เวลาทั้งงานแปลงไฟล์ 1 ไฟล์ (ทุกขั้น)', buckets=DURATION_BUCKETS)
+
 # ==============================
 # UTILITIES
 # ==============================
@@ -51,6 +352,15 @@ def _cache_headers(resp, seconds=3600):
     return resp
 
 def _file_iter(path: Path, start: int, end: int, chunk_size=CHUNK_SIZE):
+    if start < block_cache.head_bytes:
+        # ส่วนหัวไฟล์: อ่านผ่าน block_cache (request พร้อมกันอ่านดิสก์ครั้งเดียว)
+        st = os.stat(path)
+        for chunk in block_cache.iter_head(path, st, start, end):
+            start += len(chunk)
+            file_read_bytes_total.inc(len(chunk), 'head_cache')
+            yield chunk
+        if start > end:
+            return
     with open(path, 'rb') as f:
         f.seek(start)
         remaining = end - start + 1
@@ -59,230 +369,3141 @@ def _file_iter(path: Path, start: int, end: int, chunk_size=CHUNK_SIZE):
             if not chunk:
                 break
             remaining -= len(chunk)
+            file_read_bytes_total.inc(len(chunk), 'disk')
             yield chunk
 
+class _RangeFile:
+    """
+    file object ที่อ่านได้ไม่เกิน length byte ตั้งแต่ start
+    - server ที่มี wsgi.file_wrapper (gunicorn, mod_wsgi) ใช้ fileno() + ตำแหน่งปัจจุบัน + Content-Length ทำ sendfile
+    - server อื่นจะเรียก read() ซึ่งถูกจำกัดไม่ให้เกินช่วงที่ขอ
+    """
+    def __init__(self, path: Path, start: int, length: int):
+        self._f = open(path, 'rb')
+        self._f.seek(start)
+        self._remaining = length
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._f.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+def _range_body(path: Path, start: int, end: int):
+    """body สำหรับช่วง byte [start, end] ตาม STREAM_TRANSFER_MODE -> (body, direct_passthrough)"""
+    if app.config['STREAM_TRANSFER_MODE'] == 'generator' or end < block_cache.head_bytes:
+        # ช่วงที่อยู่ในส่วนหัวทั้งหมด (moov, buffer เริ่มต้น) ตอบจาก block_cache แทน sendfile
+        return _file_iter(path, start, end, chunk_size=CHUNK_SIZE), False
+    return wrap_file(request.environ, _RangeFile(path, start, end - start + 1), buffer_size=CHUNK_SIZE), True
+
+def _offload_response(video_path: Path, content_type: str):
+    """ให้ reverse proxy ส่งไฟล์เอง (จัดการ Range เอง) -> None ถ้าโหมด/ตำแหน่งไฟล์ไม่รองรับ"""
+    mode = app.config['STREAM_TRANSFER_MODE']
+    resolved = video_path.resolve()
+    if mode == 'x-sendfile':
+        resp = make_response('')
+        resp.headers['X-Sendfile'] = str(resolved)
+    elif mode == 'x-accel-redirect':
+        for local, location in app.config['X_ACCEL_LOCATIONS'].items():
+            try:
+                rel = resolved.relative_to(Path(local).resolve())
+            except ValueError:
+                continue
+            resp = make_response('')
+            resp.headers['X-Accel-Redirect'] = location.rstrip('/') + '/' + quote(rel.as_posix())
+            break
+        else:
+            return None
+    else:
+        return None
+    resp.headers['Content-Type'] = content_type
+    return _cache_headers(resp, 3600)
+
+def _mp4_faststart(path: Path):
+    """
+    อ่านเฉพาะ header ของ box ระดับบนสุดของ MP4/MOV (ไม่อ่านเนื้อไฟล์)
+    -> True ถ้า moov อยู่ก่อน mdat (เล่นได้ทันที), False ถ้า moov อยู่ท้ายไฟล์, None ถ้าไม่ใช่ ISO BMFF
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            pos = 0
+            while pos + 8 <= size:
+                f.seek(pos)
+                header = f.read(16)
+                box_size = int.from_bytes(header[0:4], 'big')
+                box_type = header[4:8]
+                if box_size == 1:
+                    box_size = int.from_bytes(header[8:16], 'big')  # largesize (64-bit)
+                elif box_size == 0:
+                    box_size = size - pos  # box สุดท้ายยาวถึงท้ายไฟล์
+                if box_type == b'moov':
+                    return True
+                if box_type == b'mdat':
+                    return False
+                if pos == 0 and box_type not in (b'ftyp', b'wide', b'free', b'skip'):
+                    return None
+                if box_size < 8:
+                    return None
+                pos += box_size
+    except OSError:
+        pass
+    return None
+
+def _kbps(bitrate: str) -> int:
+    """'2500k' -> 2500"""
+    return int(str(bitrate).lower().rstrip('k'))
+
+def _even(x) -> int:
+    """ปัดเป็นเลขคู่ (libx264 + yuv420p ต้องการ)"""
+    return max(2, int(round(x / 2)) * 2)
+
+def _vtt_time(seconds: float) -> str:
+    ms = int(round(seconds * 1000))
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+def _merge_byterange_playlist(text: str, segment_seconds: float, startup_parts: int) -> str:
+    """
+    playlist VOD แบบ #EXT-X-BYTERANGE ที่ตัดทุก part -> รวม part ที่ต่อกันเป็น segment ยาว segment_seconds
+    โดยคง startup_parts ชิ้นแรกไว้สั้นๆ (byte range ของไฟล์เดียวต่อเนื่องกัน รวมได้โดยบวกความยาว)
+    """
+    head, parts, tail = [], [], []
+    duration = None
+    for line in text.splitlines():
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line.startswith('#EXT-X-BYTERANGE:') and duration is not None:
+            length, _, offset = line[len('#EXT-X-BYTERANGE:'):].partition('@')
+            parts.append([duration, int(length), int(offset), None])
+        elif parts and parts[-1][3] is None and not line.startswith('#'):
+            parts[-1][3] = line
+            duration = None
+        elif parts:
+            tail.append(line)
+        else:
+            head.append(line)
+
+    segments = []
+    for dur, length, offset, uri in parts:
+        last = segments[-1] if segments else None
+        if (len(segments) > startup_parts and last[3] == uri and last[1] + last[2] == offset
+                and last[0] + dur <= segment_seconds + 0.5):
+            last[0] += dur
+            last[1] += length
+        else:
+            segments.append([dur, length, offset, uri])
+
+    target = max([int(-(-round(seg[0], 3) // 1)) for seg in segments] or [1])
+    out = [f'#EXT-X-TARGETDURATION:{target}' if line.startswith('#EXT-X-TARGETDURATION:') else line for line in head]
+    for dur, length, offset, uri in segments:
+        out += [f'#EXTINF:{dur:.6f},', f'#EXT-X-BYTERANGE:{length}@{offset}', uri]
+    return '\n'.join(out + tail) + '\n'
+
 def _safe_id_from_relpath(relpath: str) -> str:
     # ใช้ relpath เป็น key สำหรับโฟลเดอร์ processed โดยแปลงอักขระพิเศษ
     return re.sub(r'[^A-Za-z0-9_.-]+', '_', relpath)
 
-def send_video_with_range(video_path: Path):
-    """ส่งไฟล์วิดีโอ/ไฟล์ใหญ่พร้อมรองรับ HTTP Range"""
+# --------- HTTP Range + conditional requests (RFC 9110) ----------
+MAX_RANGES = 16  # multi-range มากกว่านี้ -> ส่งทั้งไฟล์แทน (กันการขอช่วงเล็กๆ จำนวนมาก)
+
+def _file_etag(size: int, mtime_ns: int) -> str:
+    """strong ETag จากขนาด + mtime (มีเครื่องหมายคำพูดแล้ว)"""
+    return f'"{size:x}-{mtime_ns:x}"'
+
+def _parse_range(range_header: str, size: int):
+    """
+    แปลง Range header -> [(start, end), ...] (รวมช่วงที่ซ้อน/ติดกันแล้ว)
+    None = ไม่ใช่ bytes range ที่อ่านออก (ให้ส่งทั้งไฟล์), [] = ไม่มีช่วงที่ใช้ได้ (416)
+    รองรับ bytes=a-b, bytes=a-, bytes=-n (suffix) และหลายช่วงคั่นด้วย ,
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()) or not (first or last):
+            return None
+        if not first:
+            # suffix range: n byte สุดท้าย
+            n = int(last)
+            if n == 0 or size == 0:
+                continue
+            ranges.append((max(0, size - n), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        end = int(last) if last else size - 1
+        ranges.append((start, min(end, size - 1)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _precondition_status(headers, method: str, etag: str, mtime: float):
+    """
+    ประเมิน If-Match / If-Unmodified-Since / If-None-Match / If-Modified-Since ตามลำดับใน RFC 9110 §13.2.2
+    -> 412, 304 หรือ None (ทำต่อตามปกติ)
+    """
+    tag = unquote_etag(etag)[0]
+    modified = int(mtime)
+
+    if_match = headers.get('If-Match')
+    if if_match:
+        if not parse_etags(if_match).contains(tag):
+            return 412
+    else:
+        since = parse_date(headers.get('If-Unmodified-Since'))
+        if since is not None and modified > since.timestamp():
+            return 412
+
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        if parse_etags(if_none_match).contains_weak(tag):
+            return 304 if method in ('GET', 'HEAD') else 412
+    elif method in ('GET', 'HEAD'):
+        since = parse_date(headers.get('If-Modified-Since'))
+        if since is not None and modified <= since.timestamp():
+            return 304
+    return None
+
+def _if_range_matches(value: str, etag: str, mtime: float) -> bool:
+    """If-Range ต้องเทียบแบบ strong: ETag ตรงตัว หรือวันที่ตรงกับ Last-Modified"""
+    value = value.strip()
+    if value.startswith('W/'):
+        return False
+    if value.startswith('"'):
+        return value == etag
+    date = parse_date(value)
+    return date is not None and int(date.timestamp()) == int(mtime)
+
+def _select_ranges(headers, size: int, etag: str, mtime: float):
+    """ช่วงที่ต้องส่ง -> None (ส่งทั้งไฟล์ 200), [] (416), [(start, end), ...] (206)"""
+    range_header = headers.get('Range')
+    if not range_header:
+        return None
+    if_range = headers.get('If-Range')
+    if if_range and not _if_range_matches(if_range, etag, mtime):
+        return None
+    return _parse_range(range_header, size)
+
+def _multipart_plan(ranges, size: int, content_type: str):
+    """แผนของ multipart/byteranges -> (boundary, [(หัว part, start, end), ...], ท้าย body, ความยาวรวม)"""
+    boundary = os.urandom(12).hex()
+    parts, total = [], 0
+    for start, end in ranges:
+        head = (f"\r\n--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode('latin-1')
+        parts.append((head, start, end))
+        total += len(head) + end - start + 1
+    tail = f"\r\n--{boundary}--\r\n".encode('latin-1')
+    return boundary, parts, tail, total + len(tail)
+
+class _FilePlan:
+    """ผลการตัดสินใจ response ของไฟล์: status, header และ body เป็นลำดับของ bytes / (start, end) ที่ต้องอ่านจากไฟล์"""
+    __slots__ = ('status', 'headers', 'parts', 'content_type')
+
+    def __init__(self, status, headers, parts=(), content_type=None):
+        self.status = status
+        self.headers = headers
+        self.parts = list(parts)
+        self.content_type = content_type
+
+class _ResolvedFile:
+    """stat + MIME + validator ของไฟล์ที่จะส่ง (คำนวณครั้งเดียวแล้วใช้ซ้ำผ่าน rendition_cache)"""
+    __slots__ = ('path', 'size', 'mtime_ns', 'mtime', 'content_type', 'etag', 'validators', 'version', 'checked', 'created')
+
+    def __init__(self, path: Path, st, version=None):
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.mtime = st.st_mtime
+        self.content_type = mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+        self.etag = _file_etag(st.st_size, st.st_mtime_ns)
+        self.validators = {
+            'ETag': self.etag,
+            'Last-Modified': http_date(int(st.st_mtime)),
+            'Accept-Ranges': 'bytes',
+        }
+        self.version = version
+        self.checked = self.created = time.monotonic()
+
+def _plan_file_response(video_path: Path, headers, method: str, max_age=3600, resolved=None):
+    """
+    ตัดสินใจ response ของไฟล์ตาม Range / conditional header โดยไม่ผูกกับ framework
+    (ใช้ร่วมกันระหว่าง send_video_with_range ของ Flask และโหมด ASGI ใน asgi.py)
+    resolved = _ResolvedFile จาก rendition_cache (ไม่ต้อง stat / guess MIME ซ้ำ)
+    -> _FilePlan หรือ None ถ้าไม่มีไฟล์
+    """
+    if resolved is None:
+        try:
+            resolved = _ResolvedFile(video_path, os.stat(video_path))
+        except OSError:
+            return None
+
+    file_size = resolved.size
+    content_type = resolved.content_type
+    etag = resolved.etag
+    validators = resolved.validators
+    cache = {'Cache-Control': f'public, max-age={max_age}'}
+
+    status = _precondition_status(headers, method, etag, resolved.mtime)
+    if status == 304:
+        return _FilePlan(304, {**validators, **cache}, content_type=content_type)
+    if status is not None:
+        return _FilePlan(status, {}, content_type=content_type)
+
+    ranges = _select_ranges(headers, file_size, etag, resolved.mtime)
+
+    if ranges is None:
+        # ส่งทั้งไฟล์ (200)
+        return _FilePlan(200, {
+            **validators, **cache,
+            'Content-Length': str(file_size),
+            'Content-Type': content_type,
+        }, [(0, file_size - 1)] if file_size else [], content_type)
+
+    if not ranges:
+        return _FilePlan(416, {'Content-Range': f'bytes */{file_size}', 'Content-Length': '0'},
+                         content_type=content_type)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        return _FilePlan(206, {
+            **validators, **cache,
+            'Content-Range': f'bytes {start}-{end}/{file_size}',
+            'Content-Length': str(end - start + 1),
+            'Content-Type': content_type,
+        }, [(start, end)], content_type)
+
+    boundary, parts, tail, total = _multipart_plan(ranges, file_size, content_type)
+    body = []
+    for head, start, end in parts:
+        body += [head, (start, end)]
+    body.append(tail)
+    return _FilePlan(206, {
+        **validators, **cache,
+        'Content-Length': str(total),
+        'Content-Type': f'multipart/byteranges; boundary={boundary}',
+    }, body, content_type)
+
+def _plan_iter(path: Path, parts):
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+        else:
+            yield from _file_iter(path, part[0], part[1], chunk_size=CHUNK_SIZE)
+
+def send_video_with_range(video_path: Path, max_age=3600, resolved=None, pace_session=None):
+    """
+    ส่งไฟล์วิดีโอ/ไฟล์ใหญ่พร้อมรองรับ HTTP Range และ conditional request
+    - Range: bytes=a-b, a-, -n (suffix) และหลายช่วง (multipart/byteranges)
+    - ETag / Last-Modified + If-None-Match / If-Modified-Since (304), If-Match / If-Unmodified-Since (412), If-Range
+    - pace_session: วัดความเร็วของ session นี้ระหว่างส่ง (ส่งด้วย generator แทน sendfile)
+    """
+    started = time.perf_counter()
     video_path = Path(video_path)
-    if not video_path.exists():
+    plan = _plan_file_response(video_path, request.headers, request.method, max_age, resolved)
+    if plan is None:
         abort(404)
+    _observe_stream(request.endpoint, plan.status, plan.headers, started)
+
+    if plan.status in (200, 206):
+        offloaded = _offload_response(video_path, plan.content_type)
+        if offloaded is not None:
+            offloaded.headers.update({k: plan.headers[k] for k in ('ETag', 'Last-Modified', 'Accept-Ranges')})
+            return offloaded
+
+    if plan.parts and (shaper.enabled or pace_session):
+        body = _plan_iter(video_path, plan.parts)
+        if pace_session:
+            body = _measure_pace(body, pace_session)
+        if shaper.enabled:
+            body = shaper.wrap(body, _request_client_key())
+        passthrough = False
+    elif len(plan.parts) == 1 and isinstance(plan.parts[0], tuple):
+        body, passthrough = _range_body(video_path, *plan.parts[0])
+    elif plan.parts:
+        body, passthrough = _plan_iter(video_path, plan.parts), False
+    else:
+        body, passthrough = b'', False
+    resp = Response(body, status=plan.status, direct_passthrough=passthrough, headers=plan.headers)
+    if plan.parts and request.method != 'HEAD':
+        endpoint = request.endpoint
+        active_streams.inc(1, endpoint)
+        resp.call_on_close(lambda: active_streams.dec(1, endpoint))
+    return resp
+
+def _observe_stream(endpoint, status, headers, started):
+    """บันทึก metric ของคำขอไฟล์ 1 ครั้ง (ใช้ทั้ง Flask และ asgi.py)"""
+    endpoint = endpoint or 'other'
+    stream_requests_total.inc(1, endpoint, status)
+    stream_plan_seconds.observe(time.perf_counter() - started, endpoint)
+    if status in (200, 206):
+        stream_response_bytes_total.inc(int(headers.get('Content-Length') or 0), endpoint)
+
+# --------- Basic Auth (เฉพาะหน้า index) ----------
+def _auth_failed():
+    resp = make_response('Authentication required', 401)
+    resp.headers['WWW-Authenticate'] = 'Basic realm="Video Index"'
+    return resp
+
+def require_index_auth(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        auth = request.authorization
+        if not auth or auth.type != 'basic':
+            return _auth_failed()
+        if auth.username != app.config['INDEX_USERNAME'] or auth.password != app.config['INDEX_PASSWORD']:
+            return _auth_failed()
+        return f(*args, **kwargs)
+    return wrapper
+# ---------------------------------------------------
+
+# ==============================
+# METADATA CACHE (ffprobe)
+# ==============================
+class _Flight:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """รวมงานที่ key เดียวกันซึ่งถูกเรียกพร้อมกันให้ทำแค่ครั้งเดียว คนที่มาทีหลังรอผลเดียวกัน"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+class MetadataCache:
+    """
+    เก็บผล ffprobe ถาวรใน SQLite (key = path + size + mtime)
+    - probe เฉพาะไฟล์ใหม่/ไฟล์ที่เปลี่ยน ที่เหลือตอบจากหน่วยความจำ
+    - ไฟล์เดียวกันถูกขอพร้อมกันหลาย request -> probe ครั้งเดียว (SingleFlight)
+    - จำกัดจำนวน ffprobe ที่รันพร้อมกันด้วย semaphore กัน CPU พุ่งตอนเปิดโฟลเดอร์ใหม่
+    - probe ล้มเหลว (ไม่มี ffprobe / timeout) จำไว้ในหน่วยความจำชั่วคราว ไม่บันทึกลง db
+    """
+    SCHEMA = 2  # เพิ่มเลขเมื่อเปลี่ยน field ที่ get_video_info คืน -> probe ใหม่ทั้งหมด
+    RETRY_FAILED_SECONDS = 300
+
+    def __init__(self, db_path, probe, max_concurrent_probes=4):
+        self.db_path = str(db_path)
+        self._probe = probe
+        self._lock = threading.Lock()
+        self._mem = {}  # { path: (size, mtime_ns, info) }
+        self._failed = {}  # { path: (size, mtime_ns, monotonic ts) } probe ล่าสุดที่ล้มเหลว (1 รายการต่อไฟล์)
+        self._flight = SingleFlight()
+        self._probe_slots = threading.BoundedSemaphore(max(1, int(max_concurrent_probes)))
+        self._init_db()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _init_db(self):
+        try:
+            with self._connect() as db:
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS probe (
+                        path     TEXT PRIMARY KEY,
+                        size     INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        schema   INTEGER NOT NULL,
+                        info     TEXT
+                    )
+                """)
+                rows = db.execute("SELECT path, size, mtime_ns, info FROM probe WHERE schema = ?",
+                                  (self.SCHEMA,)).fetchall()
+            with self._lock:
+                for path, size, mtime_ns, info in rows:
+                    self._mem[path] = (size, mtime_ns, json.loads(info) if info else None)
+            print(f"[META] loaded {len(rows)} cached probes from {self.db_path}")
+        except Exception as e:
+            print(f"[META] cannot open metadata db {self.db_path}: {e}")
+
+    def _load_row(self, path: str):
+        try:
+            with self._connect() as db:
+                return db.execute("SELECT size, mtime_ns, info FROM probe WHERE path = ? AND schema = ?",
+                                  (path, self.SCHEMA)).fetchone()
+        except Exception as e:
+            print(f"[META] read error {path}: {e}")
+            return None
+
+    def _store(self, path: str, size: int, mtime_ns: int, info):
+        with self._lock:
+            self._mem[path] = (size, mtime_ns, info)
+            self._failed.pop(path, None)
+        try:
+            with self._connect() as db:
+                db.execute("INSERT OR REPLACE INTO probe (path, size, mtime_ns, schema, info) VALUES (?, ?, ?, ?, ?)",
+                           (path, size, mtime_ns, self.SCHEMA, json.dumps(info)))
+        except Exception as e:
+            print(f"[META] write error {path}: {e}")
+
+    def peek(self, video_path: Path, size: int, mtime_ns: int):
+        """คืนข้อมูลที่ cache ไว้ถ้ายังตรงกับไฟล์ (ไม่ probe) -> (hit, info)"""
+        path = str(video_path)
+        with self._lock:
+            cached = self._mem.get(path)
+            failed = self._failed.get(path)
+        if cached and cached[0] == size and cached[1] == mtime_ns:
+            return True, cached[2]
+        if (failed is not None and failed[:2] == (size, mtime_ns)
+                and time.monotonic() - failed[2] < self.RETRY_FAILED_SECONDS):
+            return True, None
+        return False, None
+
+    def get(self, video_path: Path, stat=None):
+        """ข้อมูลวิดีโอจาก cache หรือ probe ใหม่ถ้าไฟล์ใหม่/เปลี่ยน"""
+        path = str(video_path)
+        st = stat or os.stat(path)
+        hit, info = self.peek(video_path, st.st_size, st.st_mtime_ns)
+        if hit:
+            return info
+
+        def probe():
+            # process อื่น (เช่น gunicorn worker อื่น) อาจ probe ไว้แล้ว
+            row = self._load_row(path)
+            if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                info = json.loads(row[2]) if row[2] else None
+                with self._lock:
+                    self._mem[path] = (st.st_size, st.st_mtime_ns, info)
+                    self._failed.pop(path, None)
+                return info
+            with self._probe_slots:
+                info = self._probe(Path(path))
+            if info is None:
+                with self._lock:
+                    self._failed[path] = (st.st_size, st.st_mtime_ns, time.monotonic())
+            else:
+                self._store(path, st.st_size, st.st_mtime_ns, info)
+            return info
+
+        return self._flight.do((path, st.st_size, st.st_mtime_ns), probe)
+
+# ==============================
+# HOT CACHE (ข้อมูลที่ถูกอ่านซ้ำบ่อยในหน่วยความจำ)
+# ==============================
+class BlockCache:
+    """
+    cache block ขนาด block_size ของ head_bytes แรกของแต่ละไฟล์ จำกัดขนาดรวมแบบ LRU
+    - key = (path, size, mtime_ns, เลข block) -> ไฟล์เปลี่ยนก็ไม่ได้ข้อมูลเก่า
+    - block เดียวกันถูกขอพร้อมกัน -> อ่านครั้งเดียวแล้วแชร์ (SingleFlight)
+    """
+    def __init__(self, head_bytes, max_bytes, block_size=CHUNK_SIZE):
+        self.block_size = int(block_size)
+        self.head_bytes = int(head_bytes) if max_bytes > 0 else 0
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict()  # { key: bytes } เก่าสุดอยู่หน้า
+        self._total = 0
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0  # รอผลจาก request อื่นที่กำลังอ่าน block เดียวกัน
+
+    def _block(self, path: str, st, index: int) -> bytes:
+        key = (path, st.st_size, st.st_mtime_ns, index)
+        with self._lock:
+            data = self._blocks.get(key)
+            if data is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return data
+
+        leader = []
+
+        def read():
+            leader.append(True)
+            with self._lock:
+                self.misses += 1
+            with open(path, 'rb') as f:
+                f.seek(index * self.block_size)
+                data = f.read(self.block_size)
+            with self._lock:
+                self._blocks[key] = data
+                self._total += len(data)
+                while self._total > self.max_bytes and len(self._blocks) > 1:
+                    _, old = self._blocks.popitem(last=False)
+                    self._total -= len(old)
+            return data
+
+        data = self._flight.do(key, read)
+        if not leader:
+            with self._lock:
+                self.shared += 1
+        return data
+
+    def iter_head(self, path, st, start: int, end: int):
+        """byte [start, end] ที่อยู่ในส่วนหัวของไฟล์ เป็นชิ้นๆ (หยุดที่ head_bytes หรือท้ายไฟล์)"""
+        path = str(path)
+        stop = min(end + 1, self.head_bytes, st.st_size)
+        pos = start
+        while pos < stop:
+            index = pos // self.block_size
+            data = self._block(path, st, index)
+            offset = pos - index * self.block_size
+            chunk = data[offset:min(len(data), stop - index * self.block_size)]
+            if not chunk:
+                return  # ไฟล์สั้นกว่าที่ stat บอก (ถูกแก้ระหว่างอ่าน)
+            pos += len(chunk)
+            yield chunk
+
+    def stats(self):
+        with self._lock:
+            blocks, total = len(self._blocks), self._total
+        return {
+            'blocks': blocks,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            'head_bytes': self.head_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+        }
+
+block_cache = BlockCache(app.config['BLOCK_CACHE_HEAD_BYTES'], app.config['BLOCK_CACHE_MAX_BYTES'])
+
+class _HotEntry:
+    __slots__ = ('body', 'size', 'mtime_ns', 'mtime', 'etag', 'headers', 'checked')
+
+    def __init__(self, body, st, max_age, content_type):
+        self.body = body
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.mtime = st.st_mtime
+        self.etag = _file_etag(st.st_size, st.st_mtime_ns)
+        self.headers = {  # header ที่ใช้ซ้ำทุก response คำนวณครั้งเดียว
+            'ETag': self.etag,
+            'Last-Modified': http_date(int(st.st_mtime)),
+            'Accept-Ranges': 'bytes',
+            'Content-Type': content_type,
+            'Cache-Control': f'public, max-age={max_age}',
+        }
+        self.checked = time.monotonic()
+
+class HotCache:
+    """
+    cache เนื้อไฟล์เล็กๆ ที่ถูกขอซ้ำบ่อย (playlist, segment) ไว้ในหน่วยความจำ จำกัดขนาดรวมแบบ LRU
+    - ตรวจว่าไฟล์เปลี่ยนหรือไม่ด้วย stat (size + mtime_ns) ไม่บ่อยกว่า revalidate_seconds ต่อไฟล์
+    - โหลดไฟล์เดียวกันพร้อมกันหลาย request -> อ่านดิสก์ครั้งเดียว (SingleFlight)
+    """
+    def __init__(self, max_bytes, max_item_bytes, revalidate_seconds=1.0):
+        self.max_bytes = int(max_bytes)
+        self.max_item_bytes = int(max_item_bytes)
+        self.revalidate_seconds = revalidate_seconds
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # { path: _HotEntry } เก่าสุดอยู่หน้า
+        self._total = 0
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.bypass = 0  # ใหญ่เกิน max_item_bytes
+        self.evictions = 0
+
+    def get(self, path: Path, max_age: int):
+        """_HotEntry ของไฟล์ (โหลดถ้ายังไม่มี/เปลี่ยน) หรือ None ถ้าไม่มีไฟล์หรือใหญ่เกิน"""
+        key = str(path)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if now - entry.checked < self.revalidate_seconds:
+                    self.hits += 1
+                    return entry
+
+        try:
+            st = os.stat(key)
+        except OSError:
+            self._drop(key)
+            return None
+        if entry is not None and (entry.size, entry.mtime_ns) == (st.st_size, st.st_mtime_ns):
+            entry.checked = now
+            with self._lock:
+                self.hits += 1
+            return entry
+        if st.st_size > self.max_item_bytes:
+            self._drop(key)
+            with self._lock:
+                self.bypass += 1
+            return None
+
+        def load():
+            with self._lock:
+                self.misses += 1
+            with open(key, 'rb') as f:
+                fst = os.fstat(f.fileno())
+                body = f.read()
+            content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+            fresh = _HotEntry(body, fst, max_age, content_type)
+            self._put(key, fresh)
+            return fresh
+
+        try:
+            return self._flight.do((key, st.st_size, st.st_mtime_ns), load)
+        except OSError:
+            return None
+
+    def _put(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old.size
+            self._entries[key] = entry
+            self._total += entry.size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                _, victim = self._entries.popitem(last=False)
+                self._total -= victim.size
+                self.evictions += 1
+
+    def _drop(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old.size
+
+    def stats(self):
+        with self._lock:
+            entries, total = len(self._entries), self._total
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            'max_item_bytes': self.max_item_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypass': self.bypass,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+hot_cache = HotCache(app.config['HOT_CACHE_MAX_BYTES'], app.config['HOT_CACHE_MAX_ITEM_BYTES'],
+                     revalidate_seconds=app.config['HOT_CACHE_REVALIDATE_SECONDS'])
+
+class RenditionCache:
+    """
+    (route, relpath/filename, quality) -> _ResolvedFile ของไฟล์ที่เลือกส่ง
+    - hit: ไม่ต้อง resolve path / regex / glob mp4/ / อ่าน manifest / stat / guess MIME ซ้ำ
+    - ทิ้งเมื่อ version() เปลี่ยน (สถานะงานแปลงไฟล์เปลี่ยน = มี rendition ใหม่/ถูกลบ)
+      หรือไฟล์ที่เลือกเปลี่ยน (stat ไม่บ่อยกว่า revalidate_seconds) หรือครบ ttl
+    - ไม่ cache กรณีไม่พบไฟล์ (ไฟล์ที่เพิ่งถูกวางจะเล่นได้ทันที)
+    - ladder(): รายการ rendition ที่พร้อมเล่นของแต่ละ key (?quality=auto) ทิ้งด้วย version() / ttl เดียวกัน
+    """
+    def __init__(self, max_entries, version, revalidate_seconds=1.0, ttl=60):
+        self.max_entries = int(max_entries)
+        self.version = version
+        self.revalidate_seconds = revalidate_seconds
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # { key: _ResolvedFile } เก่าสุดอยู่หน้า
+        self._ladders = collections.OrderedDict()  # { video key: (version, created, ladder) }
+        self.hits = 0
+        self.misses = 0
+        self.ladder_hits = 0
+        self.ladder_misses = 0
+
+    def get(self, key, resolve):
+        """resolve() -> Path หรือ None ใช้เมื่อไม่มีใน cache / ข้อมูลเก่าแล้ว"""
+        version = self.version()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry.version == version and now - entry.created < self.ttl:
+            if now - entry.checked < self.revalidate_seconds or self._unchanged(entry):
+                entry.checked = now
+                with self._lock:
+                    self.hits += 1
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                return entry
+
+        with self._lock:
+            self.misses += 1
+        path = resolve()
+        try:
+            entry = _ResolvedFile(path, os.stat(path), version) if path is not None else None
+        except OSError:
+            entry = None
+        with self._lock:
+            if entry is None:
+                self._entries.pop(key, None)
+                return None
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _unchanged(entry: _ResolvedFile) -> bool:
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            return False
+        return st.st_size == entry.size and st.st_mtime_ns == entry.mtime_ns
+
+    def ladder(self, key, build):
+        """build() -> ladder [{name, bandwidth}] ของ video key ใช้เมื่อไม่มีใน cache / version() เปลี่ยน / ครบ ttl"""
+        version = self.version()
+        now = time.monotonic()
+        with self._lock:
+            cached = self._ladders.get(key)
+            if cached is not None and cached[0] == version and now - cached[1] < self.ttl:
+                self._ladders.move_to_end(key)
+                self.ladder_hits += 1
+                return cached[2]
+            self.ladder_misses += 1
+        ladder = build()
+        with self._lock:
+            self._ladders[key] = (version, now, ladder)
+            self._ladders.move_to_end(key)
+            while len(self._ladders) > self.max_entries:
+                self._ladders.popitem(last=False)
+        return ladder
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._ladders.clear()
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+            ladders = len(self._ladders)
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            'ladders': ladders,
+            'ladder_hits': self.ladder_hits,
+            'ladder_misses': self.ladder_misses,
+        }
+
+rendition_cache = RenditionCache(
+    app.config['RENDITION_CACHE_ENTRIES'], lambda: video_processor.queue.states_version(),
+    revalidate_seconds=app.config['RENDITION_CACHE_REVALIDATE_SECONDS'], ttl=app.config['RENDITION_CACHE_TTL'],
+)
+
+def _plan_hot_response(entry: _HotEntry, headers, method: str):
+    """
+    response จาก _HotEntry ตาม Range / conditional header (ไม่ผูกกับ framework)
+    -> (status, headers, body) หรือ None ถ้าต้องส่งจากดิสก์แทน (multi-range)
+    """
+    status = _precondition_status(headers, method, entry.etag, entry.mtime)
+    if status == 304:
+        return 304, {k: v for k, v in entry.headers.items() if k != 'Content-Type'}, b''
+    if status is not None:
+        return status, {}, b''
+
+    ranges = _select_ranges(headers, entry.size, entry.etag, entry.mtime)
+    if ranges is None:
+        return 200, {**entry.headers, 'Content-Length': str(entry.size)}, entry.body
+    if not ranges:
+        return 416, {'Content-Range': f'bytes */{entry.size}', 'Content-Length': '0'}, b''
+    if len(ranges) > 1:
+        return None
+    start, end = ranges[0]
+    return 206, {
+        **entry.headers,
+        'Content-Range': f'bytes {start}-{end}/{entry.size}',
+        'Content-Length': str(end - start + 1),
+    }, entry.body[start:end + 1]
+
+def send_hot_file(path: Path, max_age=600):
+    """
+    เหมือน send_video_with_range แต่ตอบจากหน่วยความจำ (hot_cache) ด้วย header ที่คำนวณไว้แล้ว
+    ไฟล์ใหญ่เกิน / multi-range -> ส่งจากดิสก์ตามปกติ
+    """
+    started = time.perf_counter()
+    entry = hot_cache.get(path, max_age)
+    planned = _plan_hot_response(entry, request.headers, request.method) if entry is not None else None
+    if planned is None:
+        return send_video_with_range(path, max_age=max_age)
+    status, headers, body = planned
+    _observe_stream(request.endpoint, status, headers, started)
+    if body and shaper.enabled:
+        body = shaper.wrap([body], _request_client_key())
+    return Response(body, status=status, headers=headers)
+
+# ==============================
+# BANDWIDTH SHAPING
+# ==============================
+class TokenBucket:
+    """
+    token bucket แบบจองล่วงหน้า: reserve(n) หัก token ทันที (ติดลบได้) แล้วคืนเวลาที่ต้องรอ (วินาที)
+    ผู้เรียกเป็นคนรอเอง -> ใช้ได้ทั้ง thread (time.sleep) และ asyncio (asyncio.sleep)
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: int) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= n
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+class _ShapedStream:
+    """ตัวจำกัดของ 1 response: burst เริ่มต้น -> ส่วนแบ่งที่ยุติธรรมของ global + bucket ของ client"""
+    def __init__(self, shaper, client, client_bucket):
+        self.shaper = shaper
+        self.client = client
+        self.client_bucket = client_bucket
+        self.burst_left = shaper.burst_bytes
+        share = shaper.global_bps
+        self.fair = TokenBucket(share, max(SHAPING_SLICE, share // 4))
+        self.sent = 0
+
+    def delay(self, n: int) -> float:
+        """จองการส่ง n byte -> วินาทีที่ต้องรอก่อนส่ง"""
+        self.sent += n
+        wait = self.shaper.global_bucket.reserve(n)  # uplink จริงจำกัดเสมอ แม้ช่วง burst
+        if self.burst_left > 0:
+            self.burst_left -= n
+            return wait
+        if self.shaper.global_bps:
+            self.fair.rate = self.shaper.global_bps / max(1, self.shaper.active)
+            wait = max(wait, self.fair.reserve(n))
+        if self.client_bucket is not None:
+            wait = max(wait, self.client_bucket.reserve(n))
+        return wait
+
+    def close(self):
+        self.shaper._close(self)
+
+class BandwidthShaper:
+    """
+    จำกัด bandwidth ขาออกรวม (global_bps) และต่อ client (client_bps)
+    - stream ที่ active แบ่งความเร็ว global กันเท่าๆ กัน (fair share = global_bps / จำนวน stream)
+    - แต่ละ stream ได้ burst_bytes แรกโดยไม่ติด fair share / ขีดจำกัดของ client (เริ่มเล่นได้เร็ว)
+    """
+    def __init__(self, global_bps=0, client_bps=0, burst_bytes=0):
+        self.global_bps = int(global_bps)
+        self.client_bps = int(client_bps)
+        self.burst_bytes = int(burst_bytes)
+        self.global_bucket = TokenBucket(self.global_bps, max(SHAPING_SLICE, self.global_bps // 4))
+        self._lock = threading.Lock()
+        self._clients = {}  # { client: [TokenBucket, จำนวน stream] }
+        self.active = 0
+        self.total_streams = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.global_bps > 0 or self.client_bps > 0
+
+    def open(self, client: str) -> _ShapedStream:
+        with self._lock:
+            self.active += 1
+            self.total_streams += 1
+            bucket = None
+            if self.client_bps > 0:
+                slot = self._clients.setdefault(
+                    client, [TokenBucket(self.client_bps, max(SHAPING_SLICE, self.client_bps // 4)), 0])
+                slot[1] += 1
+                bucket = slot[0]
+        return _ShapedStream(self, client, bucket)
+
+    def _close(self, stream: _ShapedStream):
+        with self._lock:
+            self.active -= 1
+            slot = self._clients.get(stream.client)
+            if slot is not None:
+                slot[1] -= 1
+                if slot[1] <= 0:
+                    del self._clients[stream.client]
+
+    def wrap(self, chunks, client: str):
+        """generator ที่ส่ง chunks ตามขีดจำกัด (หั่นเป็นชิ้นละ SHAPING_SLICE)"""
+        stream = self.open(client)
+        try:
+            for chunk in chunks:
+                view = memoryview(chunk)
+                for i in range(0, len(view), SHAPING_SLICE):
+                    piece = view[i:i + SHAPING_SLICE]
+                    wait = stream.delay(len(piece))
+                    if wait > 0:
+                        time.sleep(wait)
+                    yield bytes(piece)
+        finally:
+            stream.close()
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'global_bps': self.global_bps,
+                'client_bps': self.client_bps,
+                'burst_bytes': self.burst_bytes,
+                'active_streams': self.active,
+                'active_clients': len(self._clients),
+                'fair_share_bps': self.global_bps // max(1, self.active) if self.global_bps else None,
+                'total_streams': self.total_streams,
+            }
+
+shaper = BandwidthShaper(app.config['SHAPING_GLOBAL_BPS'], app.config['SHAPING_CLIENT_BPS'],
+                         burst_bytes=app.config['SHAPING_BURST_BYTES'])
+
+def _client_key(headers, remote_addr, args=None, cookies=None, prefer_session=None) -> str:
+    """ตัวระบุ client สำหรับจำกัด bandwidth / ABR (ไม่ผูกกับ framework)"""
+    if prefer_session is None:
+        prefer_session = app.config['SHAPING_CLIENT_KEY'] == 'session'
+    if prefer_session:
+        sid = (args or {}).get('sid') or (cookies or {}).get('vs_sid')
+        if sid:
+            return f"sid:{sid}"
+    if app.config['SHAPING_TRUST_X_FORWARDED_FOR']:
+        forwarded = headers.get('X-Forwarded-For')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return remote_addr or '-'
+
+def _request_client_key() -> str:
+    return _client_key(request.headers, request.remote_addr, request.args, request.cookies)
+
+# ==============================
+# ADAPTIVE QUALITY (?quality=auto สำหรับ MP4 progressive)
+# ==============================
+class AdaptiveQuality:
+    """
+    เลือก rendition MP4 ตามความเร็วของผู้ชมแต่ละ session
+    - ความเร็ว = EWMA ของเวลาที่ server ส่ง ABR_SAMPLE_BYTES ของ response ที่สุ่มวัด (ดู _measure_pace / _pace_session)
+      ยังไม่เคยวัด -> ใช้ client hint (header Downlink / ?downlink= หน่วย Mbps)
+    - ?quality=auto ของ session + ไฟล์เดิมได้ rendition เดิมเสมอ (sticky) เพราะ Range ที่ต่อกันต้องมาจากไฟล์เดียว
+      การสลับกลางทางทำที่ player: ถาม /api/abr/ แล้วโหลด rendition ใหม่ที่เวลา keyframe ถัดไป
+    """
+    def __init__(self, safety=0.7, alpha=0.3, session_ttl=1800, max_sessions=10000, sample_interval=10):
+        self.safety = safety
+        self.alpha = alpha
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._sessions = collections.OrderedDict()  # { session: {'bps', 'seen', 'sampled', 'picks': {key: ชื่อ rendition}} }
+        self.samples = 0
+
+    def _session(self, session, create=False):
+        """ต้องถือ self._lock อยู่"""
+        now = time.monotonic()
+        s = self._sessions.get(session)
+        if s is not None and now - s['seen'] > self.session_ttl:
+            del self._sessions[session]
+            s = None
+        if s is None:
+            if not create:
+                return None
+            s = self._sessions[session] = {'bps': None, 'seen': now, 'sampled': None, 'picks': {}}
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        s['seen'] = now
+        self._sessions.move_to_end(session)
+        return s
+
+    def observe(self, session, nbytes: int, seconds: float):
+        bps = nbytes * 8 / max(seconds, 1e-3)
+        with self._lock:
+            s = self._session(session, create=True)
+            s['bps'] = bps if s['bps'] is None else self.alpha * bps + (1 - self.alpha) * s['bps']
+            self.samples += 1
+
+    def claim_sample(self, session) -> bool:
+        """True = ให้ response นี้วัดความเร็วของ session (ไม่มี response ไหนได้สิทธิ์ภายใน sample_interval วินาที)"""
+        now = time.monotonic()
+        with self._lock:
+            s = self._session(session, create=True)
+            if s['sampled'] is not None and now - s['sampled'] < self.sample_interval:
+                return False
+            s['sampled'] = now
+            return True
+
+    def estimate(self, session, hint_bps=None):
+        """bit/วินาที ที่ประเมินได้ของ session หรือ hint_bps ถ้ายังไม่เคยวัด (None = ไม่รู้)"""
+        with self._lock:
+            s = self._session(session)
+            bps = s['bps'] if s is not None else None
+        return bps if bps is not None else hint_bps
+
+    def recommend(self, ladder, bps):
+        """ladder = [{name, bandwidth}] เรียงจากน้อยไปมาก -> rendition ที่ใหญ่ที่สุดที่ความเร็วนี้รับไหว"""
+        if not ladder:
+            return None
+        if bps is None:
+            names = [r['name'] for r in ladder]
+            return next(iter(_fallback_order(names, ladder)), names[0])
+        fitting = [r for r in ladder if r['bandwidth'] <= bps * self.safety]
+        return (fitting[-1] if fitting else ladder[0])['name']
+
+    def choose(self, session, key, ladder, hint_bps=None):
+        """rendition ของ ?quality=auto (ครั้งแรกเลือกตามความเร็ว แล้ว sticky ต่อ session + key)"""
+        names = {r['name'] for r in ladder}
+        with self._lock:
+            picked = self._session(session, create=True)['picks'].get(key)
+        if picked in names:
+            return picked
+        name = self.recommend(ladder, self.estimate(session, hint_bps))
+        with self._lock:
+            self._session(session, create=True)['picks'][key] = name
+        return name
+
+    def picked(self, session, key):
+        with self._lock:
+            s = self._session(session)
+            return s['picks'].get(key) if s is not None else None
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        measured = [s['bps'] for s in sessions if s['bps'] is not None]
+        return {
+            'sessions': len(sessions),
+            'measured_sessions': len(measured),
+            'samples': self.samples,
+            'median_bps': int(sorted(measured)[len(measured) // 2]) if measured else None,
+        }
+
+adaptive = AdaptiveQuality(app.config['ABR_SAFETY'], ABR_EWMA_ALPHA, ABR_SESSION_TTL, ABR_MAX_SESSIONS,
+                           ABR_SAMPLE_INTERVAL)
+
+def _measure_pace(chunks, session):
+    """
+    ส่ง chunk ต่อแล้ววัดเวลาที่ใช้ส่ง byte ช่วง [ABR_SKIP_BYTES, ABR_SKIP_BYTES + ABR_SAMPLE_BYTES) -> adaptive.observe
+    server ขอ chunk ถัดไปหลังเขียน chunk ก่อนหน้าลง socket แล้ว -> จังหวะที่ถูกขอ = ความเร็วที่ client รับได้
+    (ช่วงต้น response / หลัง seek browser อ่านเต็มที่ ช่วงหลังถูก browser หน่วงเมื่อ buffer เต็ม จึงไม่วัด)
+    """
+    sent, t0, done = 0, None, False
+    try:
+        for chunk in chunks:
+            yield chunk
+            if done:
+                continue
+            sent += len(chunk)
+            if t0 is None:
+                if sent >= ABR_SKIP_BYTES:
+                    t0, mark = time.monotonic(), sent
+            elif sent - mark >= ABR_SAMPLE_BYTES:
+                adaptive.observe(session, sent - mark, time.monotonic() - t0)
+                done = True
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+def _downlink_hint(headers, args=None):
+    """client hint เป็น bit/วินาที: ?downlink= หรือ header Downlink (Mbps, navigator.connection.downlink)"""
+    value = (args or {}).get('downlink') or headers.get('Downlink')
+    try:
+        mbps = float(value)
+    except (TypeError, ValueError):
+        return None
+    return mbps * 1e6 if mbps > 0 else None
+
+def _has_sid(args=None, cookies=None) -> bool:
+    return bool((args or {}).get('sid') or (cookies or {}).get('vs_sid'))
+
+def _abr_session(headers, remote_addr, args=None, cookies=None, quality=None):
+    """session ของ ABR: มี ?sid= / cookie vs_sid หรือขอ quality=auto (ไม่มี sid ใช้ ip) ไม่งั้น None"""
+    if quality != 'auto' and not _has_sid(args, cookies):
+        return None
+    return _client_key(headers, remote_addr, args, cookies, prefer_session=True)
+
+def _pace_session(session, args=None, cookies=None):
+    """
+    session ที่ response นี้ต้องวัดความเร็ว (ส่งด้วย generator) หรือ None = ส่งแบบ sendfile ตามปกติ
+    - เฉพาะ request ที่มี sid (player) -- quality=auto ที่ไม่มี sid ใช้ ip ซึ่งหลายผู้ชมอาจใช้ร่วมกัน
+    - ต่อ session ไม่เกิน 1 response ทุก ABR_SAMPLE_INTERVAL วินาที
+    """
+    if session is None or not _has_sid(args, cookies):
+        return None
+    return session if adaptive.claim_sample(session) else None
+
+# ==============================
+# TRANSCODE JOB QUEUE
+# ==============================
+class QueueFull(Exception):
+    pass
+
+class JobCancelled(Exception):
+    pass
+
+class TranscodeJob:
+    """งานแปลงไฟล์ที่กำลังรันใน process นี้ (key = safe_id_from_relpath)"""
+    def __init__(self, key, input_file, make_hls=True, force=False, duration=None):
+        self.key = key
+        self.input_file = Path(input_file)
+        self.make_hls = make_hls
+        self.force = force        # True = encode ใหม่ทุก rendition แม้มีไฟล์เสร็จแล้ว
+        self.duration = duration  # ความยาวต้นฉบับ (วินาที)
+        self.process = None       # subprocess.Popen ของ ffmpeg ที่กำลังรัน
+        self.encode_seconds = 0.0  # เวลาที่ใช้รัน ffmpeg จริง (งานที่ข้ามทุก rendition = 0)
+        self.cancel_event = threading.Event()
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['key'], row['input_file'], bool(row['make_hls']), bool(row['force']), row['duration'])
+
+    def cancel(self):
+        self.cancel_event.set()
+        proc = self.process
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+
+class JobStore:
+    """
+    สถานะงานแปลงไฟล์ถาวรใน SQLite (1 แถวต่อ key = งานล่าสุดของ key นั้น)
+    ใช้ร่วมกันได้หลาย process (gunicorn หลาย worker) -> การจองงานทำใน transaction (BEGIN IMMEDIATE)
+    งาน processing ที่ไม่มี heartbeat เกิน stale_seconds (process ตาย/เครื่องดับ) ถูกคืนเข้าคิว
+    """
+    def __init__(self, db_path, stale_seconds=60):
+        self.db_path = str(db_path)
+        self.stale_seconds = stale_seconds
+        with contextlib.closing(self._connect()) as db:
+            try:
+                db.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError:
+                pass
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    key              TEXT PRIMARY KEY,
+                    input_file       TEXT NOT NULL,
+                    make_hls         INTEGER NOT NULL,
+                    force            INTEGER NOT NULL DEFAULT 0,
+                    priority         INTEGER NOT NULL DEFAULT 0,
+                    seq              INTEGER NOT NULL,
+                    state            TEXT NOT NULL,
+                    duration         REAL,
+                    created          REAL NOT NULL,
+                    started          REAL,
+                    finished         REAL,
+                    owner            TEXT,
+                    heartbeat        REAL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    encode_seconds   REAL,
+                    progress         TEXT,
+                    error            TEXT
+                )
+            """)
+            columns = {r['name'] for r in db.execute("PRAGMA table_info(jobs)")}
+            if 'progress' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN progress TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority DESC, seq)")
+            # batch = กลุ่มงานที่ส่งพร้อมกันจาก /api/batch (ความคืบหน้าอ่านจาก jobs ของ key ในชุด)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS batches (
+                    id      TEXT PRIMARY KEY,
+                    created REAL NOT NULL,
+                    spec    TEXT NOT NULL,
+                    skipped INTEGER NOT NULL DEFAULT 0,
+                    rejected INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS batch_jobs (
+                    batch_id TEXT NOT NULL,
+                    key      TEXT NOT NULL,
+                    relpath  TEXT NOT NULL,
+                    duration REAL,
+                    PRIMARY KEY (batch_id, key)
+                )
+            """)
+
+    def _connect(self):
+        """autocommit (isolation_level=None): ใช้กับ contextlib.closing หรือ BEGIN/COMMIT + close() เอง"""
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def get(self, key):
+        with contextlib.closing(self._connect()) as db:
+            row = db.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+
+    def states(self):
+        with contextlib.closing(self._connect()) as db:
+            return dict(db.execute("SELECT key, state FROM jobs").fetchall())
+
+    def submit(self, key, input_file, make_hls, force, priority, duration, max_queued):
+        """-> (row, created)"""
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is not None and row['state'] in ('queued', 'processing'):
+                if row['state'] == 'queued' and priority > row['priority']:
+                    db.execute("UPDATE jobs SET priority = ? WHERE key = ?", (priority, key))
+                db.execute("COMMIT")
+                return self.get(key), False
+
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            if queued >= max_queued:
+                db.execute("ROLLBACK")
+                raise QueueFull(f'transcode queue is full ({max_queued})')
+
+            seq = db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM jobs").fetchone()[0]
+            db.execute("""
+                INSERT OR REPLACE INTO jobs (key, input_file, make_hls, force, priority, seq, state, duration, created)
+                VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)
+            """, (key, str(input_file), int(make_hls), int(force), priority, seq, duration, time.time()))
+            db.execute("COMMIT")
+            return self.get(key), True
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def submit_many(self, entries, make_hls, force, priority, max_queued):
+        """
+        ส่งหลายงานใน transaction เดียว ตามลำดับของ entries = [(key, input_file, duration)]
+        -> { key: 'created' / 'queued' / 'processing' / 'queue_full' }
+        """
+        result = {}
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM jobs").fetchone()[0]
+            now = time.time()
+            for key, input_file, duration in entries:
+                row = db.execute("SELECT state, priority FROM jobs WHERE key = ?", (key,)).fetchone()
+                if row is not None and row['state'] in ('queued', 'processing'):
+                    if row['state'] == 'queued' and priority > row['priority']:
+                        db.execute("UPDATE jobs SET priority = ? WHERE key = ?", (priority, key))
+                    result[key] = row['state']
+                    continue
+                if queued >= max_queued:
+                    result[key] = 'queue_full'
+                    continue
+                seq += 1
+                queued += 1
+                db.execute("""
+                    INSERT OR REPLACE INTO jobs (key, input_file, make_hls, force, priority, seq, state, duration, created)
+                    VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)
+                """, (key, str(input_file), int(make_hls), int(force), priority, seq, duration, now))
+                result[key] = 'created'
+            db.execute("COMMIT")
+            return result
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def create_batch(self, batch_id, spec, members, skipped, rejected):
+        """members = [(key, relpath, duration)] ของงานที่อยู่ในคิวแล้ว"""
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("INSERT INTO batches (id, created, spec, skipped, rejected) VALUES (?, ?, ?, ?, ?)",
+                       (batch_id, time.time(), json.dumps(spec), skipped, rejected))
+            db.executemany("INSERT OR IGNORE INTO batch_jobs (batch_id, key, relpath, duration) VALUES (?, ?, ?, ?)",
+                           [(batch_id, *m) for m in members])
+            db.execute("COMMIT")
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def batch(self, batch_id):
+        """-> (batch row, [งานล่าสุดของแต่ละ key ในชุด + relpath]) หรือ (None, [])"""
+        with contextlib.closing(self._connect()) as db:
+            row = db.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return None, []
+            jobs = db.execute("""
+                SELECT b.key, b.relpath, COALESCE(j.duration, b.duration) AS duration, j.state, j.started,
+                       j.finished, j.encode_seconds, j.progress, j.error
+                FROM batch_jobs b LEFT JOIN jobs j ON j.key = b.key
+                WHERE b.batch_id = ?
+            """, (batch_id,)).fetchall()
+        return dict(row), [dict(j) for j in jobs]
+
+    def claim(self, owner):
+        """จองงานที่ priority สูงสุด (คืนงานค้างของ process ที่ตายแล้วเข้าคิวก่อน) -> row หรือ None"""
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            db.execute("""
+                UPDATE jobs SET state = 'queued', owner = NULL
+                WHERE state = 'processing' AND COALESCE(heartbeat, 0) < ?
+            """, (now - self.stale_seconds,))
+            row = db.execute("""
+                SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority DESC, seq LIMIT 1
+            """).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute("""
+                UPDATE jobs SET state = 'processing', owner = ?, started = ?, heartbeat = ?,
+                                finished = NULL, error = NULL, progress = NULL, cancel_requested = 0
+                WHERE key = ?
+            """, (owner, now, now, row['key']))
+            db.execute("COMMIT")
+            return dict(row)
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def requeue_interrupted(self, owner):
+        """
+        ตอนเริ่ม process: คืนงาน processing ที่ค้างจากการรันครั้งก่อนเข้าคิวทันที -> [key]
+        - heartbeat เก่าเกิน stale_seconds (process ตาย/เครื่องดับ)
+        - เป็นของ process บนเครื่องนี้ที่ไม่อยู่แล้ว หรือ owner เดียวกับเรา (pid ซ้ำหลังรีสตาร์ต)
+          -> ไม่ต้องรอจน heartbeat เก่า
+        """
+        node = owner.rpartition(':')[0]
+        cutoff = time.time() - self.stale_seconds
+        with contextlib.closing(self._connect()) as db:
+            rows = db.execute("SELECT key, owner, heartbeat FROM jobs WHERE state = 'processing'").fetchall()
+            orphans = [r for r in rows
+                       if (r['heartbeat'] or 0) < cutoff or r['owner'] == owner or _dead_local_owner(r['owner'], node)]
+            requeued = []
+            for r in orphans:
+                cur = db.execute("""
+                    UPDATE jobs SET state = 'queued', owner = NULL
+                    WHERE key = ? AND state = 'processing' AND owner IS ?
+                """, (r['key'], r['owner']))
+                if cur.rowcount:
+                    requeued.append(r['key'])
+        return requeued
+
+    def set_progress(self, key, progress):
+        with contextlib.closing(self._connect()) as db:
+            db.execute("UPDATE jobs SET progress = ? WHERE key = ?", (json.dumps(progress), key))
+
+    def changed_since(self, ts, keys=None):
+        """สำหรับ SSE: ทุกงานใน keys หรือ (ถ้าไม่ระบุ) งานที่กำลังรัน/จบหลังเวลา ts -> [row]"""
+        if keys:
+            sql = f"SELECT * FROM jobs WHERE key IN ({','.join('?' * len(keys))})"
+            params = list(keys)
+        else:
+            sql = "SELECT * FROM jobs WHERE state = 'processing' OR finished >= ?"
+            params = [ts]
+        with contextlib.closing(self._connect()) as db:
+            return [dict(r) for r in db.execute(sql, params).fetchall()]
+
+    def heartbeat(self, owner, keys):
+        """ต่ออายุงานที่ process นี้ถืออยู่ -> set ของ key ที่ถูกสั่งยกเลิกจาก process อื่น"""
+        if not keys:
+            return set()
+        marks = ','.join('?' * len(keys))
+        with contextlib.closing(self._connect()) as db:
+            db.execute(f"UPDATE jobs SET heartbeat = ? WHERE owner = ? AND key IN ({marks})",
+                       (time.time(), owner, *keys))
+            rows = db.execute(f"SELECT key FROM jobs WHERE owner = ? AND cancel_requested = 1 AND key IN ({marks})",
+                              (owner, *keys)).fetchall()
+        return {r['key'] for r in rows}
+
+    def finish(self, key, owner, state, encode_seconds=None, error=None):
+        with contextlib.closing(self._connect()) as db:
+            db.execute("""
+                UPDATE jobs SET state = ?, finished = ?, encode_seconds = ?, error = ?, heartbeat = NULL
+                WHERE key = ? AND owner = ? AND state = 'processing'
+            """, (state, time.time(), encode_seconds, error, key, owner))
+
+    def cancel(self, key):
+        """-> state เดิมของงานที่ถูกยกเลิก ('queued' / 'processing') หรือ None"""
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT state FROM jobs WHERE key = ?", (key,)).fetchone()
+            state = row['state'] if row else None
+            if state == 'queued':
+                db.execute("UPDATE jobs SET state = 'cancelled', finished = ? WHERE key = ?", (time.time(), key))
+            elif state == 'processing':
+                db.execute("UPDATE jobs SET cancel_requested = 1 WHERE key = ?", (key,))
+            else:
+                state = None
+            db.execute("COMMIT")
+            return state
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def queue_ahead(self, row):
+        """งานที่รออยู่ก่อน row (priority สูงกว่า หรือเท่ากันแต่มาก่อน)"""
+        with contextlib.closing(self._connect()) as db:
+            return [dict(r) for r in db.execute("""
+                SELECT * FROM jobs WHERE state = 'queued' AND (priority > ? OR (priority = ? AND seq < ?))
+            """, (row['priority'], row['priority'], row['seq'])).fetchall()]
+
+    def running(self):
+        with contextlib.closing(self._connect()) as db:
+            return [dict(r) for r in db.execute("SELECT * FROM jobs WHERE state = 'processing'").fetchall()]
+
+    def counts(self):
+        with contextlib.closing(self._connect()) as db:
+            return dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def speed(self, last=20):
+        """ความเร็วจากงานที่ encode จริงล่าสุด -> (วินาทีที่ใช้ต่อวินาทีของวิดีโอ, เวลาเฉลี่ยต่องาน)"""
+        with contextlib.closing(self._connect()) as db:
+            rows = db.execute("""
+                SELECT encode_seconds AS took, duration FROM jobs
+                WHERE state = 'completed' AND encode_seconds > 0
+                ORDER BY finished DESC LIMIT ?
+            """, (last,)).fetchall()
+        if not rows:
+            return None, None
+        avg_job = sum(r['took'] for r in rows) / len(rows)
+        timed = [r for r in rows if r['duration']]
+        per_sec = sum(r['took'] for r in timed) / sum(r['duration'] for r in timed) if timed else None
+        return per_sec, avg_job
+
+def _dead_local_owner(owner, node) -> bool:
+    """owner 'เครื่อง:pid' เป็น process บนเครื่องนี้ที่ไม่อยู่แล้วไหม (Windows ตรวจ pid ไม่ได้ -> False = รอ heartbeat)"""
+    owner_node, _, pid = (owner or '').rpartition(':')
+    if owner_node != node or not pid.isdigit() or int(pid) == os.getpid() or os.name == 'nt':
+        return False
+    try:
+        os.kill(int(pid), 0)  # signal 0 = แค่ตรวจว่ามี process
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False  # มีอยู่แต่ไม่มีสิทธิ์ส่ง signal
+    return False
+
+class ProgressHub:
+    """
+    ความคืบหน้าของงานที่กำลังรันใน process นี้ + ปลุก SSE client ทันทีที่มีข้อมูลใหม่
+    เขียนลง JobStore ไม่เกินทุก persist_seconds เพื่อให้ process อื่นเห็นด้วย
+    """
+    def __init__(self, persist_seconds=1.0):
+        self.persist_seconds = persist_seconds
+        self.store = None
+        self._cv = threading.Condition()
+        self._version = 0
+        self._persisted = {}  # { key: monotonic ts }
+
+    def publish(self, key, progress=None):
+        """progress=None = แค่ปลุก client (เช่น งานเปลี่ยน state)"""
+        now = time.monotonic()
+        if progress is None:
+            self._persisted.pop(key, None)
+        elif self.store is not None and (progress.get('percent') == 100.0
+                                         or now - self._persisted.get(key, 0) >= self.persist_seconds):
+            self._persisted[key] = now
+            try:
+                self.store.set_progress(key, progress)
+            except sqlite3.Error as e:
+                print(f"[PROGRESS] cannot persist {key}: {e}")
+        with self._cv:
+            self._version += 1
+            self._cv.notify_all()
+
+    def wait(self, version, timeout):
+        """รอจนมีการ publish ใหม่กว่า version หรือครบ timeout -> version ล่าสุด"""
+        with self._cv:
+            if self._version == version:
+                self._cv.wait(timeout)
+            return self._version
+
+progress_hub = ProgressHub()
+
+class TranscodeQueue:
+    """
+    คิวงานแปลงไฟล์ + worker pool จำนวนจำกัด (สถานะเก็บใน JobStore)
+    - key เดียวกันที่ยังรอ/กำลังทำอยู่ -> คืนงานเดิม (ไม่สร้างซ้ำ) และเลื่อน priority ขึ้นถ้าขอสูงกว่า
+    - priority มาก = ทำก่อน, เท่ากัน = มาก่อนทำก่อน
+    - ยกเลิกได้ทั้งงานที่รอและงานที่กำลังรัน (kill ffmpeg แม้อยู่คนละ process ผ่าน heartbeat)
+    - ประมาณตำแหน่งคิวและ ETA จากความเร็ว encode ที่วัดได้จริง (วินาทีที่ใช้ / วินาทีของวิดีโอ)
+    """
+    POLL_SECONDS = 2        # ตรวจงานที่ process อื่นส่งเข้าคิว
+    HEARTBEAT_SECONDS = 10
+
+    def __init__(self, run_job, store: JobStore, workers=1, max_queued=1000):
+        self._run_job = run_job
+        self.store = store
+        self.workers = max(1, int(workers))
+        self.max_queued = max_queued
+        self.owner = f"{platform.node()}:{os.getpid()}"
+        self._cv = threading.Condition()
+        self._running = {}  # { key: TranscodeJob } เฉพาะใน process นี้
+        self._started = False
+        self._states = (0.0, {})
+        self._seen_states = {}
+        self._states_version = 0
+
+    def start(self):
+        """เริ่ม worker (ครั้งเดียวต่อ process) หลังคืนงานที่ค้างจากการรันครั้งก่อนเข้าคิว"""
+        with self._cv:
+            if self._started:
+                return
+            self._started = True
+        try:
+            requeued = self.store.requeue_interrupted(self.owner)
+            if requeued:
+                print(f"[QUEUE] requeued {len(requeued)} interrupted job(s): {', '.join(requeued)}")
+        except sqlite3.Error as e:
+            print(f"[QUEUE] requeue error: {e}")
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'transcode-{i}', daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, name='transcode-heartbeat', daemon=True).start()
+
+    def submit(self, key, input_file, make_hls=True, priority=0, duration=None, force=False):
+        """-> (row, created)"""
+        self.start()
+        row, created = self.store.submit(key, input_file, make_hls, force, priority, duration, self.max_queued)
+        with self._cv:
+            self._states = (0.0, {})
+            self._cv.notify()
+        return row, created
+
+    def submit_many(self, entries, make_hls=True, priority=0, force=False):
+        """ส่งหลายงานพร้อมกัน (ดู JobStore.submit_many) แล้วปลุกทุก worker"""
+        self.start()
+        result = self.store.submit_many(entries, make_hls, force, priority, self.max_queued)
+        with self._cv:
+            self._states = (0.0, {})
+            self._cv.notify_all()
+        return result
+
+    def cancel(self, key) -> bool:
+        state = self.store.cancel(key)
+        if state is None:
+            return False
+        with self._cv:
+            job = self._running.get(key)
+            self._states = (0.0, {})
+        if job is not None:
+            job.cancel()
+        return True
+
+    def _current_states(self):
+        ts, states = self._states
+        if time.monotonic() - ts > 1.0:
+            states = self.store.states()
+            if states != self._seen_states:
+                self._seen_states = states
+                self._states_version += 1
+            self._states = (time.monotonic(), states)
+        return states
+
+    def state_of(self, key):
+        """สถานะล่าสุดของ key (cache 1 วินาที เพราะถูกเรียกทีละหลายพันไฟล์ตอน list)"""
+        return self._current_states().get(key)
+
+    def states_version(self) -> int:
+        """เลขที่เพิ่มขึ้นทุกครั้งที่สถานะงานใดๆ เปลี่ยน (ใช้ตัดสินว่า listing ที่ cache ไว้ยังใช้ได้ไหม)"""
+        self._current_states()
+        return self._states_version
+
+    def _worker(self):
+        while True:
+            try:
+                row = self.store.claim(self.owner)
+            except sqlite3.Error as e:
+                print(f"[QUEUE] claim error: {e}")
+                row = None
+            if row is None:
+                with self._cv:
+                    self._cv.wait(self.POLL_SECONDS)
+                continue
+
+            job = TranscodeJob.from_row(row)
+            with self._cv:
+                self._running[job.key] = job
+                self._states = (0.0, {})
+            error = None
+            t0 = time.monotonic()
+            try:
+                ok = self._run_job(job)
+            except JobCancelled:
+                ok = None
+            except Exception as e:
+                print(f"[QUEUE] job {job.key} crashed: {e}")
+                ok, error = False, str(e)
+
+            with self._cv:
+                self._running.pop(job.key, None)
+                self._states = (0.0, {})
+            if job.cancel_event.is_set() or ok is None:
+                state = 'cancelled'
+            else:
+                state = 'completed' if ok else 'error'
+            self.store.finish(job.key, self.owner, state, job.encode_seconds, error)
+            rendition_cache.invalidate()  # process อื่นเห็นผ่าน states_version() ภายใน ~1 วินาที
+            transcode_jobs_total.inc(1, state)
+            transcode_job_seconds.observe(time.monotonic() - t0)
+            progress_hub.publish(job.key)
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.HEARTBEAT_SECONDS)
+            with self._cv:
+                running = dict(self._running)
+            try:
+                for key in self.store.heartbeat(self.owner, list(running)):
+                    running[key].cancel()
+            except sqlite3.Error as e:
+                print(f"[QUEUE] heartbeat error: {e}")
+
+    def describe(self, key):
+        """ข้อมูลคิวของ key สำหรับ /api/status -> dict หรือ None"""
+        row = self.store.get(key)
+        if row is None:
+            return None
+        info = {
+            'state': row['state'],
+            'priority': row['priority'],
+            'position': None,
+            'eta_seconds': None,
+            'created': int(row['created']),
+            'started': int(row['started']) if row['started'] else None,
+            'finished': int(row['finished']) if row['finished'] else None,
+            'error': row['error'],
+            'progress': json.loads(row['progress']) if row['progress'] else None,
+        }
+        if row['state'] not in ('queued', 'processing'):
+            return info
+
+        per_sec, avg_job = self.store.speed()
+
+        def estimate(r):
+            if r['duration'] and per_sec is not None:
+                return r['duration'] * per_sec
+            return avg_job
+
+        now = time.time()
+        if row['state'] == 'processing':
+            progress = info['progress'] or {}
+            if progress.get('stage') == 'encode' and progress.get('speed') and row['duration']:
+                # ใช้ความเร็วจริงของ ffmpeg ตอนนี้ (ไม่รวมขั้น HLS ซึ่งเป็นแค่ remux)
+                left = max(0.0, row['duration'] - progress.get('out_time', 0))
+                info['eta_seconds'] = int(left / progress['speed'])
+                return info
+            est = estimate(row)
+            if est is not None:
+                info['eta_seconds'] = max(0, int(est - (now - row['started'])))
+            return info
+
+        ahead = self.store.queue_ahead(row)
+        info['position'] = len(ahead) + 1
+        # งานที่กำลังรันเหลืออีกเท่าไร + งานที่อยู่ข้างหน้า แบ่งตามจำนวน worker
+        backlog = 0.0
+        for r in self.store.running():
+            est = estimate(r)
+            if est is not None:
+                backlog += max(0.0, est - (now - (r['started'] or now)))
+        for r in ahead + [row]:
+            est = estimate(r)
+            if est is None:
+                return info
+            backlog += est
+        info['eta_seconds'] = int(backlog / self.workers)
+        return info
+
+    def summary(self):
+        per_sec, avg_job = self.store.speed()
+        return {
+            'workers': self.workers,
+            'max_queued': self.max_queued,
+            'jobs': self.store.counts(),
+            'running_here': sorted(self._running),
+            'secs_per_media_sec': per_sec,
+            'avg_job_seconds': avg_job,
+        }
+
+# ==============================
+# VIDEO PROCESSOR
+# ==============================
+class VideoProcessor:
+    def __init__(self, video_folder, processed_folder):
+        self.video_folder = Path(video_folder)
+        self.processed_folder = Path(processed_folder)
+        self.ffmpeg_path = 'ffmpeg'  # ต้องอยู่ใน PATH
+        self.metadata = MetadataCache(
+            app.config['METADATA_DB'], self.get_video_info,
+            max_concurrent_probes=app.config['FFPROBE_MAX_CONCURRENCY'],
+        )
+        workers = app.config['TRANSCODE_WORKERS']
+        # แบ่ง core ให้แต่ละงานเท่าๆ กัน ไม่ให้ encode พร้อมกันแย่ง CPU กันเอง
+        self.encode_threads = max(1, (os.cpu_count() or 1) // workers)
+        # สถานะงาน: queued | processing | completed | error | cancelled (ไม่มีแถว = not_started)
+        self.queue = TranscodeQueue(
+            self._run_job, JobStore(app.config['JOBS_DB'], stale_seconds=app.config['JOB_STALE_SECONDS']),
+            workers=workers, max_queued=app.config['TRANSCODE_QUEUE_LIMIT'],
+        )
+        progress_hub.store = self.queue.store
+
+    def get_video_info(self, video_path: Path):
+        """ดึงข้อมูลวิดีโอด้วย ffprobe"""
+        started = time.perf_counter()
+        try:
+            cmd = [
+                'ffprobe', '-v', 'quiet', '-print_format', 'json',
+                '-show_format', '-show_streams', str(video_path)
+            ]
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+            ffprobe_seconds.observe(time.perf_counter() - started)
+            ffprobe_calls_total.inc(1, 'ok' if result.returncode == 0 else 'error')
+            if result.returncode == 0:
+                info = json.loads(result.stdout)
+                video_stream = next((s for s in info.get('streams', []) if s.get('codec_type') == 'video'), None)
+                audio_stream = next((s for s in info.get('streams', []) if s.get('codec_type') == 'audio'), None)
+                fmt = info.get('format', {})
+                return {
+                    'duration': float(fmt.get('duration', 0) or 0),
+                    'size': int(fmt.get('size', 0) or 0),
+                    'width': int(video_stream.get('width', 0) if video_stream else 0),
+                    'height': int(video_stream.get('height', 0) if video_stream else 0),
+                    'bitrate': int(fmt.get('bit_rate', 0) or 0),
+                    'video_bitrate': int(video_stream.get('bit_rate', 0) or 0) if video_stream else 0,
+                    'video_codec': video_stream.get('codec_name') if video_stream else None,
+                    'profile': video_stream.get('profile') if video_stream else None,
+                    'pix_fmt': video_stream.get('pix_fmt') if video_stream else None,
+                    'audio_codec': audio_stream.get('codec_name') if audio_stream else None,
+                    'format_name': fmt.get('format_name'),
+                }
+        except Exception as e:
+            ffprobe_calls_total.inc(1, 'exception')
+            print(f"Error getting video info: {e}")
+        return None
+
+    def _find_input_file(self, video_id: str):
+        # โหมดเดิม: ชื่อไฟล์ไม่รวมสกุลใน root
+        for ext in VIDEO_EXTS:
+            f = self.video_folder / f"{video_id}{ext}"
+            if f.exists():
+                return f
+        return None
+
+    def enqueue(self, input_file: Path, video_key: str, make_hls=True, priority=0, force=False):
+        """ส่งงานเข้าคิว (key ซ้ำที่ยังไม่เสร็จ -> ได้งานเดิม) -> (job row, created)"""
+        duration = None
+        try:
+            info = self.metadata.get(input_file)
+            duration = info['duration'] if info else None
+        except OSError:
+            pass
+        return self.queue.submit(video_key, input_file, make_hls=make_hls, priority=priority,
+                                 duration=duration, force=force)
+
+    def _run_job(self, job: TranscodeJob):
+        return self.create_web_optimized_version_from_file(job.input_file, job.key, make_hls=job.make_hls, job=job)
+
+    def create_web_optimized_version_from_file(self, input_file: Path, video_key: str, make_hls=True, job=None):
+        """
+        ประมวลผลจากไฟล์ที่ระบุ (รองรับ relpath)
+        - ffmpeg เขียนลงชื่อชั่วคราวแล้วค่อย rename -> ไฟล์ใน mp4/ และ hls/ ครบสมบูรณ์เสมอ
+        - rendition ที่เสร็จแล้ว (ใหม่กว่าต้นฉบับ) ถูกข้าม เว้นแต่ job.force -> งานที่ค้างจาก crash ทำต่อได้
+        """
+        input_file = Path(input_file)
+        if not input_file.exists():
+            raise FileNotFoundError(str(input_file))
+
+        out_dir = self.processed_folder / video_key
+        mp4_dir = out_dir / 'mp4'
+        hls_dir = out_dir / 'hls'
+        mp4_dir.mkdir(parents=True, exist_ok=True)
+        if make_hls:
+            hls_dir.mkdir(parents=True, exist_ok=True)
+        self._clean_partials(out_dir)
+
+        force = job.force if job is not None else False
+        src_mtime = input_file.stat().st_mtime
+
+        def done(path: Path, newer_than: float) -> bool:
+            return not force and path.exists() and path.stat().st_mtime >= newer_than
+
+        try:
+            qualities = self._plan_ladder(input_file, self.metadata.get(input_file))
+            print(f"[LADDER] {video_key} - {', '.join(q['name'] for q in qualities)}")
+            self._write_manifest(out_dir, qualities)
+            names = {q['name'] for q in qualities if not (q['copy'] and not q['remux'])}
+            for old in mp4_dir.glob('*.mp4'):
+                if old.stem not in names:  # rung ที่ ladder ใหม่ไม่มีแล้ว (เช่น upscale จากรอบก่อน)
+                    old.unlink()
+                    shutil.rmtree(hls_dir / old.stem, ignore_errors=True)
+
+            # 1) remux ต้นฉบับที่ใช้ได้แล้วเป็น mp4/source.mp4 (faststart) ก่อน -> ไม่กี่วินาทีก็เล่น/seek ได้
+            #    ไม่ต้องรอ encode ทั้ง ladder
+            source = next((q for q in qualities if q['copy']), None)
+            if source and source['remux'] and not done(mp4_dir / 'source.mp4', src_mtime):
+                print(f"[REMUX] {video_key}")
+                if not self._remux(input_file, mp4_dir / 'source.mp4', self.metadata.get(input_file), job):
+                    raise RuntimeError('remux failed')
+
+            # 2) MP4 ทุกความละเอียดใน ffmpeg ครั้งเดียว: decode ครั้งเดียวแล้ว split ไปแต่ละ rendition
+            #    บังคับ keyframe ทุก HLS_PART_SECONDS เพื่อให้ตัด HLS จาก MP4 ได้โดยไม่ encode ซ้ำ
+            todo = [q for q in qualities
+                    if not q['copy'] and not done(mp4_dir / f"{q['name']}.mp4", src_mtime)]
+            if todo:
+                cmd = self._build_ladder_cmd(input_file, mp4_dir, todo)
+                print(f"[MP4] {video_key} - {', '.join(q['name'] for q in todo)}")
+                if not self._run_ffmpeg(cmd, f"MP4 {video_key}", job, stage='encode',
+                                        renditions=[q['name'] for q in todo]):
+                    raise RuntimeError('ladder encode failed')
+                for q in todo:
+                    os.replace(mp4_dir / f"{q['name']}.mp4.tmp", mp4_dir / f"{q['name']}.mp4")
+            else:
+                print(f"[MP4] {video_key} - all renditions up to date")
+
+            # 3) poster + sprite sheet + WebVTT: decode rendition ที่เล็กที่สุด (ไม่มี rung ที่ encode -> ต้นฉบับ)
+            #    ไม่สำเร็จก็ไม่ทำให้งานล้ม (เล่นได้ แค่ไม่มีภาพตัวอย่าง)
+            thumbs_dir = out_dir / 'thumbs'
+            if app.config['THUMBNAILS'] and not done(thumbs_dir / 'thumbs.vtt', src_mtime):
+                encoded = [q for q in qualities if not q['copy']]
+                small = min(encoded or qualities, key=lambda q: q['height'])
+                thumb_src = mp4_dir / f"{small['name']}.mp4" if encoded else input_file
+                duration = (self.metadata.get(input_file) or {}).get('duration')
+                print(f"[THUMBS] {video_key}")
+                if not self._make_thumbnails(thumb_src, duration, small['width'], small['height'], thumbs_dir, job):
+                    print(f"[WARN] thumbnails failed: {video_key}")
+
+            # 4) HLS (optional): แบ่ง segment จาก MP4 ที่ encode แล้วด้วย -c copy
+            if make_hls:
+                variants = []
+                for q in qualities:
+                    mp4_file = mp4_dir / f"{q['name']}.mp4"
+                    if q['copy'] and not q['remux']:
+                        mp4_file = input_file  # ต้นฉบับใช้ได้เลย ไม่มี source.mp4
+                    v_dir = hls_dir / q['name']
+                    layout_ok = (v_dir / 'media.mp4').exists() == self._single_file_hls()  # เปลี่ยน HLS_SINGLE_FILE -> แพ็กใหม่
+                    if not (mp4_file.exists() and layout_ok and done(v_dir / 'index.m3u8', mp4_file.stat().st_mtime)):
+                        # rung ที่ stream copy (source) ไม่มี keyframe ทุก HLS_PART_SECONDS -> encode เฉพาะสำเนา HLS
+                        print(f"[HLS] {video_key} - {q['name']}{' (encode)' if q['copy'] else ''}")
+                        if not self._package_hls(mp4_file, v_dir, job, encode=q if q['copy'] else None):
+                            continue
+                    bw = _rung_bandwidth(q)
+                    variants.append({
+                        'name': q['name'],
+                        'bandwidth': bw,
+                        'playlist': f"{q['name']}/index.m3u8",
+                        'resolution': f"{q['width']}x{q['height']}"
+                    })
+
+                if variants:
+                    variants.sort(key=lambda v: v['bandwidth'])
+                    version = 7 if HLS_SEGMENT_TYPE == 'fmp4' else 3
+                    master_tmp = hls_dir / 'master.m3u8.tmp'
+                    with open(master_tmp, 'w', encoding='utf-8') as m:
+                        m.write(f"#EXTM3U\n#EXT-X-VERSION:{version}\n#EXT-X-INDEPENDENT-SEGMENTS\n")
+                        for v in variants:
+                            m.write(f"#EXT-X-STREAM-INF:BANDWIDTH={v['bandwidth']},RESOLUTION={v['resolution']}\n")
+                            m.write(f"{v['playlist']}\n")
+                    os.replace(master_tmp, hls_dir / 'master.m3u8')
+
+            print(f"[OK] processed: {video_key}")
+            return True
+
+        except JobCancelled:
+            print(f"[CANCEL] processing {video_key}")
+            raise
+
+        except Exception as e:
+            print(f"[ERR] processing {video_key}: {e}")
+            return False
+
+    def _ladder_for(self, input_file: Path):
+        """ladder ตั้งต้นของไฟล์: RENDITION_LADDERS ของโฟลเดอร์ที่ตรงที่สุด หรือ RENDITION_LADDER"""
+        try:
+            rel_dir = input_file.resolve().parent.relative_to(self.video_folder.resolve()).as_posix()
+        except ValueError:
+            rel_dir = ''
+        rel_dir = '' if rel_dir == '.' else rel_dir
+        best, rungs = -1, RENDITION_LADDER
+        for folder, ladder in app.config['RENDITION_LADDERS'].items():
+            folder = folder.strip('/').replace('\\', '/')
+            if (folder == '' or rel_dir == folder or rel_dir.startswith(folder + '/')) and len(folder) > best:
+                best, rungs = len(folder), ladder
+        by_name = {r['name']: r for r in RENDITION_LADDER}
+        return [dict(by_name[r]) if isinstance(r, str) else dict(r) for r in rungs]
+
+    @staticmethod
+    def _web_compatible(info) -> bool:
+        """วิดีโอของต้นฉบับเบราว์เซอร์เล่นได้โดยตรงหรือไม่ (H.264 8-bit 4:2:0) ไม่สนใจ container/เสียง"""
+        return bool(
+            info
+            and info.get('video_codec') == 'h264'
+            and info.get('pix_fmt') in ('yuv420p', 'yuvj420p')
+        )
+
+    @staticmethod
+    def _needs_remux(input_file: Path, info) -> bool:
+        """ต้นฉบับที่วิดีโอใช้ได้แล้วต้อง remux ไหม (container ไม่ใช่ MP4, moov อยู่ท้ายไฟล์ หรือเสียงไม่ใช่ AAC)"""
+        return not (
+            'mp4' in (info.get('format_name') or '').split(',')
+            and info.get('audio_codec') in ('aac', None)
+            and _mp4_faststart(input_file) is True
+        )
+
+    def _plan_ladder(self, input_file: Path, info, allow_copy=True):
+        """
+        rendition ที่จะทำจริงจากผล probe ของต้นฉบับ
+        - ตัด rung ที่สูงกว่าต้นฉบับ หรือบิตเรตสูงกว่าต้นฉบับ (upscale เปลืองเวลา/พื้นที่/bandwidth เปล่าๆ)
+          rung แรกที่บิตเรตเกินต้นฉบับถูกลดบิตเรตลงเท่าต้นฉบับแทน (ถ้าไม่มี 'source')
+        - ต้นฉบับเล็กกว่าทุก rung -> เหลือ rung เล็กสุด ที่ความสูงต้นฉบับ บิตเรตไม่เกินต้นฉบับ
+        - ต้นฉบับเล่นบนเว็บได้อยู่แล้ว -> เพิ่ม 'source' (stream copy) แทน rung ที่ความสูงเท่ากัน
+          remux=False = ต้นฉบับเป็น MP4 faststart อยู่แล้ว ใช้ไฟล์เดิมได้เลย
+        -> [{name, width, height, video_bitrate, audio_bitrate, copy[, remux]}] เรียงจากเล็กไปใหญ่
+        """
+        rungs = sorted(self._ladder_for(input_file), key=lambda r: r['height'])
+        src_w = (info or {}).get('width') or 0
+        src_h = (info or {}).get('height') or 0
+        if not src_w or not src_h:
+            # probe ไม่ได้ -> ladder เต็มแบบ 16:9 เหมือนเดิม
+            for r in rungs:
+                r.update(width=_even(r['height'] * 16 / 9), copy=False)
+            return rungs
+
+        src_kbps = ((info.get('video_bitrate') or info.get('bitrate') or 0) + 999) // 1000
+        copy = allow_copy and app.config['SOURCE_COPY_RENDITION'] and self._web_compatible(info)
+
+        plan = []
+        for r in rungs:
+            if r['height'] > src_h or (copy and r['height'] >= src_h):
+                break  # สูงกว่าต้นฉบับ หรือซ้ำกับ 'source'
+            if src_kbps and _kbps(r['video_bitrate']) > src_kbps:
+                # rung แรกที่ต้นฉบับมีบิตเรตไม่พอ: ใช้ได้แค่บิตเรตต้นฉบับ แล้วจบ ladder ตรงนี้
+                if not copy:
+                    plan.append(dict(r, video_bitrate=f"{src_kbps}k"))
+                break
+            plan.append(r)
+        if not plan and not copy and rungs:
+            # ต้นฉบับเล็กกว่าทุก rung -> rung เดียวที่ความสูงต้นฉบับ
+            h = min(rungs[0]['height'], _even(src_h))
+            r = dict(rungs[0], height=h, name=rungs[0]['name'] if h == rungs[0]['height'] else f"{h}p")
+            if src_kbps:
+                r['video_bitrate'] = f"{min(_kbps(r['video_bitrate']), src_kbps)}k"
+            plan.append(r)
+        for r in plan:
+            r.update(width=_even(src_w * r['height'] / src_h), copy=False)
+        if copy:
+            plan.append({
+                'name': 'source', 'width': src_w, 'height': src_h, 'copy': True,
+                'remux': self._needs_remux(input_file, info),
+                'video_bitrate': f"{src_kbps}k",
+                'audio_bitrate': rungs[-1]['audio_bitrate'] if info.get('audio_codec') else '0k',
+            })
+        return plan
+
+    def _write_manifest(self, out_dir: Path, qualities):
+        """manifest.json = rendition ที่ไฟล์นี้มี (ใช้ตอนเลือก quality / แสดงสถานะ)"""
+        manifest = {
+            'renditions': [
+                {k: q[k] for k in ('name', 'width', 'height', 'video_bitrate', 'audio_bitrate', 'copy', 'remux') if k in q}
+                for q in qualities
+            ],
+            'encode_profile': app.config['ENCODE_PROFILE'],
+        }
+        tmp = out_dir / 'manifest.json.tmp'
+        tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding='utf-8')
+        os.replace(tmp, out_dir / 'manifest.json')
+
+    def _clean_partials(self, out_dir: Path):
+        """ลบไฟล์ชั่วคราวที่ค้างจากงานที่ถูก kill / crash"""
+        for tmp in (out_dir / 'mp4').glob('*.tmp'):
+            tmp.unlink()
+        hls_dir = out_dir / 'hls'
+        if hls_dir.exists():
+            for tmp in hls_dir.glob('.*.tmp'):
+                shutil.rmtree(tmp, ignore_errors=True)
+            (hls_dir / 'master.m3u8.tmp').unlink(missing_ok=True)
+        shutil.rmtree(out_dir / '.thumbs.tmp', ignore_errors=True)
+        (out_dir / 'manifest.json.tmp').unlink(missing_ok=True)
+
+    def _run_ffmpeg(self, cmd, label: str, job=None, stage=None, renditions=()) -> bool:
+        """
+        รัน ffmpeg พร้อมอ่าน -progress ทีละบรรทัด (ไม่เก็บ output ทั้งหมดในหน่วยความจำ)
+        stderr เก็บแค่บรรทัดท้ายๆ ไว้แสดงตอน error
+        """
+        if job is not None and job.cancel_event.is_set():
+            raise JobCancelled(job.key)
+        cmd = [cmd[0], '-nostats', '-progress', 'pipe:1'] + list(cmd[1:])
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+        if job is not None:
+            job.process = p
+            if job.cancel_event.is_set():  # ถูกยกเลิกระหว่างเริ่ม process
+                p.kill()
+
+        stderr_tail = collections.deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+        drain = threading.Thread(target=stderr_tail.extend, args=(p.stderr,), daemon=True)
+        drain.start()
+
+        t0 = time.monotonic()
+        block = {}
+        for line in p.stdout:
+            k, sep, v = line.strip().partition('=')
+            if not sep:
+                continue
+            block[k] = v
+            if k == 'progress':
+                if job is not None:
+                    self._report_progress(job, stage or label, renditions, block)
+                block = {}
+        p.wait()
+        drain.join()
+        elapsed = time.monotonic() - t0
+        ffmpeg_seconds.observe(elapsed, stage or 'other')
+        if job is not None:
+            job.encode_seconds += elapsed
+        if job is not None and job.cancel_event.is_set():
+            raise JobCancelled(job.key)
+        if p.returncode != 0:
+            ffmpeg_failures_total.inc(1, stage or 'other')
+            print(f"FFmpeg error {label}: {''.join(stderr_tail)}")
+            return False
+        return True
+
+    def _report_progress(self, job, stage, renditions, block):
+        """แปลงบล็อก key=value ของ ffmpeg -progress เป็น % / fps / speed แล้วแจ้ง progress_hub"""
+        done = block.get('progress') == 'end'
+        try:
+            out_time = int(block.get('out_time_us') or block.get('out_time_ms') or 0) / 1e6
+        except ValueError:  # 'N/A' ช่วงท้าย encode -> ข้ามบล็อกนี้ ไม่ให้ % ถอยกลับเป็น 0
+            if not done:
+                return
+            out_time = job.duration or 0.0
+        try:
+            fps = float(block.get('fps') or 0)
+        except ValueError:
+            fps = 0.0
+        speed = block.get('speed', '').strip().rstrip('x')
+        try:
+            speed = float(speed)
+        except ValueError:
+            speed = None
+        percent = None
+        if done:
+            percent = 100.0
+        elif job.duration:
+            percent = round(min(100.0, max(0.0, out_time / job.duration * 100)), 1)
+        progress_hub.publish(job.key, {
+            'stage': stage,
+            'renditions': {r: percent for r in renditions},
+            'percent': percent,
+            'out_time': round(out_time, 2),
+            'fps': fps,
+            'speed': speed,
+        })
+
+    def _encode_profile(self, profile=None):
+        """โปรไฟล์ encode: dict ที่ส่งมา / ชื่อใน ENCODE_PROFILES / app.config['ENCODE_PROFILE']"""
+        if isinstance(profile, dict):
+            return {**ENCODE_PROFILES['balanced'], **profile}
+        name = profile or app.config['ENCODE_PROFILE']
+        if name not in ENCODE_PROFILES:
+            print(f"[WARN] unknown ENCODE_PROFILE {name!r}, using 'balanced'")
+            name = 'balanced'
+        return ENCODE_PROFILES[name]
+
+    @staticmethod
+    def _rate_control_args(profile, video_bitrate: str):
+        """argument rate control ของ libx264 ตามโปรไฟล์ (ไม่ใส่ -crf คู่กับ -b:v ซึ่งขัดกันเอง)"""
+        vbv = ['-maxrate', video_bitrate, '-bufsize', f"{_kbps(video_bitrate) * 2}k"]
+        mode = profile['rate_control']
+        if mode == 'abr':
+            return ['-b:v', video_bitrate] + vbv
+        if mode == 'crf':
+            return ['-crf', str(profile['crf'])]
+        return ['-crf', str(profile['crf'])] + vbv  # capped_crf
+
+    def _encode_args(self, profile, q):
+        """codec ของ rung หนึ่ง: libx264 ตามโปรไฟล์ + keyframe ทุก HLS_PART_SECONDS (ทุก rendition ตรงกัน) + AAC"""
+        return [
+            '-c:v', 'libx264', '-preset', profile['preset'],
+            *self._rate_control_args(profile, _rung_video_bitrate(q)),
+            '-force_key_frames', f'expr:gte(t,n_forced*{HLS_PART_SECONDS})',
+            '-c:a', 'aac', '-b:a', q['audio_bitrate'],
+        ]
+
+    def _build_ladder_cmd(self, input_file: Path, mp4_dir: Path, qualities, profile=None):
+        """คำสั่ง ffmpeg เดียวที่ decode ครั้งเดียวแล้ว encode ทุก rendition ด้วย filter_complex split"""
+        profile = self._encode_profile(profile)
+        n = len(qualities)
+        # scale=-2:H รักษา aspect ratio ของต้นฉบับ (ความกว้างปัดเป็นเลขคู่)
+        graph = [f"[0:v]split={n}" + ''.join(f"[s{i}]" for i in range(n))]
+        for i, q in enumerate(qualities):
+            graph.append(f"[s{i}]scale=-2:{q['height']}[v{i}]")
+
+        cmd = [self.ffmpeg_path, '-y', '-i', str(input_file), '-filter_complex', ';'.join(graph),
+               '-threads', str(profile['threads'] or self.encode_threads)]
+        for i, q in enumerate(qualities):
+            cmd += [
+                '-map', f'[v{i}]', '-map', '0:a:0?',
+                *self._encode_args(profile, q),
+                '-movflags', '+faststart',
+                '-f', 'mp4', str(mp4_dir / f"{q['name']}.mp4.tmp"),
+            ]
+        return cmd
+
+    def _remux(self, input_file: Path, out_file: Path, info, job=None) -> bool:
+        """
+        ห่อ stream เดิมใหม่เป็น MP4 faststart ด้วย -c copy (ย้าย moov ไว้หน้าไฟล์ / MKV -> MP4)
+        เสียงที่ไม่ใช่ AAC ถูกแปลงเฉพาะเสียง (เร็วกว่า encode วิดีโอมาก)
+        """
+        tmp = out_file.with_name(out_file.name + '.tmp')
+        audio = ['-c:a', 'copy'] if (info or {}).get('audio_codec') in ('aac', None) else ['-c:a', 'aac', '-b:a', '192k']
+        cmd = [
+            self.ffmpeg_path, '-y', '-i', str(input_file),
+            '-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy', *audio,
+            '-movflags', '+faststart',
+            '-f', 'mp4', str(tmp),
+        ]
+        if not self._run_ffmpeg(cmd, f"REMUX {input_file.name}", job, stage='remux', renditions=['source']):
+            tmp.unlink(missing_ok=True)
+            return False
+        os.replace(tmp, out_file)
+        return True
+
+    @staticmethod
+    def _single_file_hls() -> bool:
+        return HLS_SINGLE_FILE and HLS_SEGMENT_TYPE == 'fmp4'
+
+    def _package_hls(self, mp4_file: Path, v_dir: Path, job=None, encode=None) -> bool:
+        """
+        ตัด MP4 ที่ encode แล้วเป็น HLS (fMP4/CMAF หรือ MPEG-TS ตาม HLS_SEGMENT_TYPE) โดยไม่ encode ใหม่
+        - HLS_SINGLE_FILE: ffmpeg ตัดทุก keyframe (HLS_PART_SECONDS) ลง media.mp4 ไฟล์เดียว
+          แล้ว _merge_byterange_playlist รวมเป็น segment ยาว HLS_SEGMENT_SECONDS (ยกเว้นช่วงเริ่มเล่น)
+        - encode = rung ของ ladder: encode ระหว่างตัด (rung 'source' ที่เป็น stream copy ไม่มี keyframe
+          ทุก HLS_PART_SECONDS -> ตัด segment ตามความยาวที่ตั้งไว้ / สลับ rendition ตรงกันไม่ได้)
+        เขียนลงโฟลเดอร์ชั่วคราวก่อนแล้วสลับเข้าที่เมื่อเสร็จ
+        """
+        if not mp4_file.exists():
+            return False
+        tmp_dir = v_dir.parent / f".{v_dir.name}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        single = self._single_file_hls()
+        if encode is not None:
+            profile = self._encode_profile()
+            codec = ['-map', '0:v:0', '-map', '0:a:0?', '-threads', str(profile['threads'] or self.encode_threads),
+                     *self._encode_args(profile, encode)]
+        else:
+            codec = ['-map', '0', '-c', 'copy']
+        cmd = [
+            self.ffmpeg_path, '-y',
+            '-i', str(mp4_file),
+            *codec,
+            '-f', 'hls',
+            '-hls_time', str(HLS_PART_SECONDS if single else HLS_SEGMENT_SECONDS),
+            '-hls_playlist_type', 'vod',
+            '-hls_flags', 'independent_segments+single_file' if single else 'independent_segments',
+        ]
+        if single:
+            cmd += ['-hls_segment_type', 'fmp4', '-hls_segment_filename', str(tmp_dir / 'media.mp4')]
+        elif HLS_SEGMENT_TYPE == 'fmp4':
+            cmd += ['-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', 'init.mp4',
+                    '-hls_segment_filename', str(tmp_dir / 'seg_%05d.m4s')]
+        else:
+            cmd += ['-hls_segment_filename', str(tmp_dir / 'seg_%05d.ts')]
+        cmd.append(str(tmp_dir / 'index.m3u8'))
+        try:
+            if not self._run_ffmpeg(cmd, f"HLS {v_dir.name}", job, stage='hls', renditions=[v_dir.name]):
+                return False
+            if single:
+                playlist = tmp_dir / 'index.m3u8'
+                playlist.write_text(_merge_byterange_playlist(
+                    playlist.read_text(encoding='utf-8'), HLS_SEGMENT_SECONDS, HLS_STARTUP_PARTS), encoding='utf-8')
+            shutil.rmtree(v_dir, ignore_errors=True)
+            os.replace(tmp_dir, v_dir)
+            return True
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _make_thumbnails(self, input_file: Path, duration, width, height, thumbs_dir: Path, job=None) -> bool:
+        """
+        poster.jpg + sprite_NNN.jpg + thumbs.vtt จาก ffmpeg ครั้งเดียว (decode ครั้งเดียวแล้ว split)
+        - sprite: 1 ภาพทุก THUMB_INTERVAL_SECONDS ขนาด THUMB_WIDTH เรียงเป็นตาราง THUMB_GRID
+        - thumbs.vtt: cue ละช่วงเวลา ชี้ไปที่ช่องใน sprite (#xywh=) ตามมาตรฐานที่ player ทั่วไปใช้
+        เขียนลงโฟลเดอร์ชั่วคราวก่อนแล้วสลับเข้าที่เมื่อเสร็จ
+        """
+        if not input_file.exists() or not duration or not width or not height:
+            return False
+        tw = THUMB_WIDTH
+        th = _even(tw * height / width)
+        cols, rows = THUMB_GRID
+        poster_at = min(POSTER_AT_SECONDS, duration * 0.1)
+        tmp_dir = thumbs_dir.parent / '.thumbs.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        graph = (f"[0:v]split=2[a][b];"
+                 f"[a]fps=1/{THUMB_INTERVAL_SECONDS}:round=up,scale={tw}:{th},tile={cols}x{rows}[s];"
+                 f"[b]trim=start={poster_at:.3f}[p]")
+        cmd = [
+            self.ffmpeg_path, '-y', '-i', str(input_file), '-filter_complex', graph,
+            '-map', '[s]', '-q:v', '5', '-start_number', '0', '-f', 'image2', str(tmp_dir / 'sprite_%03d.jpg'),
+            '-map', '[p]', '-frames:v', '1', '-q:v', '3', '-update', '1', str(tmp_dir / 'poster.jpg'),
+        ]
+        try:
+            if not self._run_ffmpeg(cmd, f"THUMBS {input_file.name}", job, stage='thumbs', renditions=['thumbs']):
+                return False
+            sheets = len(list(tmp_dir.glob('sprite_*.jpg')))
+            per_sheet = cols * rows
+            stamp = int(time.time())  # ใส่ใน URL ของ sprite -> ประมวลผลใหม่แล้ว cache เดิมไม่ถูกใช้
+            lines = ['WEBVTT', '']
+            i = 0
+            while i * THUMB_INTERVAL_SECONDS < duration and i // per_sheet < sheets:
+                start = i * THUMB_INTERVAL_SECONDS
+                sheet, cell = divmod(i, per_sheet)
+                x, y = cell % cols * tw, cell // cols * th
+                lines += [f"{_vtt_time(start)} --> {_vtt_time(min(duration, start + THUMB_INTERVAL_SECONDS))}",
+                          f"sprite_{sheet:03d}.jpg?v={stamp}#xywh={x},{y},{tw},{th}", '']
+                i += 1
+            (tmp_dir / 'thumbs.vtt').write_text('\n'.join(lines), encoding='utf-8')
+            shutil.rmtree(thumbs_dir, ignore_errors=True)
+            os.replace(tmp_dir, thumbs_dir)
+            return True
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def encode_segment(self, input_file: Path, info, rung, index: int, out_file: Path) -> bool:
+        """
+        JIT HLS: encode เฉพาะช่วง [index * HLS_SEGMENT_SECONDS, +HLS_SEGMENT_SECONDS) เป็น MPEG-TS
+        -ss ก่อน -i = seek เร็วแล้ว decode ทิ้งถึงเวลาที่ต้องการ (ตรงเฟรม เพราะ encode ใหม่)
+        -output_ts_offset ให้ timestamp ต่อกันระหว่าง segment ที่ encode แยกกัน
+        """
+        start = index * HLS_SEGMENT_SECONDS
+        length = min(HLS_SEGMENT_SECONDS, info['duration'] - start)
+        cmd = [
+            self.ffmpeg_path, '-y',
+            '-ss', f'{start:.3f}', '-i', str(input_file), '-t', f'{length:.3f}',
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-vf', f"scale=-2:{rung['height']}", '-pix_fmt', 'yuv420p',
+            '-c:v', 'libx264', '-preset', app.config['JIT_PRESET'],
+            '-b:v', rung['video_bitrate'],
+            '-maxrate', rung['video_bitrate'],
+            '-bufsize', f"{_kbps(rung['video_bitrate']) * 2}k",
+            '-c:a', 'aac', '-b:a', rung['audio_bitrate'], '-ac', '2',
+            '-output_ts_offset', f'{start:.3f}', '-muxdelay', '0', '-muxpreload', '0',
+            '-f', 'mpegts', str(out_file),
+        ]
+        return self._run_ffmpeg(cmd, f"JIT {input_file.name} {rung['name']} #{index}", stage='jit')
+
+    def create_web_optimized_version(self, video_id: str, priority=0):
+        """โหมดเก่า: หาไฟล์จาก root ด้วยชื่อ video_id (ไม่รองรับโฟลเดอร์ย่อย) แล้วส่งเข้าคิว"""
+        input_file = self._find_input_file(video_id)
+        if not input_file:
+            raise FileNotFoundError(f"ไม่พบไฟล์ {video_id}")
+        key = _safe_id_from_relpath(video_id)
+        return self.enqueue(input_file, key, priority=priority)
+
+    def get_processing_status(self, key: str):
+        return self.queue.state_of(key) or 'not_started'
+
+# ==============================
+# LIBRARY INDEX
+# ==============================
+class _DirState:
+    __slots__ = ('mtime_ns', 'subdirs', 'files')
+
+    def __init__(self, mtime_ns, subdirs, files):
+        self.mtime_ns = mtime_ns
+        self.subdirs = subdirs  # tuple ชื่อโฟลเดอร์ย่อย (เรียงแล้ว)
+        self.files = files      # { name: (size, mtime_ns, mtime) } เฉพาะไฟล์วิดีโอ
+
+class LibrarySnapshot:
+    """สถานะดัชนี ณ เวลาหนึ่ง (อ่านอย่างเดียว ใช้ร่วมกันได้หลาย request)"""
+    __slots__ = ('generation', 'files', 'dirs', 'sort_keys')
+
+    def __init__(self, generation, files, dirs, sort_keys):
+        self.generation = generation
+        self.files = files            # { relpath: entry }
+        self.dirs = dirs              # { rel_dir: (subdir relpaths, [(ชื่อตัวเล็ก, relpath), ...] เรียงแล้ว) }
+        self.sort_keys = sort_keys    # { field: [(ค่า, relpath), ...] เรียงจากน้อยไปมาก }
+
+class LibraryIndex:
+    """
+    ดัชนีไฟล์วิดีโอในหน่วยความจำ แทนการ rglob ทุก request
+    - สแกนทั้งหมดครั้งแรกครั้งเดียว จากนั้น thread เบื้องหลัง stat เฉพาะโฟลเดอร์ทุก rescan_seconds
+      แล้วสแกนใหม่เฉพาะโฟลเดอร์ที่ mtime เปลี่ยน (ใช้ได้กับ network share ที่ไม่มี inotify)
+    - ทุก full_rescan_seconds stat ไฟล์ทั้งหมดอีกรอบ (กรณีไฟล์ถูกเขียนทับโดย mtime โฟลเดอร์ไม่เปลี่ยน)
+    - ไฟล์ใหม่/เปลี่ยนถูก probe ใน thread แยก แล้วเผยแพร่ snapshot ใหม่
+    - request อ่าน snapshot ปัจจุบันเสมอ ไม่ต้องรอการสแกน
+    - snapshot เรียงไว้ล่วงหน้าตามทุก field ใน SORT_FIELDS -> แบ่งหน้าด้วย cursor ได้ในราคา O(page)
+    """
+    SORT_FIELDS = {
+        'created': lambda e: e['mtime'],
+        'size': lambda e: e['size'],
+        'duration': lambda e: e['info']['duration'] if e['info'] else -1.0,
+        'name': lambda e: e['name'].lower(),
+    }
+
+    def __init__(self, root, metadata, rescan_seconds=10, full_rescan_seconds=600, probe_workers=4):
+        self.root = Path(root)
+        self.metadata = metadata
+        self.rescan_seconds = rescan_seconds
+        self.full_rescan_seconds = full_rescan_seconds
+        self.probe_workers = max(1, int(probe_workers))
+        self._dirs = {}  # { rel_dir: _DirState } เขียนโดย thread สแกนเท่านั้น
+        self._snapshot = LibrarySnapshot(0, {}, {}, {f: [] for f in self.SORT_FIELDS})
+        self._publish_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._ready = threading.Event()
+        self._wake = threading.Event()
+        self._probe_queue = []
+        self._probing = 0
+        self._probe_cv = threading.Condition()
+        self._last_publish = 0.0
+        self._keys = None  # (generation, { key: relpath }) สำหรับ relpath_for_key
+
+    # ---------- public ----------
+    def snapshot(self) -> LibrarySnapshot:
+        self._ensure_started()
+        self._ready.wait()
+        return self._snapshot
+
+    def request_rescan(self):
+        self._ensure_started()
+        self._wake.set()
+
+    def relpath_for_key(self, key: str):
+        """key (safe_id_from_relpath) -> relpath ของไฟล์ใน snapshot ปัจจุบัน หรือ None"""
+        snap = self.snapshot()
+        keys = self._keys
+        if keys is None or keys[0] != snap.generation:
+            keys = self._keys = (snap.generation, {_safe_id_from_relpath(r): r for r in snap.files})
+        return keys[1].get(key)
+
+    # ---------- background ----------
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+            threading.Thread(target=self._scan_loop, name='library-scan', daemon=True).start()
+            for i in range(self.probe_workers):
+                threading.Thread(target=self._probe_loop, name=f'library-probe-{i}', daemon=True).start()
+
+    def _scan_loop(self):
+        last_full = time.monotonic()
+        while True:
+            full = time.monotonic() - last_full >= self.full_rescan_seconds
+            try:
+                self._rescan(full=full)
+            except Exception as e:
+                print(f"[INDEX] rescan error: {e}")
+            if full:
+                last_full = time.monotonic()
+            self._ready.set()
+            self._wake.wait(self.rescan_seconds)
+            self._wake.clear()
+
+    def _scan_dir(self, rel_dir: str, mtime_ns: int) -> _DirState:
+        abs_dir = self.root / rel_dir if rel_dir else self.root
+        subdirs, files = [], {}
+        with os.scandir(abs_dir) as it:
+            for e in it:
+                try:
+                    if e.is_dir():
+                        subdirs.append(e.name)
+                    elif e.is_file() and os.path.splitext(e.name)[1].lower() in VIDEO_EXTS:
+                        st = e.stat()
+                        files[e.name] = (st.st_size, st.st_mtime_ns, st.st_mtime)
+                except OSError:
+                    continue
+        subdirs.sort(key=str.lower)
+        return _DirState(mtime_ns, tuple(subdirs), files)
+
+    def _rescan(self, full=False):
+        old_dirs = self._dirs
+        new_dirs = {}
+        changed = False
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            abs_dir = self.root / rel if rel else self.root
+            try:
+                mtime_ns = os.stat(abs_dir).st_mtime_ns
+            except OSError:
+                continue  # ถูกลบไปแล้ว
+            state = old_dirs.get(rel)
+            if full or state is None or state.mtime_ns != mtime_ns:
+                try:
+                    fresh = self._scan_dir(rel, mtime_ns)
+                except OSError as e:
+                    print(f"[INDEX] cannot scan {abs_dir}: {e}")
+                    continue
+                if state is None or fresh.subdirs != state.subdirs or fresh.files != state.files:
+                    changed = True
+                state = fresh
+            new_dirs[rel] = state
+            pending.extend(f"{rel}/{d}" if rel else d for d in state.subdirs)
+
+        if changed or new_dirs.keys() != old_dirs.keys():
+            self._dirs = new_dirs
+            self._publish()
+
+    def _publish(self):
+        with self._publish_lock:
+            dirs_state = self._dirs
+            files, dirs, missing = {}, {}, []
+            for rel_dir, state in dirs_state.items():
+                file_keys = []
+                for name in state.files:
+                    size, mtime_ns, mtime = state.files[name]
+                    relpath = f"{rel_dir}/{name}" if rel_dir else name
+                    hit, info = self.metadata.peek(self.root / relpath, size, mtime_ns)
+                    if not hit:
+                        missing.append(relpath)
+                    files[relpath] = {
+                        'relpath': relpath,
+                        'dir': rel_dir,
+                        'name': name,
+                        'size': size,
+                        'mtime': mtime,
+                        'mtime_ns': mtime_ns,
+                        'info': info,
+                    }
+                    file_keys.append((name.lower(), relpath))
+                file_keys.sort()
+                sub_rels = tuple(f"{rel_dir}/{d}" if rel_dir else d for d in state.subdirs)
+                dirs[rel_dir] = (sub_rels, file_keys)
+
+            sort_keys = {
+                field: sorted((fn(e), r) for r, e in files.items())
+                for field, fn in self.SORT_FIELDS.items()
+            }
+            self._snapshot = LibrarySnapshot(self._snapshot.generation + 1, files, dirs, sort_keys)
+            self._last_publish = time.monotonic()
+
+        if missing:
+            with self._probe_cv:
+                self._probe_queue = missing
+                self._probe_cv.notify_all()
+
+    def _probe_loop(self):
+        while True:
+            with self._probe_cv:
+                while not self._probe_queue:
+                    self._probe_cv.wait()
+                relpath = self._probe_queue.pop()
+                self._probing += 1
+            try:
+                if relpath in self._snapshot.files:
+                    self.metadata.get(self.root / relpath)
+            except OSError:
+                self._wake.set()  # ไฟล์หายไประหว่างรอ -> ให้ thread สแกนจัดการ
+            finally:
+                with self._probe_cv:
+                    self._probing -= 1
+                    done = not self._probe_queue and self._probing == 0
+            # เผยแพร่ duration ใหม่เป็นระยะ และเมื่อ probe ชุดนี้เสร็จหมด
+            if done or time.monotonic() - self._last_publish >= 5:
+                self._publish()
+
+video_processor = VideoProcessor(app.config['VIDEO_FOLDER'], app.config['PROCESSED_FOLDER'])
+library = LibraryIndex(
+    app.config['VIDEO_FOLDER'], video_processor.metadata,
+    rescan_seconds=app.config['LIBRARY_RESCAN_SECONDS'],
+    full_rescan_seconds=app.config['LIBRARY_FULL_RESCAN_SECONDS'],
+    probe_workers=app.config['FFPROBE_MAX_CONCURRENCY'],
+)
+
+# ==============================
+# JUST-IN-TIME HLS
+# ==============================
+class SegmentCache:
+    """
+    cache ไฟล์ segment บนดิสก์ จำกัดขนาดรวม max_bytes (ลบอันที่ไม่ได้ใช้นานที่สุดก่อน)
+    - segment เดียวกันถูกขอพร้อมกันหลาย request -> สร้างครั้งเดียว (SingleFlight)
+    - ลำดับการใช้งานเก็บในหน่วยความจำ + mtime ของไฟล์ (เริ่ม process ใหม่ก็ยังเรียงได้)
+    - หลาย process ใช้โฟลเดอร์เดียวกันได้ แต่ละ process นับขนาดเอง (อาจเกิน max_bytes ได้บ้าง)
+    """
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # { rel: size } เก่าสุดอยู่หน้า
+        self._total = 0
+        self._loaded = False
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        found = []
+        if self.root.exists():
+            for p in self.root.rglob('*'):
+                try:
+                    if not p.is_file():
+                        continue
+                    if p.name.endswith('.tmp'):
+                        p.unlink()  # ค้างจาก process ที่ตายกลางคัน
+                        continue
+                    st = p.stat()
+                except OSError:
+                    continue
+                found.append((st.st_mtime, p.relative_to(self.root).as_posix(), st.st_size))
+        found.sort()
+        for _, rel, size in found:
+            self._entries[rel] = size
+            self._total += size
+        self._loaded = True
+        print(f"[JIT] cache {len(found)} segments, {self._total / 1024**2:.0f} MB in {self.root}")
+
+    def get(self, rel: str, produce):
+        """path ของ segment rel ถ้ายังไม่มีเรียก produce(tmp_path) -> bool เพื่อสร้าง"""
+        path = self.root / rel
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            hit = rel in self._entries
+            if hit:
+                self._entries.move_to_end(rel)
+        if hit and path.exists():
+            self.hits += 1
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return path
+
+        def fill():
+            if path.exists():  # process อื่นสร้างไว้แล้ว
+                self._add(rel, path.stat().st_size)
+                return path
+            self.misses += 1
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            try:
+                if not produce(tmp):
+                    raise RuntimeError(f'cannot produce {rel}')
+                os.replace(tmp, path)
+            finally:
+                tmp.unlink(missing_ok=True)
+            self._add(rel, path.stat().st_size)
+            return path
+
+        return self._flight.do(rel, fill)
+
+    def _add(self, rel: str, size: int):
+        with self._lock:
+            self._total += size - self._entries.pop(rel, 0)
+            self._entries[rel] = size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old, old_size = next(iter(self._entries.items()))
+                if old == rel:
+                    break
+                try:
+                    (self.root / old).unlink(missing_ok=True)
+                except OSError:
+                    # ยังถูกเปิดอ่านอยู่ (Windows) -> ย้ายไปท้ายคิว ลองใหม่รอบหน้า
+                    self._entries.move_to_end(old)
+                    break
+                del self._entries[old]
+                self._total -= old_size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'segments': len(self._entries),
+                'bytes': self._total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+segment_cache = SegmentCache(app.config['JIT_CACHE_DIR'], app.config['JIT_CACHE_MAX_BYTES'])
+_jit_slots = threading.BoundedSemaphore(app.config['JIT_MAX_CONCURRENCY'])
+
+def _jit_source(key: str):
+    """key -> (ไฟล์ต้นฉบับ, stat, ผล probe, rung ที่ใช้ JIT) หรือ None ถ้าไม่พบ/probe ไม่ได้"""
+    relpath = library.relpath_for_key(key)
+    if relpath is None:
+        return None
+    input_file = Path(app.config['VIDEO_FOLDER']) / relpath
+    try:
+        st = input_file.stat()
+        info = video_processor.metadata.get(input_file, st)
+    except OSError:
+        return None
+    if not info or not info.get('duration') or not info.get('height'):
+        return None
+    rungs = video_processor._plan_ladder(input_file, info, allow_copy=False)
+    return input_file, st, info, rungs
+
+def _jit_master(rungs) -> str:
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-INDEPENDENT-SEGMENTS']
+    for r in rungs:
+        bw = _kbps(r['video_bitrate']) * 1000 + _kbps(r['audio_bitrate']) * 1000
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={bw},RESOLUTION={r['width']}x{r['height']}")
+        lines.append(f"jit/{r['name']}/index.m3u8")
+    return '\n'.join(lines) + '\n'
+
+def _jit_media_playlist(duration: float) -> str:
+    count = max(1, int(-(-duration // HLS_SEGMENT_SECONDS)))
+    lines = [
+        '#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{HLS_SEGMENT_SECONDS}',
+        '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD', '#EXT-X-INDEPENDENT-SEGMENTS',
+    ]
+    for i in range(count):
+        length = min(HLS_SEGMENT_SECONDS, duration - i * HLS_SEGMENT_SECONDS)
+        lines.append(f'#EXTINF:{length:.3f},')
+        lines.append(f'seg_{i:05d}.ts')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+def _serve_jit(video_key: str, subpath: str):
+    """master.m3u8, jit/<rendition>/index.m3u8, jit/<rendition>/seg_NNNNN.ts ของไฟล์ที่ยังไม่มี HLS"""
+    src = _jit_source(video_key)
+    if src is None:
+        return abort(404)
+    input_file, st, info, rungs = src
+
+    if subpath == 'master.m3u8':
+        return _playlist_response(_jit_master(rungs))
+    parts = subpath.split('/')
+    rung = next((r for r in rungs if len(parts) == 3 and parts[0] == 'jit' and r['name'] == parts[1]), None)
+    if rung is None:
+        return abort(404)
+    if parts[2] == 'index.m3u8':
+        return _playlist_response(_jit_media_playlist(info['duration']))
+
+    m = re.fullmatch(r'seg_(\d{5})\.ts', parts[2])
+    if not m or int(m.group(1)) * HLS_SEGMENT_SECONDS >= info['duration']:
+        return abort(404)
+    index = int(m.group(1))
+
+    def produce(tmp):
+        with _jit_slots:
+            return video_processor.encode_segment(input_file, info, rung, index, tmp)
+
+    # stamp ของต้นฉบับอยู่ใน path -> ไฟล์ถูกแก้ = segment ชุดใหม่ ชุดเก่าถูก LRU ลบเอง
+    rel = f"{video_key}/{st.st_size:x}-{st.st_mtime_ns:x}/{rung['name']}/{parts[2]}"
+    try:
+        path = segment_cache.get(rel, produce)
+    except Exception as e:
+        print(f"[JIT] {rel}: {e}")
+        return jsonify({'error': 'ไม่สามารถสร้าง segment ได้'}), 500
+    return send_hot_file(path, max_age=600)
+
+def _playlist_response(body: str):
+    resp = Response(body, mimetype='application/vnd.apple.mpegURL')
+    return _cache_headers(resp, 60)
+
+# ==============================
+# HLS STARTUP (preload / playlist ในหน้า / อุ่น cache)
+# ==============================
+_BYTERANGE_RE = re.compile(r'(\d+)(?:@(\d+))?')
+
+def _media_refs(text: str):
+    """
+    media playlist -> (init, [segment, ...]) โดยแต่ละตัวเป็น (uri, (offset, length) หรือ None = ทั้งไฟล์)
+    ไม่มี #EXT-X-MAP (MPEG-TS) -> init = None / #EXT-X-BYTERANGE ที่ไม่มี @offset = ต่อจากช่วงก่อนหน้า
+    """
+    init = None
+    refs = []
+    pending = None
+    next_offset = 0
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-MAP:'):
+            uri = re.search(r'URI="([^"]+)"', line)
+            rng = re.search(r'BYTERANGE="([^"]+)"', line)
+            if uri:
+                m = _BYTERANGE_RE.fullmatch(rng.group(1)) if rng else None
+                init = (uri.group(1), (int(m.group(2) or 0), int(m.group(1))) if m else None)
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            m = _BYTERANGE_RE.fullmatch(line[len('#EXT-X-BYTERANGE:'):].strip())
+            if m:
+                pending = (int(m.group(2)) if m.group(2) else next_offset, int(m.group(1)))
+                next_offset = pending[0] + pending[1]
+        elif line and not line.startswith('#'):
+            refs.append((line, pending))
+            pending = None
+    return init, refs
+
+def _playlist_text(path: Path):
+    entry = hot_cache.get(path, 600)
+    if entry is not None:
+        return entry.body.decode('utf-8', 'replace')
+    try:
+        return path.read_text(encoding='utf-8')
+    except OSError:
+        return None
+
+def _hls_startup(video_key: str):
+    """
+    สิ่งที่ player ต้องใช้ก่อนภาพแรกของ HLS แบบ offline -> dict หรือ None (ยังไม่มี HLS)
+    - inline: {URL path: playlist} ของ master และ rendition แรก (hls.js เริ่มที่ rendition แรกใน master)
+    - preload: init + segment แรกของ rendition แรกสำหรับ Link เฉพาะที่เป็นไฟล์แยก (HLS_SINGLE_FILE=0)
+      แบบ byte-range (HLS_SINGLE_FILE=1) = [] เสมอ: preload ระบุ Range ไม่ได้ และ media.mp4 ทั้งไฟล์ใหญ่เกินจะ preload
+    - warm: [(Path, byte สุดท้ายที่ต้องใช้ หรือ None = ทั้งไฟล์)] ของทุก rendition
+    """
+    master = _hls_file(video_key, 'master.m3u8')
+    text = _playlist_text(master) if master is not None else None
+    if text is None:
+        return None
+    base = f"/hls/{video_key}"
+    variants = [line for line in text.splitlines() if line and not line.startswith('#')]
+    startup = {'inline': {f"{base}/master.m3u8": text}, 'preload': [], 'warm': []}
+    for i, variant in enumerate(variants):
+        playlist = _hls_file(video_key, variant)
+        body = _playlist_text(playlist) if playlist is not None else None
+        if body is None:
+            continue
+        folder = variant.rpartition('/')[0]
+        init, segments = _media_refs(body)
+        head = ([init] if init else []) + segments[:HLS_STARTUP_PARTS]
+        ends = {}
+        for uri, rng in head:
+            path = _hls_file(video_key, f"{folder}/{uri}" if folder else uri)
+            if path is not None:
+                ends[path] = None if rng is None else max(ends.get(path) or 0, rng[0] + rng[1] - 1)
+        startup['warm'] += list(ends.items())
+        if i == 0:
+            startup['inline'][f"{base}/{variant}"] = body
+            startup['preload'] += [f"{base}/{folder}/{uri}" if folder else f"{base}/{uri}"
+                                   for uri, rng in head if rng is None]
+    return startup
+
+_warming = set()
+_warming_lock = threading.Lock()
+
+def _warm_hls(video_key: str, targets):
+    """อ่าน init + segment แรกๆ เข้า hot_cache (ไฟล์เล็ก) หรือ block_cache (ส่วนหัวของ media.mp4) ใน thread แยก"""
+    with _warming_lock:
+        if video_key in _warming:
+            return
+        _warming.add(video_key)
+
+    def run():
+        try:
+            for path, end in targets:
+                if hot_cache.get(path, 600) is not None:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                for _ in block_cache.iter_head(path, st, 0, st.st_size - 1 if end is None else end):
+                    pass
+        except Exception as e:
+            print(f"[WARN] warm hls {video_key}: {e}")
+        finally:
+            with _warming_lock:
+                _warming.discard(video_key)
+
+    threading.Thread(target=run, daemon=True, name=f"warm-{video_key}").start()
+
+# hls.js: ตอบ playlist ที่ฝังในหน้าแทนการโหลดผ่านเครือข่าย (ครั้งแรกเท่านั้น ครั้งถัดไปโหลดตามปกติ)
+_INLINE_PLAYLIST_LOADER = """
+                const inline = %s;
+                const Base = Hls.DefaultConfig.loader;
+                class InlineLoader extends Base {
+                    load(context, config, callbacks) {
+                        const key = new URL(context.url, location.href).pathname;
+                        const data = inline[key];
+                        if (data === undefined) return super.load(context, config, callbacks);
+                        delete inline[key];
+                        const st = this.stats, now = performance.now();
+                        st.loading.start = st.loading.first = st.loading.end = now;
+                        st.loaded = st.total = data.length;
+                        callbacks.onSuccess({url: context.url, data}, st, context, null);
+                    }
+                }
+                config.pLoader = InlineLoader;"""
+
+QUALITY_FALLBACK = ['720p', '480p', '1080p']
 
-    file_size = video_path.stat().st_size
-    range_header = request.headers.get('Range')
-    content_type = mimetypes.guess_type(str(video_path))[0] or 'application/octet-stream'
+def _manifest_renditions(key: str):
+    """renditions ใน manifest.json ของ key (ไม่มี/อ่านไม่ได้ -> [])"""
+    try:
+        manifest = json.loads((Path(app.config['PROCESSED_FOLDER']) / key / 'manifest.json').read_text(encoding='utf-8'))
+        return manifest.get('renditions', [])
+    except (OSError, ValueError):
+        return []
 
-    if not range_header:
-        # ส่งทั้งไฟล์ (200)
-        resp = make_response(_file_iter(video_path, 0, file_size - 1, chunk_size=CHUNK_SIZE))
-        resp.status_code = 200
-        resp.headers['Content-Length'] = str(file_size)
-        resp.headers['Content-Type'] = content_type
-        resp.headers['Accept-Ranges'] = 'bytes'
-        return _cache_headers(resp, 3600)
-
-    # Parse: bytes=start-end
-    m = re.match(r'bytes=(\d+)-(\d*)', range_header)
-    if not m:
-        resp = make_response('', 416)
-        resp.headers['Content-Range'] = f'bytes */{file_size}'
-        return resp
+def _original_rungs(manifest):
+    """ชื่อ rung ที่เป็นต้นฉบับเอง ('source' ที่ copy โดยไม่ต้อง remux -> ไม่มีไฟล์ใน mp4/)"""
+    return {r['name'] for r in manifest if r.get('copy') and not r.get('remux')}
 
-    start = int(m.group(1))
-    end = int(m.group(2)) if m.group(2) else file_size - 1
+def _renditions(key: str, manifest=None):
+    """
+    ชื่อ rendition MP4 ที่พร้อมเล่นของ key เรียงตาม manifest.json (ไม่มี manifest -> ตามชื่อไฟล์)
+    rung ที่เป็นต้นฉบับเอง (copy, ไม่ remux) พร้อมเสมอ -- ส่งไฟล์ต้นฉบับ
+    """
+    if manifest is None:
+        manifest = _manifest_renditions(key)
+    ready = {p.stem for p in (Path(app.config['PROCESSED_FOLDER']) / key / 'mp4').glob('*.mp4')}
+    ready |= _original_rungs(manifest)
+    order = [r['name'] for r in manifest]
+    return [n for n in order if n in ready] + sorted(ready - set(order))
 
-    if start >= file_size or end >= file_size or start > end:
-        resp = make_response('', 416)
-        resp.headers['Content-Range'] = f'bytes */{file_size}'
-        return resp
+def _rung_video_bitrate(rendition) -> str:
+    """บิตเรตวิดีโอของ rung -- ต้นฉบับที่ probe บิตเรตไม่ได้ ('0k') ใช้ของ RENDITION_LADDER ที่สูงใกล้สุด"""
+    if _kbps(rendition['video_bitrate']):
+        return rendition['video_bitrate']
+    height = rendition.get('height') or 0
+    return min(RENDITION_LADDER, key=lambda r: abs(r['height'] - height))['video_bitrate']
 
-    length = end - start + 1
-    resp = Response(
-        _file_iter(video_path, start, end, chunk_size=CHUNK_SIZE),
-        status=206,
-        headers={
-            'Content-Range': f'bytes {start}-{end}/{file_size}',
-            'Accept-Ranges': 'bytes',
-            'Content-Length': str(length),
-            'Content-Type': content_type
-        }
-    )
-    return _cache_headers(resp, 3600)
+def _rung_bandwidth(rendition) -> int:
+    """บิตเรตรวม (bit/วินาที) ของ rung ใน manifest"""
+    return (_kbps(_rung_video_bitrate(rendition)) + _kbps(rendition['audio_bitrate'])) * 1000
 
-# --------- Basic Auth (เฉพาะหน้า index) ----------
-def _auth_failed():
-    resp = make_response('Authentication required', 401)
-    resp.headers['WWW-Authenticate'] = 'Basic realm="Video Index"'
-    return resp
+def _rendition_ladder(key: str):
+    """
+    rendition MP4 ที่พร้อมเล่นพร้อมบิตเรตรวม (bit/วินาที) -> [{name, bandwidth, height}] เรียงจากน้อยไปมาก
+    รวม rung 'source' ที่เป็นต้นฉบับเอง (_pick_rendition ส่งไฟล์ต้นฉบับ)
+    """
+    manifest = _manifest_renditions(key)
+    ready = set(_renditions(key, manifest))
+    ladder = [{'name': r['name'], 'bandwidth': _rung_bandwidth(r), 'height': r.get('height')}
+              for r in manifest if r['name'] in ready]
+    return sorted(ladder, key=lambda r: r['bandwidth'])
 
-def require_index_auth(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        auth = request.authorization
-        if not auth or auth.type != 'basic':
-            return _auth_failed()
-        if auth.username != app.config['INDEX_USERNAME'] or auth.password != app.config['INDEX_PASSWORD']:
-            return _auth_failed()
-        return f(*args, **kwargs)
-    return wrapper
-# ---------------------------------------------------
+def _cached_ladder(key: str):
+    """_rendition_ladder ผ่าน rendition_cache (ไม่ glob mp4/ / อ่าน manifest ทุก Range request ของ quality=auto)"""
+    return rendition_cache.ladder(key, lambda: _rendition_ladder(key))
 
-# ==============================
-# VIDEO PROCESSOR
-# ==============================
-class VideoProcessor:
-    def __init__(self, video_folder, processed_folder):
-        self.video_folder = Path(video_folder)
-        self.processed_folder = Path(processed_folder)
-        self.ffmpeg_path = 'ffmpeg'  # ต้องอยู่ใน PATH
-        self.processing_status = {}  # { key: 'processing'|'completed'|'error'|'not_started' }
-        self._lock = threading.Lock()
+def _fallback_order(ready, manifest):
+    """QUALITY_FALLBACK -> ชื่อที่พร้อม: ชื่อตรงกัน หรือ rendition ที่สูงเท่ากัน (เช่น 'source' 720p อยู่ตำแหน่ง '720p')"""
+    heights = {r['name']: r.get('height') for r in manifest}
+    order = []
+    for name in QUALITY_FALLBACK:
+        height = int(name[:-1]) if name[:-1].isdigit() else None
+        order += [n for n in ready if n == name or (height and heights.get(n) == height)]
+    return order
 
-    def get_video_info(self, video_path: Path):
-        """ดึงข้อมูลวิดีโอด้วย ffprobe"""
-        try:
-            cmd = [
-                'ffprobe', '-v', 'quiet', '-print_format', 'json',
-                '-show_format', '-show_streams', str(video_path)
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-            if result.returncode == 0:
-                info = json.loads(result.stdout)
-                video_stream = next((s for s in info.get('streams', []) if s.get('codec_type') == 'video'), None)
-                fmt = info.get('format', {})
-                return {
-                    'duration': float(fmt.get('duration', 0) or 0),
-                    'size': int(fmt.get('size', 0) or 0),
-                    'width': int(video_stream.get('width', 0) if video_stream else 0),
-                    'height': int(video_stream.get('height', 0) if video_stream else 0),
-                    'bitrate': int(fmt.get('bit_rate', 0) or 0),
-                }
-        except Exception as e:
-            print(f"Error getting video info: {e}")
+def _pick_rendition(key: str, quality=None):
+    """
+    MP4 ที่จะเล่น: ?quality= ถ้ามี, ไม่งั้นตาม QUALITY_FALLBACK (เทียบความสูงด้วย) แล้ว rendition อื่นที่มี
+    -> Path หรือ None = ส่งต้นฉบับ (ยังไม่ประมวลผล / ได้ rung ที่เป็นต้นฉบับเอง)
+    """
+    manifest = _manifest_renditions(key)
+    ready = _renditions(key, manifest)
+    if not ready or (quality == 'source' and 'source' not in ready):
+        return None  # ไม่มี source.mp4 = ต้นฉบับเล่นได้อยู่แล้ว (หรือยังไม่ประมวลผล) -> ส่งไฟล์เดิม
+    order = ([quality] if quality else []) + _fallback_order(ready, manifest) + ready
+    name = next(n for n in order if n in ready)
+    if name in _original_rungs(manifest):
         return None
+    return Path(app.config['PROCESSED_FOLDER']) / key / 'mp4' / f"{name}.mp4"
 
-    def _find_input_file(self, video_id: str):
-        # โหมดเดิม: ชื่อไฟล์ไม่รวมสกุลใน root
-        for ext in VIDEO_EXTS:
-            f = self.video_folder / f"{video_id}{ext}"
-            if f.exists():
-                return f
-        return None
+def _format_duration(seconds):
+    if not seconds or seconds <= 0:
+        return "Unknown"
+    minutes = int(seconds // 60)
+    return f"{minutes}:{int(seconds % 60):02d}"
 
-    def create_web_optimized_version_from_file(self, input_file: Path, video_key: str, make_hls=True):
-        """ประมวลผลจากไฟล์ที่ระบุ (รองรับ relpath)"""
-        input_file = Path(input_file)
-        if not input_file.exists():
-            raise FileNotFoundError(str(input_file))
+def _video_entry(entry):
+    """ข้อมูลไฟล์วิดีโอสำหรับ /api/browse และ /api/videos จาก entry ของ LibraryIndex"""
+    relpath = entry['relpath']
+    stem = Path(entry['name']).stem
+    info = entry['info']
+    return {
+        'id': stem,
+        'relpath': relpath,
+        'filename': entry['name'],
+        'title': stem.replace('_', ' ').title(),
+        'size': f"{entry['size'] / (1024**3):.2f} GB",
+        'duration': _format_duration(info['duration'] if info else 0),
+        'path': f"/api/video_path/{relpath}",
+        'player_url': f"/player_path/{relpath}",
+        'status': video_processor.get_processing_status(_safe_id_from_relpath(relpath)),
+        'created': int(entry['mtime'])
+    }
 
-        out_dir = self.processed_folder / video_key
-        (out_dir / 'mp4').mkdir(parents=True, exist_ok=True)
-        if make_hls:
-            (out_dir / 'hls').mkdir(parents=True, exist_ok=True)
+def _encode_cursor(*parts) -> str:
+    raw = json.dumps(parts, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
 
-        qualities = [
-            {'name': '480p',  'resolution': '854x480',   'video_bitrate': '1000k', 'audio_bitrate': '96k'},
-            {'name': '720p',  'resolution': '1280x720',  'video_bitrate': '2500k', 'audio_bitrate': '128k'},
-            {'name': '1080p', 'resolution': '1920x1080', 'video_bitrate': '4000k', 'audio_bitrate': '192k'},
-        ]
+_NUMBER = (int, float)
+# ชนิดของค่าใน key ที่ LibraryIndex.SORT_FIELDS สร้าง
+_CURSOR_VALUE_TYPES = {'created': _NUMBER, 'size': _NUMBER, 'duration': _NUMBER, 'name': str}
 
-        with self._lock:
-            self.processing_status[video_key] = 'processing'
+def _decode_cursor(token: str, *types):
+    """
+    cursor -> list ของค่าตามลำดับ โดยแต่ละค่าต้องเป็นชนิดตาม types (ตรวจก่อนถึง bisect
+    ที่จะ TypeError ถ้าเทียบ key ต่างชนิดกัน) ผิดรูปแบบ -> ValueError
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        parts = json.loads(raw)
+    except Exception:
+        raise ValueError('invalid cursor')
+    if (not isinstance(parts, list) or len(parts) != len(types)
+            or any(isinstance(v, bool) or not isinstance(v, t) for v, t in zip(parts, types))):
+        raise ValueError('invalid cursor')
+    return parts
 
-        try:
-            # 1) MP4 ต่อความละเอียด
-            for q in qualities:
-                mp4_out = out_dir / 'mp4' / f"{q['name']}.mp4"
-                cmd = [
-                    self.ffmpeg_path, '-y',
-                    '-i', str(input_file),
-                    '-c:v', 'libx264', '-preset', 'medium', '-crf', '23',
-                    '-b:v', q['video_bitrate'],
-                    '-maxrate', q['video_bitrate'],
-                    '-bufsize', str(int(q['video_bitrate'].replace('k', '')) * 2) + 'k',
-                    '-s', q['resolution'],
-                    '-c:a', 'aac', '-b:a', q['audio_bitrate'],
-                    '-movflags', '+faststart',
-                    str(mp4_out)
-                ]
-                print(f"[MP4] {video_key} - {q['name']}")
-                p = subprocess.run(cmd, capture_output=True, text=True)
-                if p.returncode != 0:
-                    print(f"FFmpeg MP4 error {q['name']}: {p.stderr}")
-
-            # 2) HLS (optional)
-            if make_hls:
-                master_path = out_dir / 'hls' / 'master.m3u8'
-                variants = []
-                for q in qualities:
-                    v_dir = out_dir / 'hls' / q['name']
-                    v_dir.mkdir(parents=True, exist_ok=True)
-                    hlscmd = [
-                        self.ffmpeg_path, '-y',
-                        '-i', str(input_file),
-                        '-c:v', 'libx264', '-preset', 'medium', '-crf', '23',
-                        '-b:v', q['video_bitrate'],
-                        '-maxrate', q['video_bitrate'],
-                        '-bufsize', str(int(q['video_bitrate'].replace('k', '')) * 2) + 'k',
-                        '-s', q['resolution'],
-                        '-c:a', 'aac', '-b:a', q['audio_bitrate'],
-                        '-hls_time', str(HLS_SEGMENT_SECONDS),
-                        '-hls_playlist_type', 'vod',
-                        '-hls_flags', 'independent_segments',
-                        '-hls_segment_filename', str(v_dir / "seg_%05d.ts"),
-                        str(v_dir / 'index.m3u8')
-                    ]
-                    print(f"[HLS] {video_key} - {q['name']}")
-                    p2 = subprocess.run(hlscmd, capture_output=True, text=True)
-                    if p2.returncode != 0:
-                        print(f"FFmpeg HLS error {q['name']}: {p2.stderr}")
-                        continue
-                    bw = int(q['video_bitrate'].replace('k', '')) * 1000 + 128000
-                    variants.append({
-                        'name': q['name'],
-                        'bandwidth': bw,
-                        'playlist': f"{q['name']}/index.m3u8",
-                        'resolution': q['resolution']
-                    })
+def _keyset_page(keys, after, limit, descending=False, accept=None):
+    """
+    แบ่งหน้าแบบ keyset บน keys [(ค่า, relpath), ...] ที่เรียงไว้แล้ว
+    after = key ตัวสุดท้ายของหน้าก่อน (None = หน้าแรก) -> (relpaths, key สุดท้ายถ้ายังมีหน้าถัดไป)
+    ราคา O(log n + จำนวนที่ต้องข้ามเพราะ filter)
+    """
+    if descending:
+        i = (bisect.bisect_left(keys, after) if after is not None else len(keys)) - 1
+        step, stop = -1, -1
+    else:
+        i = bisect.bisect_right(keys, after) if after is not None else 0
+        step, stop = 1, len(keys)
 
-                if variants:
-                    with open(master_path, 'w', encoding='utf-8') as m:
-                        m.write("#EXTM3U\n#EXT-X-VERSION:3\n")
-                        for v in variants:
-                            m.write(f"#EXT-X-STREAM-INF:BANDWIDTH={v['bandwidth']},RESOLUTION={v['resolution']}\n")
-                            m.write(f"{v['playlist']}\n")
+    out, last = [], None
+    while i != stop:
+        key = keys[i]
+        i += step
+        if accept is not None and not accept(key[1]):
+            continue
+        if len(out) == limit:
+            return out, last
+        out.append(key[1])
+        last = key
+    return out, None
 
-            with self._lock:
-                self.processing_status[video_key] = 'completed'
-            print(f"[OK] processed: {video_key}")
-            return True
+class _JsonSnapshot:
+    """JSON ที่ serialize แล้ว + strong ETag + ฉบับบีบอัด (สร้างเมื่อมีคนขอครั้งแรก)"""
+    __slots__ = ('version', 'etag', 'body', 'encoded')
 
-        except Exception as e:
-            print(f"[ERR] processing {video_key}: {e}")
-            with self._lock:
-                self.processing_status[video_key] = 'error'
-            return False
+    def __init__(self, version, body: bytes):
+        self.version = version
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.encoded = {}  # { 'gzip' | 'br': bytes }
 
-    def create_web_optimized_version(self, video_id: str):
-        """โหมดเก่า: หาไฟล์จาก root ด้วยชื่อ video_id (ไม่รองรับโฟลเดอร์ย่อย)"""
-        input_file = self._find_input_file(video_id)
-        if not input_file:
-            raise FileNotFoundError(f"ไม่พบไฟล์ {video_id}")
-        key = _safe_id_from_relpath(video_id)
-        return self.create_web_optimized_version_from_file(input_file, key)
+_browse_cache = collections.OrderedDict()  # { (cwd, cursor, limit): _JsonSnapshot }
+_browse_lock = threading.Lock()
 
-    def get_processing_status(self, key: str):
-        return self.processing_status.get(key, 'not_started')
+def _cached_json(cache_key, version, build):
+    """_JsonSnapshot ของ build() ที่ใช้ซ้ำได้ตราบที่ version ยังเท่าเดิม"""
+    with _browse_lock:
+        snap = _browse_cache.get(cache_key)
+        if snap is not None and snap.version == version:
+            _browse_cache.move_to_end(cache_key)
+            return snap
+    body = json.dumps(build(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    snap = _JsonSnapshot(version, body)
+    with _browse_lock:
+        _browse_cache[cache_key] = snap
+        _browse_cache.move_to_end(cache_key)
+        while len(_browse_cache) > BROWSE_CACHE_ENTRIES:
+            _browse_cache.popitem(last=False)
+    return snap
 
-video_processor = VideoProcessor(app.config['VIDEO_FOLDER'], app.config['PROCESSED_FOLDER'])
+def _snapshot_response(snap: _JsonSnapshot):
+    """ตอบ _JsonSnapshot: 304 ถ้า If-None-Match ตรง, บีบอัด br/gzip ตาม Accept-Encoding"""
+    coding = None
+    if len(snap.body) >= COMPRESS_MIN_BYTES:
+        accept = request.accept_encodings
+        if brotli is not None and accept['br']:
+            coding = 'br'
+        elif accept['gzip']:
+            coding = 'gzip'
+    # strong ETag แยกตาม content-coding (RFC 9110 §8.8.3)
+    etag = f'"{snap.etag}-{coding}"' if coding else f'"{snap.etag}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and parse_etags(if_none_match).contains_weak(unquote_etag(etag)[0]):
+        return Response(status=304, headers=headers)
+
+    body = snap.body
+    if coding:
+        body = snap.encoded.get(coding)
+        if body is None:
+            body = brotli.compress(snap.body) if coding == 'br' else gzip.compress(snap.body, 6)
+            snap.encoded[coding] = body
+        headers['Content-Encoding'] = coding
+    return Response(body, status=200, mimetype='application/json', headers=headers)
+
+def _int_param(raw, name: str) -> int:
+    """ค่าจาก query string / JSON -> int หรือ ValueError ที่ตอบเป็น 400 ได้ตรงๆ (ไม่ใช่ข้อความของ int())"""
+    if isinstance(raw, (bool, float)):
+        raise ValueError(f'{name} must be an integer')
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be an integer') from None
+
+def _page_limit(default=None):
+    raw = request.args.get('limit')
+    if raw is None:
+        return default
+    limit = _int_param(raw, 'limit')
+    if limit < 1:
+        raise ValueError('limit must be >= 1')
+    return min(limit, MAX_PAGE_SIZE)
 
 # ==============================
 # ROUTES
 # ==============================
 
+@app.before_request
+def _start_background_workers():
+    # serve.py / asgi.py เริ่มคิวตั้งแต่เปิด server แล้ว -- ทางสำรองสำหรับ WSGI server อื่น (mod_wsgi ฯลฯ)
+    video_processor.queue.start()
+
 @app.route('/healthz')
 def healthz():
     return 'ok', 200
@@ -335,6 +3556,7 @@ def index():
 
         <h2 style="margin-top:20px">🎞 Files in this folder</h2>
         <div id="files" class="grid"></div>
+        <button class="btn" id="moreBtn" style="display:none;margin-top:12px">Load more</button>
 
         <div id="toast"></div>
 
@@ -374,10 +3596,10 @@ def index():
                 `).join('');
             }
 
-            function renderFiles(files) {
+            function renderFiles(files, append=false) {
                 const el = document.getElementById('files');
-                if (!files.length) { el.innerHTML = '<div style="color:#666">— No video files in this folder —</div>'; return; }
-                el.innerHTML = files.map(v => {
+                if (!files.length && !append) { el.innerHTML = '<div style="color:#666">— No video files in this folder —</div>'; return; }
+                const html = files.map(v => {
                     const playerPath = `${prefix}/player_path/${v.relpath}?quality=720p`;
                     const directPath = `${prefix}/api/video_path/${v.relpath}?quality=720p`;
                     const directUrl  = `${location.origin}${directPath}`;
@@ -394,17 +3616,27 @@ def index():
                         </div>
                     `;
                 }).join('');
+                if (append) el.insertAdjacentHTML('beforeend', html);
+                else el.innerHTML = html;
+            }
+
+            function setMore(data) {
+                const more = document.getElementById('moreBtn');
+                more.style.display = data.next_cursor ? '' : 'none';
+                more.dataset.path = data.cwd || '';
+                more.dataset.cursor = data.next_cursor || '';
             }
 
             async function load(path='') {
                 const url = `${prefix}/api/browse?path=${encodeURIComponent(path)}`;
                 document.getElementById('openApi').href = url;
-                const res = await fetch(url);
+                const res = await fetch(`${url}&limit=200`);
                 const data = await res.json();
 
                 buildCrumbs(data.cwd || '');
                 renderFolders(data.dirs || []);
                 renderFiles(data.files || []);
+                setMore(data);
 
                 const up = document.getElementById('upBtn');
                 if (data.parent) { up.disabled = false; up.dataset.path = data.parent; }
@@ -413,6 +3645,15 @@ def index():
 
             document.addEventListener('click', async (e) => {
                 // breadcrumb / folder / up
+                if (e.target.matches('#moreBtn')) {
+                    e.preventDefault();
+                    const path = e.target.dataset.path || '';
+                    const res = await fetch(`${prefix}/api/browse?path=${encodeURIComponent(path)}&limit=200&cursor=${encodeURIComponent(e.target.dataset.cursor)}`);
+                    const data = await res.json();
+                    renderFiles(data.files || [], true);
+                    setMore(data);
+                    return;
+                }
                 if (e.target.matches('#upBtn')) {
                     e.preventDefault();
                     await load(e.target.dataset.path || '');
@@ -476,172 +3717,283 @@ def browse():
     คืนรายการเฉพาะภายใต้โฟลเดอร์ที่ระบุ (ไม่ recursive)
     query: ?path=<relpath> (ว่าง = root)
     """
-    video_folder = Path(app.config['VIDEO_FOLDER']).resolve()
     req_path = (request.args.get('path', '') or '').strip('/')
+    snap = library.snapshot()
 
-    current_dir = (video_folder / req_path).resolve() if req_path else video_folder
-    # ป้องกัน traversal
-    if not str(current_dir).startswith(str(video_folder)):
-        return jsonify({'error': 'forbidden path'}), 403
-    if not current_dir.exists() or not current_dir.is_dir():
-        return jsonify({'error': f'not a directory: {req_path}'}), 404
-
-    dirs, files = [], []
-
-    # โฟลเดอร์ย่อย
-    for p in current_dir.iterdir():
-        if p.is_dir():
-            dirs.append({
-                'name': p.name,
-                'relpath': p.relative_to(video_folder).as_posix(),
-                'type': 'dir'
-            })
+    if req_path in snap.dirs:
+        cwd = req_path  # มาจากการสแกนจริง -> อยู่ใต้ VIDEO_FOLDER แน่นอน ไม่ต้องแตะดิสก์
+    else:
+        video_folder = Path(app.config['VIDEO_FOLDER']).resolve()
+        current_dir = (video_folder / req_path).resolve() if req_path else video_folder
+        # ป้องกัน traversal
+        if not str(current_dir).startswith(str(video_folder)):
+            return jsonify({'error': 'forbidden path'}), 403
+        if not current_dir.exists() or not current_dir.is_dir():
+            return jsonify({'error': f'not a directory: {req_path}'}), 404
+        cwd = '' if current_dir == video_folder else current_dir.relative_to(video_folder).as_posix()
 
-    # ไฟล์วิดีโอในโฟลเดอร์นี้
-    for p in current_dir.iterdir():
-        if p.is_file() and p.suffix.lower() in VIDEO_EXTS:
-            stat = p.stat()
-            size_gb = stat.st_size / (1024**3)
-            info = video_processor.get_video_info(p)
-            duration_str = "Unknown"
-            if info and info['duration'] > 0:
-                minutes = int(info['duration'] // 60)
-                seconds = int(info['duration'] % 60)
-                duration_str = f"{minutes}:{seconds:02d}"
-
-            relpath = p.relative_to(video_folder).as_posix()
-            key = _safe_id_from_relpath(relpath)
-            files.append({
-                'id': p.stem,
-                'relpath': relpath,
-                'filename': p.name,
-                'title': p.stem.replace('_', ' ').title(),
-                'size': f"{size_gb:.2f} GB",
-                'duration': duration_str,
-                'path': f"/api/video_path/{relpath}",
-                'player_url': f"/player_path/{relpath}",
-                'status': video_processor.get_processing_status(key),
-                'created': int(stat.st_mtime)
-            })
+    # แบ่งหน้าเฉพาะไฟล์ (?limit=&cursor=) โฟลเดอร์ย่อยส่งมาเฉพาะหน้าแรก
+    try:
+        limit = _page_limit()
+        cursor = request.args.get('cursor')
+        after = None
+        if cursor:
+            scope, name_key, relpath = _decode_cursor(cursor, str, str, str)
+            if scope != cwd:
+                raise ValueError('cursor belongs to another folder')
+            after = (name_key, relpath)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    dirs.sort(key=lambda x: x['name'].lower())
-    files.sort(key=lambda x: x['filename'].lower())
+    listing = snap.dirs.get(cwd)
+    if listing is None:
+        # โฟลเดอร์ใหม่ที่ดัชนียังไม่เห็น -> ปลุก thread สแกน แล้วตอบว่างไปก่อน
+        library.request_rescan()
 
-    parent_rel = None
-    if current_dir != video_folder:
-        parent_rel = current_dir.parent.relative_to(video_folder).as_posix()
+    def build():
+        sub_rels, file_keys = listing if listing is not None else ((), [])
+        if limit is None and after is None:
+            file_rels, next_key = [k[1] for k in file_keys], None
+        else:
+            file_rels, next_key = _keyset_page(file_keys, after, limit or DEFAULT_PAGE_SIZE)
 
-    return jsonify({
-        'cwd': '' if current_dir == video_folder else current_dir.relative_to(video_folder).as_posix(),
-        'parent': parent_rel,
-        'dirs': dirs,
-        'files': files
-    })
+        dirs = [] if after is not None else [{'name': r.rsplit('/', 1)[-1], 'relpath': r, 'type': 'dir'} for r in sub_rels]
+        return {
+            'cwd': cwd,
+            'parent': (cwd.rsplit('/', 1)[0] if '/' in cwd else '.') if cwd else None,  # '.' = รากของ VIDEO_FOLDER
+            'dirs': dirs,
+            'files': [_video_entry(snap.files[r]) for r in file_rels],
+            'next_cursor': _encode_cursor(cwd, *next_key) if next_key else None
+        }
+
+    # ใช้ JSON เดิมซ้ำจนกว่าดัชนี (ไฟล์/โฟลเดอร์เปลี่ยน) หรือสถานะงานแปลงไฟล์จะเปลี่ยน
+    version = (snap.generation, video_processor.queue.states_version(), listing is not None)
+    return _snapshot_response(_cached_json((cwd, cursor or '', limit), version, build))
 
 @app.route('/api/videos')
 def list_videos():
-    """(ยังคงไว้) ลิสต์ไฟล์วิดีโอทั้งหมดแบบ recursive"""
-    videos = []
+    """
+    ลิสต์ไฟล์วิดีโอทั้งหมดแบบ recursive (ตอบจาก LibraryIndex)
+    query (ทั้งหมด optional):
+      sort=created|size|duration|name  order=asc|desc
+      folder=<relpath prefix>  ext=mp4,mkv  status=completed,processing,...
+      min_duration=<sec>  max_duration=<sec>
+      limit=<n>  cursor=<next_cursor จากหน้าก่อน>
+    ไม่ส่ง limit/cursor -> คืน array ทั้งหมดแบบเดิม, ส่ง -> คืน {items, next_cursor}
+    """
     video_folder = Path(app.config['VIDEO_FOLDER'])
 
     if not video_folder.exists():
         return jsonify({'error': f'VIDEO_FOLDER not found: {video_folder}'}), 500
 
+    args = request.args
+    try:
+        sort = args.get('sort', 'created')
+        if sort not in LibraryIndex.SORT_FIELDS:
+            raise ValueError(f"sort must be one of {', '.join(LibraryIndex.SORT_FIELDS)}")
+        order = args.get('order', 'asc' if sort == 'name' else 'desc')
+        if order not in ('asc', 'desc'):
+            raise ValueError('order must be asc or desc')
+        limit = _page_limit()
+        cursor = args.get('cursor')
+        after = None
+        if cursor:
+            c_sort, c_order, value, relpath = _decode_cursor(cursor, str, str, _CURSOR_VALUE_TYPES[sort], str)
+            if (c_sort, c_order) != (sort, order):
+                raise ValueError('cursor does not match sort/order')
+            after = (value, relpath)
+
+        folder = (args.get('folder') or '').strip('/')
+        exts = {('.' + e.strip().lstrip('.')).lower() for e in args.get('ext', '').split(',') if e.strip()}
+        statuses = {x.strip() for x in args.get('status', '').split(',') if x.strip()}
+        min_d = float(args['min_duration']) if args.get('min_duration') else None
+        max_d = float(args['max_duration']) if args.get('max_duration') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
-        for video_file in video_folder.rglob('*'):
-            if video_file.is_file() and video_file.suffix.lower() in VIDEO_EXTS:
-                stat = video_file.stat()
-                size_gb = stat.st_size / (1024**3)
-                info = video_processor.get_video_info(video_file)
-                duration_str = "Unknown"
-                if info and info['duration'] > 0:
-                    minutes = int(info['duration'] // 60)
-                    seconds = int(info['duration'] % 60)
-                    duration_str = f"{minutes}:{seconds:02d}"
-                relpath = video_file.relative_to(video_folder).as_posix()
-                key = _safe_id_from_relpath(relpath)
-                videos.append({
-                    'id': video_file.stem,
-                    'relpath': relpath,
-                    'filename': video_file.name,
-                    'title': video_file.stem.replace('_', ' ').title(),
-                    'size': f"{size_gb:.2f} GB",
-                    'duration': duration_str,
-                    'path': f"/api/video_path/{relpath}",
-                    'player_url': f"/player_path/{relpath}",
-                    'status': video_processor.get_processing_status(key),
-                    'created': int(stat.st_mtime)
-                })
-
-        videos.sort(key=lambda x: x['created'], reverse=True)
-        return jsonify(videos)
+        snap = library.snapshot()
+        files = snap.files
+
+        def accept(relpath):
+            e = files[relpath]
+            if folder and not relpath.startswith(folder + '/'):
+                return False
+            if exts and os.path.splitext(e['name'])[1].lower() not in exts:
+                return False
+            if min_d is not None or max_d is not None:
+                d = e['info']['duration'] if e['info'] else None
+                if d is None or (min_d is not None and d < min_d) or (max_d is not None and d > max_d):
+                    return False
+            if statuses and video_processor.get_processing_status(_safe_id_from_relpath(relpath)) not in statuses:
+                return False
+            return True
+
+        paged = limit is not None or after is not None
+        page_size = (limit or DEFAULT_PAGE_SIZE) if paged else len(files) + 1
+        filtered = folder or exts or statuses or min_d is not None or max_d is not None
+        rels, next_key = _keyset_page(snap.sort_keys[sort], after, page_size,
+                                      descending=(order == 'desc'), accept=accept if filtered else None)
+        items = [_video_entry(files[r]) for r in rels]
+        if not paged:
+            return jsonify(items)
+        return jsonify({
+            'items': items,
+            'next_cursor': _encode_cursor(sort, order, *next_key) if next_key else None
+        })
 
     except Exception as e:
         return jsonify({'error': f'เกิดข้อผิดพลาด: {str(e)}'}), 500
 
-@app.route('/api/video/<filename>')
-def serve_video_legacy(filename):
-    """โหมดเดิม: เฉพาะไฟล์ระดับ root (เพื่อความเข้ากันได้)"""
-    video_folder = Path(app.config['VIDEO_FOLDER'])
-    video_path = video_folder / secure_filename(filename)
+def _legacy_stream_target(filename: str, quality=None):
+    """ไฟล์ที่ /api/video/<filename> จะส่ง -> Path หรือ None ถ้าไม่พบ"""
+    video_path = Path(app.config['VIDEO_FOLDER']) / secure_filename(filename)
     if not video_path.exists():
-        return jsonify({'error': 'ไม่พบไฟล์'}), 404
+        return None
+    return _pick_rendition(_safe_id_from_relpath(video_path.stem), quality) or video_path
 
-    key = _safe_id_from_relpath(video_path.stem)
-    processed = Path(app.config['PROCESSED_FOLDER']) / key / 'mp4'
-    final_path = None
-    quality = request.args.get('quality')
-    if quality:
-        cand = processed / f"{quality}.mp4"
-        if cand.exists():
-            final_path = cand
-
-    if final_path is None:
-        for q in ['720p', '480p', '1080p']:
-            cand = processed / f"{q}.mp4"
-            if cand.exists():
-                final_path = cand
-                break
+def _source_path(relpath: str):
+    """relpath -> Path ของต้นฉบับ หรือ None ถ้าหลุดออกนอก VIDEO_FOLDER (path traversal)"""
+    video_folder = Path(app.config['VIDEO_FOLDER'])
+    video_path = (video_folder / relpath).resolve()
+    if not str(video_path).startswith(str(video_folder.resolve())):
+        return None
+    return video_path
 
-    if final_path is None:
-        final_path = video_path
+def _stream_target(relpath: str, quality=None):
+    """ไฟล์ที่ /api/video_path/<relpath> จะส่ง (rendition ที่แปลงแล้วหรือต้นฉบับ) -> Path หรือ None"""
+    video_path = _source_path(relpath)
+    if video_path is None or not video_path.exists():
+        return None
+    return _pick_rendition(_safe_id_from_relpath(relpath), quality) or video_path
 
-    return send_video_with_range(final_path)
+def _auto_quality(key: str, session, hint_bps=None):
+    """?quality=auto -> ชื่อ rendition ของ session นี้ (ยังไม่ได้ประมวลผล -> None = ตาม QUALITY_FALLBACK/ต้นฉบับ)"""
+    ladder = _cached_ladder(key)
+    return adaptive.choose(session, key, ladder, hint_bps) if ladder else None
 
-@app.route('/api/video_path/<path:relpath>')
-def serve_video_by_path(relpath):
-    """เล่นไฟล์ตาม relpath (รองรับโฟลเดอร์ย่อย)"""
-    video_folder = Path(app.config['VIDEO_FOLDER'])
-    video_path = (video_folder / relpath).resolve()
+def _resolve_legacy(filename: str, quality=None, session=None, hint_bps=None):
+    """_legacy_stream_target ผ่าน rendition_cache -> _ResolvedFile หรือ None"""
+    if quality == 'auto':
+        quality = _auto_quality(_safe_id_from_relpath(Path(secure_filename(filename)).stem), session, hint_bps)
+    return rendition_cache.get(('video', filename, quality), lambda: _legacy_stream_target(filename, quality))
 
-    # ป้องกัน path traversal
-    if not str(video_path).startswith(str(video_folder.resolve())):
-        return jsonify({'error': 'forbidden path'}), 403
-    if not video_path.exists():
-        return jsonify({'error': 'ไม่พบไฟล์'}), 404
+def _resolve_stream(relpath: str, quality=None, session=None, hint_bps=None):
+    """_stream_target ผ่าน rendition_cache -> _ResolvedFile หรือ None"""
+    if quality == 'auto':
+        quality = _auto_quality(_safe_id_from_relpath(relpath), session, hint_bps)
+    return rendition_cache.get(('video_path', relpath, quality), lambda: _stream_target(relpath, quality))
 
-    # ถ้ามีไฟล์แปลงแล้วให้ใช้ หรือเลือกจาก ?quality=
-    key = _safe_id_from_relpath(relpath)
-    processed = Path(app.config['PROCESSED_FOLDER']) / key / 'mp4'
-
-    final_path = None
-    quality = request.args.get('quality')
-    if quality:
-        cand = processed / f"{quality}.mp4"
-        if cand.exists():
-            final_path = cand
-
-    if final_path is None:
-        for q in ['720p', '480p', '1080p']:
-            cand = processed / f"{q}.mp4"
-            if cand.exists():
-                final_path = cand
-                break
+def _request_abr():
+    """(session ของ quality=auto หรือ None, client hint, session ที่ต้องวัดความเร็วหรือ None) ของ request ปัจจุบัน"""
+    session = _abr_session(request.headers, request.remote_addr, request.args, request.cookies,
+                           request.args.get('quality'))
+    return session, _downlink_hint(request.headers, request.args), _pace_session(session, request.args, request.cookies)
+
+def _hls_file(video_key: str, subpath: str):
+    """ไฟล์ HLS แบบ offline ใต้ PROCESSED/<key>/hls -> Path หรือ None (ไม่มี / path traversal)"""
+    base = Path(app.config['PROCESSED_FOLDER']) / video_key / 'hls'
+    target = (base / subpath).resolve()
+    if not str(target).startswith(str(base.resolve())) or not target.is_file():
+        return None
+    return target
+
+def _thumbs_file(video_key: str, name: str):
+    """poster / sprite / vtt ใต้ PROCESSED/<key>/thumbs -> Path หรือ None (ไม่มี / path traversal)"""
+    base = Path(app.config['PROCESSED_FOLDER']) / video_key / 'thumbs'
+    target = (base / name).resolve()
+    if not str(target).startswith(str(base.resolve())) or not target.is_file():
+        return None
+    return target
+
+def _thumbs_urls(video_key: str):
+    """{'poster': url, 'vtt': url} ของวิดีโอที่ทำภาพตัวอย่างแล้ว (ไม่มี -> {})"""
+    vtt = _thumbs_file(video_key, 'thumbs.vtt')
+    if vtt is None:
+        return {}
+    v = int(vtt.stat().st_mtime)
+    base = f"/thumbs/{quote(video_key)}"
+    return {'poster': f"{base}/poster.jpg?v={v}", 'vtt': f"{base}/thumbs.vtt?v={v}"}
+
+# แถบเวลาใต้วิดีโอที่แสดงภาพจาก sprite ตอนชี้/ลาก (native controls แสดง thumbnail track ไม่ได้)
+_SCRUB_PREVIEW = """
+        <style>
+            .wrap{height:calc(100% - 18px)}
+            #scrub{position:fixed;left:0;right:0;bottom:0;height:18px;background:#222;cursor:pointer}
+            #scrub-fill{height:100%;width:0;background:#c00;pointer-events:none}
+            #scrub-tip{position:fixed;bottom:24px;display:none;border:1px solid #fff;pointer-events:none}
+        </style>
+        <div id="scrub"><div id="scrub-fill"></div></div>
+        <div id="scrub-tip"></div>
+        <script>
+        (function(){
+            const video = document.getElementById('__VIDEO_ID__');
+            const bar = document.getElementById('scrub'), fill = document.getElementById('scrub-fill');
+            const tip = document.getElementById('scrub-tip');
+            const vtt = new URL('__VTT_URL__', location.href);
+            const sec = s => s.split(':').reduce((a, p) => a * 60 + parseFloat(p), 0);
+            let cues = [];
+            fetch(vtt).then(r => r.ok ? r.text() : '').then(text => {
+                for (const block of text.split(/\\r?\\n\\r?\\n/)) {
+                    const m = block.match(/([\\d:.]+) --> ([\\d:.]+)\\r?\\n(\\S+)/);
+                    if (!m) continue;
+                    const [url, xywh] = m[3].split('#xywh=');
+                    const [x, y, w, h] = (xywh || '0,0,0,0').split(',').map(Number);
+                    cues.push({start: sec(m[1]), end: sec(m[2]), url: new URL(url, vtt).href, x, y, w, h});
+                }
+            });
+            const timeAt = e => {
+                const r = bar.getBoundingClientRect();
+                return Math.min(1, Math.max(0, (e.clientX - r.left) / r.width)) * (video.duration || 0);
+            };
+            bar.addEventListener('mousemove', e => {
+                const t = timeAt(e);
+                const c = cues.find(c => t >= c.start && t < c.end) || cues[cues.length - 1];
+                if (!c) return;
+                Object.assign(tip.style, {
+                    display: 'block', width: c.w + 'px', height: c.h + 'px',
+                    background: `url("${c.url}") -${c.x}px -${c.y}px`,
+                    left: Math.min(innerWidth - c.w - 2, Math.max(0, e.clientX - c.w / 2)) + 'px'
+                });
+            });
+            bar.addEventListener('mouseleave', () => { tip.style.display = 'none'; });
+            bar.addEventListener('click', e => { if (video.duration) video.currentTime = timeAt(e); });
+            video.addEventListener('timeupdate', () => {
+                fill.style.width = (video.duration ? video.currentTime / video.duration * 100 : 0) + '%';
+            });
+        })();
+        </script>
+"""
 
-    if final_path is None:
-        final_path = video_path
+def _thumbs_markup(video_key: str, video_id: str):
+    """-> (attribute poster ของ <video>, HTML แถบ preview) หรือ ('', '') ถ้ายังไม่มีภาพตัวอย่าง"""
+    urls = _thumbs_urls(video_key)
+    if not urls:
+        return '', ''
+    return (f'poster="{urls["poster"]}"',
+            _SCRUB_PREVIEW.replace('__VIDEO_ID__', video_id).replace('__VTT_URL__', urls['vtt']))
+
+@app.route('/api/video/<filename>')
+def serve_video_legacy(filename):
+    """โหมดเดิม: เฉพาะไฟล์ระดับ root (เพื่อความเข้ากันได้)"""
+    session, hint, pace = _request_abr()
+    resolved = _resolve_legacy(filename, request.args.get('quality'), session, hint)
+    if resolved is None:
+        return jsonify({'error': 'ไม่พบไฟล์'}), 404
+    return send_video_with_range(resolved.path, resolved=resolved, pace_session=pace)
 
-    return send_video_with_range(final_path)
+@app.route('/api/video_path/<path:relpath>')
+def serve_video_by_path(relpath):
+    """เล่นไฟล์ตาม relpath (รองรับโฟลเดอร์ย่อย)"""
+    # ถ้ามีไฟล์แปลงแล้วให้ใช้ หรือเลือกจาก ?quality= (_stream_target ตรวจ path traversal แล้ว)
+    # ?quality=auto = เลือกตามความเร็วของ session (ดู AdaptiveQuality)
+    session, hint, pace = _request_abr()
+    resolved = _resolve_stream(relpath, request.args.get('quality'), session, hint)
+    if resolved is None:
+        if _source_path(relpath) is None:
+            return jsonify({'error': 'forbidden path'}), 403
+        return jsonify({'error': 'ไม่พบไฟล์'}), 404
+    return send_video_with_range(resolved.path, resolved=resolved, pace_session=pace)
 
 @app.route('/player/<filename>')
 def player_legacy(filename):
@@ -659,10 +4011,16 @@ def player_by_path(relpath):
 
     start_time = request.args.get('t', '0')
     autoplay = request.args.get('autoplay', '0') == '1'
-    quality = request.args.get('quality', '720p')
+    quality = request.args.get('quality', 'auto')  # auto = เลือก/สลับตามความเร็วของผู้ชม
+    key = _safe_id_from_relpath(relpath)
+    if quality not in {'auto', 'source', *(r['name'] for r in RENDITION_LADDER), *_renditions(key)}:
+        return "quality ไม่ถูกต้อง", 400
 
-    video_url = f"/api/video_path/{relpath}?quality={quality}"
+    video_url = f"/api/video_path/{quote(relpath)}"
+    abr_url = f"/api/abr/{quote(relpath)}"
     title = Path(relpath).stem.replace('_', ' ').title()
+    poster, preview = _thumbs_markup(key, 'v')
+    quality_js = json.dumps(quality).replace('</', '<\\/')
 
     return f"""
     <!DOCTYPE html>
@@ -679,33 +4037,116 @@ def player_by_path(relpath):
     </head>
     <body>
         <div class="wrap">
-            <video id="v" controls {"autoplay" if autoplay else ""} preload="metadata" playsinline>
-                <source src="{video_url}" type="video/mp4">
+            <video id="v" controls {"autoplay" if autoplay else ""} preload="metadata" playsinline {poster}>
                 เบราว์เซอร์ของคุณไม่รองรับการเล่นวิดีโอ
             </video>
         </div>
         <script>
             const v = document.getElementById('v');
-            const t = {start_time};
-            v.addEventListener('loadedmetadata', ()=>{{ if (t>0) v.currentTime = t; }});
+            const t = {float(start_time) if start_time.replace('.', '', 1).isdigit() else 0};
+            // session ของแท็บนี้: server วัดความเร็วและจำ rendition ของ quality=auto ตาม sid
+            let sid = sessionStorage.getItem('vs_sid');
+            if (!sid) {{
+                sid = Math.random().toString(36).slice(2) + Date.now().toString(36);
+                sessionStorage.setItem('vs_sid', sid);
+            }}
+            const downlink = (navigator.connection && navigator.connection.downlink) || '';
+            const src = q => "{video_url}?quality=" + encodeURIComponent(q) + "&sid=" + sid + "&downlink=" + downlink;
+            let current = {quality_js};
+            const auto = current === 'auto';
+            v.src = src(current);
+            v.addEventListener('loadedmetadata', ()=>{{ if (t>0) v.currentTime = t; }}, {{once: true}});
             document.addEventListener('contextmenu', e=>e.preventDefault());
+
+            // สลับ rendition กลางทาง: ถาม server ทุก 10 วินาที แล้วเปลี่ยนไฟล์ที่ keyframe ถัดไป
+            // (ทุก rendition มี keyframe ตรงกันทุก keyframe_interval วินาที -> seek ไปจุดนั้นเริ่มเล่นได้ทันที)
+            let pending = null;
+            function bufferedAhead() {{
+                for (let i = 0; i < v.buffered.length; i++) {{
+                    if (v.buffered.start(i) <= v.currentTime && v.currentTime <= v.buffered.end(i)) {{
+                        return v.buffered.end(i) - v.currentTime;
+                    }}
+                }}
+                return 0;
+            }}
+            function switchTo(q, at) {{
+                const playing = !v.paused;
+                current = q;
+                v.src = src(q);
+                v.addEventListener('loadedmetadata', ()=>{{
+                    v.currentTime = at;
+                    if (playing) v.play();
+                }}, {{once: true}});
+            }}
+            v.addEventListener('timeupdate', ()=>{{
+                if (pending && v.currentTime >= pending.at - 0.1) {{
+                    const p = pending;
+                    pending = null;
+                    switchTo(p.quality, Math.max(p.at, v.currentTime));
+                }}
+            }});
+            if (auto) setInterval(async ()=>{{
+                if (v.paused || v.seeking || pending) return;
+                const r = await fetch("{abr_url}?sid=" + sid + "&current=" + encodeURIComponent(current)
+                                      + "&downlink=" + downlink).then(r => r.json()).catch(() => null);
+                if (!r || !r.quality || r.quality === r.current) return;
+                const up = r.renditions.findIndex(x => x.name === r.quality) >
+                           r.renditions.findIndex(x => x.name === r.current);
+                if (up && bufferedAhead() < 15) return;  // ขึ้นคุณภาพเฉพาะตอน buffer เหลือพอ
+                const k = r.keyframe_interval;
+                pending = {{quality: r.quality, at: Math.ceil((v.currentTime + 0.5) / k) * k}};
+            }}, 10000);
         </script>
+        {preview}
     </body>
     </html>
     """
 
+@app.route('/api/abr/<path:relpath>')
+def abr_recommend(relpath):
+    """
+    rendition ที่แนะนำสำหรับ session นี้ตอนนี้ (?sid=, ?current= ชื่อที่เล่นอยู่หรือ auto)
+    player เรียกเป็นระยะแล้วสลับเองที่ keyframe ถัดไป
+    """
+    if _source_path(relpath) is None:
+        return jsonify({'error': 'forbidden path'}), 403
+    key = _safe_id_from_relpath(relpath)
+    ladder = _cached_ladder(key)
+    session = _client_key(request.headers, request.remote_addr, request.args, request.cookies, prefer_session=True)
+    bps = adaptive.estimate(session, _downlink_hint(request.headers, request.args))
+    current = request.args.get('current')
+    if current == 'auto':
+        current = adaptive.picked(session, key)
+    return jsonify({
+        'quality': adaptive.recommend(ladder, bps),
+        'current': current,
+        'estimate_bps': int(bps) if bps else None,
+        'renditions': ladder,
+        'keyframe_interval': HLS_PART_SECONDS,
+    })
+
 @app.route('/hls/<video_key>/<path:subpath>')
 def serve_hls(video_key, subpath):
-    """เสิร์ฟไฟล์ HLS (master.m3u8, index.m3u8, .ts segments)"""
+    """
+    เสิร์ฟไฟล์ HLS (master.m3u8, index.m3u8, segment .m4s/.ts หรือ media.mp4 แบบ byte-range)
+    media.mp4 ใหญ่เกิน hot cache -> send_video_with_range ตอบ 206 ตาม Range ของแต่ละ segment
+    (ส่วนหัวไฟล์ = init + segment แรกๆ อยู่ใน block_cache)
+    """
     base = Path(app.config['PROCESSED_FOLDER']) / video_key / 'hls'
-    target = (base / subpath).resolve()
-    if not str(target).startswith(str(base.resolve())):
+    if not str((base / subpath).resolve()).startswith(str(base.resolve())):
         return abort(403)
-    if not target.exists():
-        return abort(404)
-    ctype = mimetypes.guess_type(str(target))[0] or 'application/octet-stream'
-    resp = send_file(str(target), mimetype=ctype, as_attachment=False)
-    return _cache_headers(resp, 600)
+    started = time.perf_counter()
+    target = _hls_file(video_key, subpath)
+    if target is not None:
+        resp = send_hot_file(target, max_age=600)
+        hls_request_seconds.observe(time.perf_counter() - started, 'offline')
+        return resp
+    # ยังไม่มีผลจาก process_by_path -> JIT (ใช้ namespace jit/ แยกจาก HLS แบบ offline ไม่ให้ปนกัน)
+    if app.config['HLS_JIT'] and (subpath == 'master.m3u8' or subpath.startswith('jit/')):
+        resp = _serve_jit(video_key, subpath)
+        hls_request_seconds.observe(time.perf_counter() - started, 'jit')
+        return resp
+    return abort(404)
 
 @app.route('/hlsplayer/<video_key>')
 def hls_player(video_key):
@@ -713,10 +4154,19 @@ def hls_player(video_key):
     base = Path(app.config['PROCESSED_FOLDER']) / video_key / 'hls'
     master = base / 'master.m3u8'
     title = video_key.replace('_', ' ').title()
-    if not master.exists():
+    if not master.exists() and not (app.config['HLS_JIT'] and _jit_source(video_key)):
         return f"ยังไม่มี HLS สำหรับ {video_key}.<br>โปรดกด /api/process_by_path/<relpath> ก่อน", 404
 
     master_url = f"/hls/{video_key}/master.m3u8"
+    poster, preview = _thumbs_markup(video_key, 'video')
+    startup = _hls_startup(video_key) if app.config['HLS_STARTUP_HINTS'] else None
+    headers = {}
+    loader = ''
+    if startup:
+        _warm_hls(video_key, startup['warm'])
+        loader = _INLINE_PLAYLIST_LOADER % json.dumps(startup['inline']).replace('</', '<\\/')
+        if startup['preload']:
+            headers['Link'] = ', '.join(f"<{url}>; rel=preload; as=fetch; crossorigin" for url in startup['preload'])
     return f"""
     <!DOCTYPE html>
     <html>
@@ -732,7 +4182,7 @@ def hls_player(video_key):
     </head>
     <body>
         <div class="wrap">
-            <video id="video" controls autoplay playsinline></video>
+            <video id="video" controls autoplay playsinline {poster}></video>
         </div>
         <script src="https://cdn.jsdelivr.net/npm/hls.js@latest"></script>
         <script>
@@ -741,7 +4191,8 @@ def hls_player(video_key):
             if (video.canPlayType('application/vnd.apple.mpegURL')) {{
                 video.src = src; // Safari/iOS เล่น HLS ได้ตรง
             }} else if (window.Hls) {{
-                const hls = new Hls();
+                const config = {{}};{loader}
+                const hls = new Hls(config);
                 hls.loadSource(src);
                 hls.attachMedia(video);
             }} else {{
@@ -749,9 +4200,31 @@ def hls_player(video_key):
             }}
             document.addEventListener('contextmenu', e=>e.preventDefault());
         </script>
+        {preview}
     </body>
     </html>
-    """
+    """, 200, headers
+
+@app.route('/thumbs/<video_key>/<path:name>')
+def serve_thumbs(video_key, name):
+    """poster.jpg / sprite_NNN.jpg / thumbs.vtt (URL มี ?v= -> ให้ browser/proxy cache ได้นาน)"""
+    target = _thumbs_file(video_key, name)
+    if target is None:
+        return abort(404)
+    return send_hot_file(target, max_age=THUMBS_MAX_AGE)
+
+def _priority_arg():
+    try:
+        return int(request.args.get('priority', 0))
+    except ValueError:
+        return 0
+
+def _enqueue_response(job, created, **extra):
+    return jsonify({
+        'status': 'processing_started' if created else f"already_{job['state']}",
+        **extra,
+        'queue': video_processor.queue.describe(job['key']),
+    })
 
 @app.route('/api/process/<video_id>')
 def process_video_legacy(video_id):
@@ -760,17 +4233,19 @@ def process_video_legacy(video_id):
         if not video_processor._find_input_file(video_id):
             return jsonify({'error': f'ไม่พบไฟล์ {video_id} ใน root'}), 404
 
-        def bg():
-            video_processor.create_web_optimized_version(video_id)
-
-        threading.Thread(target=bg, daemon=True).start()
-        return jsonify({'status': 'processing_started', 'video_id': video_id})
+        job, created = video_processor.create_web_optimized_version(video_id, priority=_priority_arg())
+        return _enqueue_response(job, created, video_id=video_id)
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/process_by_path/<path:relpath>')
 def process_by_path(relpath):
-    """เริ่มประมวลผลไฟล์ตาม relpath (สร้าง MP4 หลายความละเอียด + HLS)"""
+    """
+    ส่งไฟล์ตาม relpath เข้าคิวประมวลผล (สร้าง MP4 หลายความละเอียด + HLS)
+    ?priority=<int> มาก = ทำก่อน, ?force=1 = encode ใหม่ทั้งหมดแม้มี rendition ที่เสร็จแล้ว
+    """
     video_folder = Path(app.config['VIDEO_FOLDER'])
     input_path = (video_folder / relpath).resolve()
     if not str(input_path).startswith(str(video_folder.resolve())):
@@ -779,31 +4254,333 @@ def process_by_path(relpath):
         return jsonify({'error': f'ไม่พบไฟล์ {relpath}'}), 404
 
     key = _safe_id_from_relpath(relpath)
+    try:
+        job, created = video_processor.enqueue(input_path, key, make_hls=True, priority=_priority_arg(),
+                                               force=request.args.get('force') == '1')
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    return _enqueue_response(job, created, video_key=key, relpath=relpath)
+
+@app.route('/api/cancel/<key>', methods=['GET', 'POST'])
+def cancel_processing(key):
+    """ยกเลิกงานที่รออยู่ในคิวหรือกำลังแปลง (GET ได้ด้วยเพราะ Apache เปิดแค่ GET/HEAD/OPTIONS)"""
+    if not video_processor.queue.cancel(key):
+        return jsonify({'key': key, 'cancelled': False, 'status': video_processor.get_processing_status(key)}), 409
+    return jsonify({'key': key, 'cancelled': True})
+
+BATCH_ORDERS = ('shortest', 'longest', 'path')
+BATCH_ASSUMED_BPS = 4_000_000  # เดาความยาวจากขนาดไฟล์ของไฟล์ที่ยังไม่ได้ probe (ใช้จัดลำดับเท่านั้น)
+
+def _flag(value, default=False):
+    if value is None:
+        return default
+    return value is True or str(value).lower() in ('1', 'true', 'yes')
+
+def _batch_args():
+    """พารามิเตอร์ของ /api/batch จาก query string (GET) หรือ JSON body (POST, รายการ relpath ยาวๆ)"""
+    body = request.get_json(silent=True) if request.method == 'POST' else None
+    body = body if isinstance(body, dict) else {}
+
+    def arg(name, default=None):
+        return body.get(name, request.args.get(name, default))
+
+    relpaths = body.get('relpaths') or request.args.getlist('relpath')
+    if not isinstance(relpaths, list) or not all(isinstance(r, str) for r in relpaths):
+        raise ValueError('relpaths must be a list of strings')
+    order = arg('order', 'shortest')
+    if order not in BATCH_ORDERS:
+        raise ValueError(f"order must be one of {', '.join(BATCH_ORDERS)}")
+    return {
+        'prefix': str(arg('prefix', '')).strip('/'),
+        'relpaths': [r.strip('/') for r in relpaths if r.strip('/')],
+        'recursive': _flag(arg('recursive')),
+        'skip_processed': _flag(arg('skip_processed'), default=True),
+        'force': _flag(arg('force')),
+        'priority': _int_param(arg('priority', 0), 'priority'),
+        'order': order,
+    }
+
+def _batch_files(spec):
+    """
+    ไฟล์ที่จะอยู่ในชุด -> ([entry ของ library], [relpath ที่ไม่พบ])
+    prefix อ่านจากดัชนี (ไม่ต้อง walk / probe ไฟล์ทีละตัว), relpath ที่ยังไม่เข้าดัชนีเช็คจากดิสก์
+    """
+    snap = library.snapshot()
+    if not spec['relpaths']:
+        prefix = spec['prefix']
+        if prefix not in snap.dirs:
+            return [], [prefix]
+        if spec['recursive']:
+            return [e for e in snap.files.values()
+                    if not prefix or e['dir'] == prefix or e['dir'].startswith(prefix + '/')], []
+        return [snap.files[r] for _, r in snap.dirs[prefix][1]], []
+
+    entries, missing = [], []
+    for relpath in dict.fromkeys(spec['relpaths']):
+        entry = snap.files.get(relpath)
+        if entry is None:
+            path = _source_path(relpath)
+            if path is None or not path.is_file() or path.suffix.lower() not in VIDEO_EXTS:
+                missing.append(relpath)
+                continue
+            st = path.stat()
+            entry = {'relpath': relpath, 'dir': relpath.rpartition('/')[0], 'name': path.name,
+                     'size': st.st_size, 'mtime': st.st_mtime, 'info': None}
+        entries.append(entry)
+    return entries, missing
+
+def _entry_duration(entry):
+    return entry['info']['duration'] if entry['info'] and entry['info'].get('duration') else None
 
-    def bg():
-        video_processor.create_web_optimized_version_from_file(input_path, key, make_hls=True)
+def _already_processed(key: str, entry) -> bool:
+    """งานล่าสุดเสร็จแล้ว หรือมี HLS ที่ใหม่กว่าต้นฉบับ (ประมวลผลไว้ก่อนมี JobStore)"""
+    if video_processor.get_processing_status(key) == 'completed':
+        return True
+    master = Path(app.config['PROCESSED_FOLDER']) / key / 'hls' / 'master.m3u8'
+    try:
+        return master.stat().st_mtime >= entry['mtime']
+    except OSError:
+        return False
+
+def _batch_summary(batch_id: str):
+    """ความคืบหน้ารวมของ batch -> dict หรือ None"""
+    batch, jobs = video_processor.queue.store.batch(batch_id)
+    if batch is None:
+        return None
+    counts = collections.Counter(j['state'] or 'missing' for j in jobs)
+    total = done = 0.0
+    for j in jobs:
+        duration = j['duration'] or 0.0
+        total += duration
+        if j['state'] == 'completed':
+            done += duration
+        elif j['state'] == 'processing' and j['progress']:
+            progress = json.loads(j['progress'])
+            stage = progress.get('stage')
+            if stage == 'encode':
+                done += min(duration, progress.get('out_time') or 0.0)
+            elif stage not in (None, 'remux'):
+                done += duration  # encode เสร็จแล้ว เหลือ thumbnails / HLS ซึ่งเร็วมาก
+
+    started = [j['started'] for j in jobs if j['started'] and j['started'] >= batch['created']]
+    finished = [j['finished'] for j in jobs if j['finished']]
+    active = counts['queued'] + counts['processing']
+    now = time.time()
+    elapsed = ((now if active or not finished else max(finished)) - min(started)) if started else 0.0
+    rate = done / elapsed if elapsed > 0 else None  # วินาทีของวิดีโอต่อวินาที (ทั้งชุด ทุก worker)
+    ended = len(jobs) - active
+    return {
+        'batch_id': batch_id,
+        'created': int(batch['created']),
+        'spec': json.loads(batch['spec']),
+        'jobs': len(jobs),
+        'skipped': batch['skipped'],
+        'rejected': batch['rejected'],
+        'states': dict(counts),
+        'done': not active,
+        'percent': round(done / total * 100, 1) if total else (round(ended / len(jobs) * 100, 1) if jobs else 100.0),
+        'media_seconds': round(total, 1),
+        'media_seconds_done': round(done, 1),
+        'elapsed_seconds': int(elapsed),
+        'throughput': {
+            'media_seconds_per_second': round(rate, 3) if rate else None,
+            'jobs_per_hour': round(ended / elapsed * 3600, 1) if elapsed > 0 else None,
+            'encode_seconds': round(sum(j['encode_seconds'] or 0.0 for j in jobs), 1),
+        },
+        'eta_seconds': int((total - done) / rate) if rate and active else None,
+        'errors': [{'relpath': j['relpath'], 'error': j['error']} for j in jobs if j['state'] == 'error'][:50],
+    }
+
+@app.route('/api/batch', methods=['GET', 'POST'])
+def create_batch():
+    """
+    ส่งหลายไฟล์เข้าคิวในครั้งเดียว -> batch_id สำหรับติดตามความคืบหน้ารวม (GET ได้เพราะ Apache เปิดแค่ GET/HEAD/OPTIONS)
+    ?prefix=<โฟลเดอร์> [&recursive=1] หรือ ?relpath=a&relpath=b (POST: JSON {"relpaths": [...], ...})
+    ?skip_processed=0 = รวมไฟล์ที่ประมวลผลแล้ว, ?force=1, ?priority=<int>
+    ?order=shortest (ค่าเริ่มต้น: งานสั้นเสร็จเร็ว ได้ไฟล์ที่ดูได้มากที่สุดเร็วที่สุด)
+          | longest (ทั้งชุดจบเร็วที่สุดเมื่อมีหลาย worker) | path (ตามโฟลเดอร์/ชื่อไฟล์)
+    """
+    try:
+        spec = _batch_args()
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    entries, missing = _batch_files(spec)
+    if not entries:
+        return jsonify({'error': 'ไม่พบไฟล์วิดีโอ', 'missing': missing[:50]}), 404
+
+    todo, skipped = [], 0
+    for entry in entries:
+        key = _safe_id_from_relpath(entry['relpath'])
+        if spec['skip_processed'] and not spec['force'] and _already_processed(key, entry):
+            skipped += 1
+            continue
+        todo.append((key, entry))
+    if spec['order'] == 'path':
+        todo.sort(key=lambda t: t[1]['relpath'].lower())
+    else:
+        todo.sort(key=lambda t: _entry_duration(t[1]) or t[1]['size'] * 8 / BATCH_ASSUMED_BPS,
+                  reverse=spec['order'] == 'longest')
+
+    video_folder = Path(app.config['VIDEO_FOLDER'])
+    try:
+        result = video_processor.queue.submit_many(
+            [(key, video_folder / entry['relpath'], _entry_duration(entry)) for key, entry in todo],
+            priority=spec['priority'], force=spec['force'])
+    except sqlite3.Error as e:
+        return jsonify({'error': str(e)}), 500
+    members = [(key, entry['relpath'], _entry_duration(entry)) for key, entry in todo if result[key] != 'queue_full']
+    rejected = [entry['relpath'] for key, entry in todo if result[key] == 'queue_full']
+
+    batch_id = uuid.uuid4().hex[:12]
+    video_processor.queue.store.create_batch(batch_id, spec, members, skipped, len(rejected))
+    submitted = collections.Counter(result.values())
+    print(f"[BATCH] {batch_id} - {len(members)} jobs ({submitted['created']} new), "
+          f"{skipped} skipped, {len(rejected)} rejected")
+    return jsonify({
+        'status': 'batch_started' if members else 'nothing_to_do',
+        'batch_id': batch_id,
+        'created': submitted['created'],
+        'already_queued': submitted['queued'] + submitted['processing'],
+        'skipped': skipped,
+        'rejected': rejected[:50],  # คิวเต็ม (TRANSCODE_QUEUE_LIMIT) -> ส่ง batch ใหม่ภายหลัง
+        'missing': missing[:50],
+        'summary': _batch_summary(batch_id),
+    }), 202 if members else 200
+
+@app.route('/api/batch/<batch_id>')
+def batch_status(batch_id):
+    """ความคืบหน้ารวม / throughput / ETA ของ batch"""
+    summary = _batch_summary(batch_id)
+    if summary is None:
+        return jsonify({'error': f'ไม่พบ batch {batch_id}'}), 404
+    return jsonify(summary)
 
-    threading.Thread(target=bg, daemon=True).start()
-    return jsonify({'status': 'processing_started', 'video_key': key, 'relpath': relpath})
+@app.route('/api/batch/<batch_id>/cancel', methods=['GET', 'POST'])
+def cancel_batch(batch_id):
+    """ยกเลิกทุกงานของ batch ที่ยังรอหรือกำลังแปลง"""
+    batch, jobs = video_processor.queue.store.batch(batch_id)
+    if batch is None:
+        return jsonify({'error': f'ไม่พบ batch {batch_id}'}), 404
+    cancelled = sum(video_processor.queue.cancel(j['key']) for j in jobs if j['state'] in ('queued', 'processing'))
+    return jsonify({'batch_id': batch_id, 'cancelled': cancelled})
+
+@app.route('/api/queue')
+def queue_summary():
+    return jsonify(video_processor.queue.summary())
+
+@app.route('/api/cache')
+def cache_summary():
+    """สถิติ cache (hit/miss/ขนาด)"""
+    return jsonify({
+        'hot': hot_cache.stats(),
+        'head_blocks': block_cache.stats(),
+        'jit_segments': segment_cache.stats(),
+        'renditions': rendition_cache.stats(),
+        'abr_sessions': adaptive.stats(),
+    })
+
+@app.route('/api/streams')
+def stream_summary():
+    """สถานะการจำกัด bandwidth (stream/client ที่ active, ส่วนแบ่งต่อ stream)"""
+    return jsonify(shaper.stats())
+
+def _cache_samples(field):
+    stats = {'hot': hot_cache.stats(), 'head_blocks': block_cache.stats(), 'jit_segments': segment_cache.stats(),
+             'renditions': rendition_cache.stats()}
+    return {(name,): s[field] for name, s in stats.items() if field in s}
+
+metrics.gauge('transcode_queue_jobs', 'งานในคิว (ทุก process) แยกตามสถานะ', ('state',),
+              fn=lambda: video_processor.queue.store.counts())
+metrics.gauge('transcode_running', 'งานที่กำลังแปลงใน process นี้',
+              fn=lambda: len(video_processor.queue._running))
+metrics.gauge('cache_bytes', 'ขนาดข้อมูลใน cache', ('cache',), fn=lambda: _cache_samples('bytes'))
+metrics.counter('cache_hits_total', 'cache hit', ('cache',), fn=lambda: _cache_samples('hits'))
+metrics.counter('cache_misses_total', 'cache miss', ('cache',), fn=lambda: _cache_samples('misses'))
+metrics.gauge('shaped_streams', 'stream ที่ถูกจำกัด bandwidth อยู่', fn=lambda: shaper.stats()['active_streams'])
+metrics.gauge('library_files', 'ไฟล์วิดีโอในดัชนี', fn=lambda: len(library.snapshot().files))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """metric ทั้งหมดของ process นี้ใน Prometheus text exposition format"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/api/status/<key>')
 def get_processing_status(key):
     """เช็คสถานะการประมวลผลตาม key (key = safe_id_from_relpath)"""
     status = video_processor.get_processing_status(key)
-    processed_dir = Path(app.config['PROCESSED_FOLDER']) / key
-    mp4_dir = processed_dir / 'mp4'
-    hls_dir = processed_dir / 'hls'
-    av_q = []
-    for q in ['480p', '720p', '1080p']:
-        if (mp4_dir / f"{q}.mp4").exists():
-            av_q.append(q)
+    hls_dir = Path(app.config['PROCESSED_FOLDER']) / key / 'hls'
     return jsonify({
         'key': key,
         'status': status,
-        'available_mp4_qualities': av_q,
-        'hls_ready': (hls_dir / 'master.m3u8').exists()
+        'available_mp4_qualities': _renditions(key),
+        'hls_ready': (hls_dir / 'master.m3u8').exists(),
+        'thumbnails': _thumbs_urls(key) or None,
+        'queue': video_processor.queue.describe(key)
     })
 
+SSE_KEEPALIVE_SECONDS = 15
+SSE_POLL_SECONDS = 1.0  # เช็ค DB ด้วย (งานที่รันใน process อื่นไม่ปลุก progress_hub ของเรา)
+SSE_MAX_SECONDS = 3600  # ปิด stream ที่เปิดนานเกินนี้ (EventSource ต่อใหม่เองตาม retry)
+
+@app.route('/api/events')
+def job_events():
+    """
+    Server-Sent Events: ส่ง progress ของงาน transcode แบบ live แทนการ poll /api/status
+    ?key=a&key=b = ติดตามเฉพาะงานนั้น (ปิด stream เมื่อทุกงานจบ), ไม่ระบุ = ทุกงานที่กำลังรัน
+    key ที่ไม่มีงาน -> แจ้งใน event: error แล้วไม่ติดตาม (ไม่มีเลยสักตัว -> 404)
+    """
+    keys = list(dict.fromkeys(k for k in request.args.getlist('key') if k))
+    store = video_processor.queue.store
+    terminal = ('completed', 'error', 'cancelled')
+    unknown = []
+    if keys:
+        known = {row['key'] for row in store.changed_since(0, keys)}
+        unknown = [k for k in keys if k not in known]
+        keys = [k for k in keys if k in known]
+        if not keys:
+            return jsonify({'error': 'ไม่พบงานของ key ที่ระบุ', 'unknown': unknown}), 404
+
+    def stream():
+        since = time.time()
+        sent = {}
+        version = -1
+        opened = last_write = time.monotonic()
+        yield 'retry: 3000\n\n'
+        if unknown:
+            yield f"event: error\ndata: {json.dumps({'unknown': unknown}, ensure_ascii=False)}\n\n"
+        while True:
+            if time.monotonic() - opened >= SSE_MAX_SECONDS:
+                yield 'event: timeout\ndata: {}\n\n'
+                return
+            version = progress_hub.wait(version, SSE_POLL_SECONDS)
+            out = []
+            for row in store.changed_since(since, keys):
+                sig = (row['state'], row['progress'])
+                if sent.get(row['key']) == sig:
+                    continue
+                sent[row['key']] = sig
+                data = {
+                    'key': row['key'],
+                    'state': row['state'],
+                    'progress': json.loads(row['progress']) if row['progress'] else None,
+                    'error': row['error'],
+                }
+                out.append(f"event: progress\ndata: {json.dumps(data, ensure_ascii=False)}\n\n")
+            if out:
+                last_write = time.monotonic()
+                yield ''.join(out)
+            elif time.monotonic() - last_write >= SSE_KEEPALIVE_SECONDS:
+                last_write = time.monotonic()
+                yield ': keepalive\n\n'
+            if keys and all(sent.get(k, ('',))[0] in terminal for k in keys):
+                yield 'event: done\ndata: {}\n\n'
+                return
+
+    resp = Response(stream(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # nginx: ห้าม buffer
+    return resp
+
 # ==============================
 # ERROR HANDLERS
 # ==============================
@@ -822,7 +4599,6 @@ if __name__ == '__main__':
     print("🎬 Video Streaming Server Starting...")
     print(f"📁 Video Folder: {app.config['VIDEO_FOLDER']}")
     print(f"⚙️ Processed Folder: {app.config['PROCESSED_FOLDER']}")
-    print("🌐 Server: http://localhost:5000")
 
     # เตือนหาก path เป็น Windows แต่ระบบไม่ใช่ Windows
     if platform.system().lower() != 'windows' and app.config['VIDEO_FOLDER'].startswith(('C:\\', 'D:\\')):
@@ -835,5 +4611,9 @@ if __name__ == '__main__':
     except Exception:
         print("❌ FFmpeg not found - กรุณาติดตั้ง FFmpeg")
 
-    # หลัง Apache แนะนำให้ bind loopback เท่านั้น
-    app.run(host='127.0.0.1', port=5000, debug=True, threaded=True)
+    # ใช้ตัวเปิด server ของ serve.py (uvicorn / waitress / gunicorn, ไม่ใช่ debug server ของ Flask)
+    # ค่าเริ่มต้นฟังที่ 127.0.0.1:5000 (หลัง Apache) -- python app.py --server waitress --port 8000 ฯลฯ
+    # ให้ asgi.py / serve.py ที่ import app ได้ module นี้ (ไม่โหลด app.py ซ้ำเป็นอีกชุด)
+    sys.modules.setdefault('app', sys.modules[__name__])
+    import serve
+    serve.main()
@@ -0,0 +1,199 @@
+# asgi.py
+"""
+โหมด ASGI (asyncio) สำหรับ endpoint สตรีมวิดีโอที่ผู้ชมเปิดค้างไว้นาน
+    /api/video/<filename>, /api/video_path/<relpath>, /hls/<video_key>/<subpath>, /thumbs/<video_key>/<name>
+
+- 1 stream = 1 coroutine ไม่ผูก OS thread ไว้ตลอดการดู -> รับ stream พร้อมกันได้หลายพันต่อ process
+- อ่านไฟล์ทีละ CHUNK_SIZE ใน thread pool ขนาดคงที่ (ASGI_IO_THREADS) ไม่บล็อก event loop
+- ตัดสิน Range / conditional ด้วยฟังก์ชันเดียวกับ Flask (_plan_file_response, _plan_hot_response)
+  -> header / status เหมือนกันทุกโหมด
+- route อื่นทั้งหมด และกรณีที่ไม่ใช่ทางปกติ (404/403, JIT HLS, X-Sendfile/X-Accel-Redirect)
+  ส่งต่อให้ Flask app เดิมผ่าน WsgiToAsgi (URL เดิมทั้งหมด)
+
+รัน:  python serve.py            (ดู serve.py)
+หรือ: uvicorn asgi:application --host 0.0.0.0 --port 5000
+ต้องมี: pip install uvicorn asgiref
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_cookie
+
+import app as webapp
+
+ASGI_IO_THREADS = int(os.environ.get('ASGI_IO_THREADS', '64'))  # thread อ่านไฟล์ (ไม่ใช่ต่อ stream)
+HLS_MAX_AGE = 600
+
+_io = ThreadPoolExecutor(max_workers=ASGI_IO_THREADS, thread_name_prefix='asgi-io')
+_wsgi = WsgiToAsgi(webapp.app)
+
+
+def _route(path: str, query: dict, headers, remote_addr, cookies):
+    """
+    path ของ request -> (ไฟล์ที่จะส่ง, max_age, ใช้ hot cache, ชื่อ endpoint ของ Flask สำหรับ metric,
+    _ResolvedFile จาก rendition_cache หรือ None, session ที่ต้องวัดความเร็วหรือ None) หรือ None = ให้ Flask จัดการ
+    """
+    quality = query.get('quality')
+    if path.startswith('/api/video_path/') or path.startswith('/api/video/'):
+        session = webapp._abr_session(headers, remote_addr, query, cookies, quality)
+        hint = webapp._downlink_hint(headers, query)
+        pace = webapp._pace_session(session, query, cookies)
+    if path.startswith('/api/video_path/'):
+        resolved = webapp._resolve_stream(path[len('/api/video_path/'):], quality, session, hint)
+        return (resolved.path, 3600, False, 'serve_video_by_path', resolved, pace) if resolved is not None else None
+    if path.startswith('/api/video/'):
+        filename = path[len('/api/video/'):]
+        if not filename or '/' in filename:
+            return None
+        resolved = webapp._resolve_legacy(filename, quality, session, hint)
+        return (resolved.path, 3600, False, 'serve_video_legacy', resolved, pace) if resolved is not None else None
+    if path.startswith('/hls/'):
+        video_key, _, subpath = path[len('/hls/'):].partition('/')
+        if not video_key or not subpath:
+            return None
+        target = webapp._hls_file(video_key, subpath)
+        return (target, HLS_MAX_AGE, True, 'serve_hls', None, None) if target is not None else None
+    if path.startswith('/thumbs/'):
+        video_key, _, name = path[len('/thumbs/'):].partition('/')
+        target = webapp._thumbs_file(video_key, name) if video_key and name else None
+        return (target, webapp.THUMBS_MAX_AGE, True, 'serve_thumbs', None, None) if target is not None else None
+    return None
+
+
+def _encode_headers(headers: dict):
+    out = [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()]
+    # ให้เหมือน flask_cors ของ app (CORS(app) = อนุญาตทุก origin)
+    out.append((b'access-control-allow-origin', b'*'))
+    return out
+
+
+async def _watch_disconnect(receive, gone: asyncio.Event):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            gone.set()
+            return
+
+
+async def _send_chunk(send, chunk, stream):
+    """ส่ง chunk ตามขีดจำกัดของ shaper (stream=None = ไม่จำกัด)"""
+    if stream is None:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        return
+    view = memoryview(chunk)
+    for i in range(0, len(view), webapp.SHAPING_SLICE):
+        piece = view[i:i + webapp.SHAPING_SLICE]
+        wait = stream.delay(len(piece))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await send({'type': 'http.response.body', 'body': bytes(piece), 'more_body': True})
+
+
+async def _send_plan(send, receive, path: Path, plan, head_only: bool, client: str, endpoint: str, pace_session=None):
+    loop = asyncio.get_running_loop()
+    await send({'type': 'http.response.start', 'status': plan.status, 'headers': _encode_headers(plan.headers)})
+    if head_only or not plan.parts:
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    webapp.active_streams.inc(1, endpoint)
+    gone = asyncio.Event()
+    watcher = asyncio.ensure_future(_watch_disconnect(receive, gone))
+    chunks = webapp._plan_iter(path, plan.parts)  # ใช้ block_cache ส่วนหัวไฟล์เหมือนโหมด WSGI
+    if pace_session:
+        chunks = webapp._measure_pace(chunks, pace_session)  # ?sid= (สุ่มตาม ABR_SAMPLE_INTERVAL): วัดความเร็วของ session
+    stream = webapp.shaper.open(client) if webapp.shaper.enabled else None
+    try:
+        while not gone.is_set():
+            chunk = await loop.run_in_executor(_io, next, chunks, None)
+            if chunk is None:
+                break
+            await _send_chunk(send, chunk, stream)
+        if not gone.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        webapp.active_streams.dec(1, endpoint)
+        if stream is not None:
+            stream.close()
+        await loop.run_in_executor(_io, chunks.close)
+
+
+async def _serve_file(scope, receive, send, headers, query, cookies, target: Path, max_age: int, hot: bool,
+                      endpoint: str, resolved=None, pace_session=None):
+    """-> False ถ้าต้องให้ Flask ตอบแทน"""
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    method = scope['method']
+    head_only = method == 'HEAD'
+    client = webapp._client_key(headers, (scope.get('client') or ('-',))[0], query, cookies)
+
+    if hot:
+        entry = await loop.run_in_executor(_io, webapp.hot_cache.get, target, max_age)
+        planned = webapp._plan_hot_response(entry, headers, method) if entry is not None else None
+        if planned is not None:
+            status, resp_headers, body = planned
+            webapp._observe_stream(endpoint, status, resp_headers, started)
+            await send({'type': 'http.response.start', 'status': status, 'headers': _encode_headers(resp_headers)})
+            if body and not head_only and webapp.shaper.enabled:
+                stream = webapp.shaper.open(client)
+                try:
+                    await _send_chunk(send, body, stream)
+                finally:
+                    stream.close()
+                body = b''
+            await send({'type': 'http.response.body', 'body': b'' if head_only else body})
+            return True
+
+    plan = await loop.run_in_executor(_io, webapp._plan_file_response, target, headers, method, max_age, resolved)
+    if plan is None:
+        return False
+    if plan.status in (200, 206) and webapp.app.config['STREAM_TRANSFER_MODE'] in ('x-accel-redirect', 'x-sendfile'):
+        return False  # ให้ Flask ตอบด้วย header offload ตามเดิม
+    webapp._observe_stream(endpoint, plan.status, plan.headers, started)
+    await _send_plan(send, receive, target, plan, head_only, client, endpoint, pace_session)
+    return True
+
+
+_started = False
+
+
+async def application(scope, receive, send):
+    global _started
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # เริ่มคิว transcode ตอนเปิด server -> งานที่ค้างจากการรันครั้งก่อนทำต่อโดยไม่ต้องรอ request แรก
+                await asyncio.get_running_loop().run_in_executor(_io, webapp.video_processor.queue.start)
+                _started = True
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                _io.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    if not _started:
+        # server ที่ไม่ส่ง lifespan: เริ่ม worker ของคิว transcode ตั้งแต่ request แรก (เหมือน before_request)
+        _started = True
+        webapp.video_processor.queue.start()
+
+    if scope['method'] in ('GET', 'HEAD'):
+        headers = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']])
+        query = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+        cookies = parse_cookie(headers.get('Cookie', ''))
+        routed = await asyncio.get_running_loop().run_in_executor(
+            _io, _route, scope['path'], query, headers, (scope.get('client') or ('-',))[0], cookies)
+        if routed is not None and await _serve_file(scope, receive, send, headers, query, cookies, *routed):
+            return
+
+    await _wsgi(scope, receive, send)
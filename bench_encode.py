@@ -0,0 +1,204 @@
+# bench_encode.py
+"""
+วัดความเร็ว / CPU / บิตเรต / คุณภาพ (SSIM, PSNR) ของการ encode ladder แต่ละแบบ
+เพื่อเลือก app.config['ENCODE_PROFILE'] (หรือ env ENCODE_PROFILE) ที่เหมาะกับเครื่องและเนื้อหาจริง
+
+ตัวอย่าง:
+    python bench_encode.py                                        (ทุกโปรไฟล์ใน ENCODE_PROFILES กับคลิปสังเคราะห์)
+    python bench_encode.py --profiles fast balanced --threads 0 4 8
+    python bench_encode.py --presets veryfast medium slow --rate-controls capped_crf abr
+    python bench_encode.py --clips D:\\video\\lecture.mp4 --seconds 60   (คลิปจริง ใช้แค่ N วินาทีแรก)
+
+- encode ด้วยคำสั่งเดียวกับ VideoProcessor (_plan_ladder + _build_ladder_cmd) -> ตัวเลขตรงกับงานจริง
+- คลิปสังเคราะห์จาก ffmpeg: testsrc2 (ภาพเคลื่อนไหวเรียบๆ) และ grain (testsrc2 + noise, encode ยาก)
+- คุณภาพของแต่ละ rendition วัดเทียบต้นฉบับที่ scale เป็นขนาดเดียวกัน (ยิ่งใกล้ 1 / ยิ่งสูงยิ่งดี)
+- ไฟล์ทั้งหมดอยู่ในโฟลเดอร์ชั่วคราว ไม่แตะโฟลเดอร์วิดีโอจริง
+- วัด CPU ได้เฉพาะบนระบบที่มีโมดูล resource (Linux/macOS)
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HERE = Path(__file__).resolve().parent
+
+SYNTHETIC = {
+    'testsrc2': 'testsrc2=size={size}:rate={rate}',
+    'grain': 'testsrc2=size={size}:rate={rate},noise=alls=25:allf=t+u',
+}
+
+
+def _make_clip(kind: str, out: Path, size: str, rate: int, seconds: int):
+    """คลิปสังเคราะห์คุณภาพสูง (ใช้เป็นต้นฉบับและ reference ของ SSIM/PSNR)"""
+    cmd = [
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', SYNTHETIC[kind].format(size=size, rate=rate),
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(seconds), '-pix_fmt', 'yuv420p',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '10',
+        '-c:a', 'aac', '-b:a', '192k', str(out),
+    ]
+    subprocess.run(cmd, check=True)
+
+
+def _cut_clip(src: Path, out: Path, seconds: int):
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-i', str(src), '-t', str(seconds),
+                    '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', str(out)], check=True)
+
+
+def _frame_rate(path: Path) -> float:
+    out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+                          'stream=avg_frame_rate', '-of', 'csv=p=0', str(path)],
+                         capture_output=True, text=True).stdout.strip()
+    num, _, den = out.partition('/')
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def _quality(encoded: Path, reference: Path, width: int, height: int):
+    """-> (ssim, psnr) ของ encoded เทียบ reference ที่ scale เป็น width x height"""
+    graph = (f"[1:v]scale={width}:{height}:flags=bicubic,setsar=1,split[r1][r2];"
+             f"[0:v]setsar=1,split[e1][e2];[e1][r1]ssim;[e2][r2]psnr")
+    p = subprocess.run(['ffmpeg', '-hide_banner', '-i', str(encoded), '-i', str(reference),
+                        '-lavfi', graph, '-f', 'null', '-'], capture_output=True, text=True)
+    ssim = re.search(r'SSIM .*All:([\d.]+)', p.stderr)
+    psnr = re.search(r'PSNR .*average:([\d.]+|inf)', p.stderr)
+    return (float(ssim.group(1)) if ssim else None,
+            float(psnr.group(1)) if psnr else None)
+
+
+def _cases(args, profiles):
+    """(ชื่อ, โปรไฟล์) ทุกชุดที่จะวัด: ชื่อใน ENCODE_PROFILES หรือ --presets x --rate-controls, คูณ --threads"""
+    if args.presets:
+        base = [(f"{preset}/{rc}", {'preset': preset, 'rate_control': rc, 'crf': args.crf})
+                for preset in args.presets for rc in args.rate_controls]
+    else:
+        base = [(name, dict(profiles[name])) for name in (args.profiles or profiles)]
+    return [(name, {**profile, 'threads': t}) for name, profile in base for t in args.threads]
+
+
+def run_case(vp, clip: Path, info, name, profile, out_dir: Path):
+    qualities = vp._plan_ladder(clip, info, allow_copy=False)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    cmd = vp._build_ladder_cmd(clip, out_dir, qualities, profile)
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    t0 = time.perf_counter()
+    ok = vp._run_ffmpeg(cmd, f"BENCH {clip.name} {name}")
+    wall = time.perf_counter() - t0
+    duration = info['duration']
+    row = {
+        'clip': clip.stem,
+        'profile': name,
+        'preset': profile['preset'],
+        'rate_control': profile['rate_control'],
+        'threads': profile['threads'] or vp.encode_threads,
+        'ok': ok,
+        'wall_s': wall,
+        'speed_x': duration / wall,
+        'fps': duration * _frame_rate(clip) / wall,
+    }
+    if before is not None:
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        row['cpu_s'] = cpu
+        row['cpu_s_per_min'] = cpu / (duration / 60)
+
+    renditions = {}
+    for q in qualities:
+        out = out_dir / f"{q['name']}.mp4.tmp"
+        if not ok or not out.exists():
+            continue
+        ssim, psnr = _quality(out, clip, q['width'], q['height'])
+        renditions[q['name']] = {
+            'kbps': round(out.stat().st_size * 8 / duration / 1000),
+            'target_kbps': int(q['video_bitrate'].rstrip('k')),
+            'ssim': ssim,
+            'psnr': psnr,
+        }
+        out.unlink()
+    row['renditions'] = renditions
+    return row
+
+
+def _print_row(row):
+    head = {k: v for k, v in row.items() if k != 'renditions'}
+    print('  '.join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in head.items()))
+    for name, r in row['renditions'].items():
+        ssim = f"{r['ssim']:.4f}" if r['ssim'] is not None else '-'
+        psnr = f"{r['psnr']:.2f}" if r['psnr'] is not None else '-'
+        print(f"    {name:>6}  total {r['kbps']:>6}k (video target {r['target_kbps']}k)  ssim={ssim}  psnr={psnr}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--profiles', nargs='+', help='ชื่อใน ENCODE_PROFILES (ค่าเริ่มต้น = ทั้งหมด)')
+    ap.add_argument('--presets', nargs='+', help='วัด libx264 preset เหล่านี้แทนโปรไฟล์ที่ตั้งชื่อไว้')
+    ap.add_argument('--rate-controls', nargs='+', default=['capped_crf', 'abr'],
+                    choices=['capped_crf', 'abr', 'crf'])
+    ap.add_argument('--crf', type=int, default=23, help='ใช้กับ --presets')
+    ap.add_argument('--threads', nargs='+', type=int, default=[0], help='0 = ตาม TRANSCODE_WORKERS')
+    ap.add_argument('--clips', nargs='+', type=Path, help='คลิปจริง (ไม่ระบุ = สร้างคลิปสังเคราะห์)')
+    ap.add_argument('--synthetic', nargs='+', default=list(SYNTHETIC), choices=list(SYNTHETIC))
+    ap.add_argument('--size', default='1920x1080', help='ขนาดคลิปสังเคราะห์')
+    ap.add_argument('--rate', type=int, default=30, help='fps ของคลิปสังเคราะห์')
+    ap.add_argument('--seconds', type=int, default=20)
+    ap.add_argument('--json', type=Path, help='บันทึกผลทั้งหมดเป็น JSON')
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        # ให้ app ใช้โฟลเดอร์ชั่วคราว (metadata/jobs DB) ก่อน import
+        os.environ['VIDEO_FOLDER'] = str(tmp / 'video')
+        os.environ['PROCESSED_FOLDER'] = str(tmp / 'processed')
+        (tmp / 'video').mkdir()
+        (tmp / 'processed').mkdir()
+        sys.path.insert(0, str(HERE))
+        import app as webapp
+        vp = webapp.video_processor
+
+        clips = []
+        for kind in ([] if args.clips else args.synthetic):
+            clip = tmp / 'video' / f"{kind}.mp4"
+            print(f"generating {kind} {args.size}@{args.rate} {args.seconds}s ...")
+            _make_clip(kind, clip, args.size, args.rate, args.seconds)
+            clips.append(clip)
+        for src in args.clips or []:
+            clip = tmp / 'video' / f"{src.stem}.mp4"
+            _cut_clip(src, clip, args.seconds)
+            clips.append(clip)
+
+        cases = _cases(args, webapp.ENCODE_PROFILES)
+        rows = []
+        for clip in clips:
+            info = vp.get_video_info(clip)
+            if not info:
+                print(f"skip {clip.name}: ffprobe failed")
+                continue
+            print(f"\nclip={clip.stem} {info['width']}x{info['height']} {info['duration']:.1f}s "
+                  f"cpu={os.cpu_count()} default_threads={vp.encode_threads}")
+            for name, profile in cases:
+                row = run_case(vp, clip, info, name, profile, tmp / 'processed' / 'bench')
+                _print_row(row)
+                rows.append(row)
+
+    if args.json:
+        args.json.write_text(json.dumps(rows, indent=2), encoding='utf-8')
+        print(f"\nsaved {args.json}")
+    print("\nเลือกโปรไฟล์: app.config['ENCODE_PROFILE'] = '<ชื่อ>' หรือ set ENCODE_PROFILE=<ชื่อ>")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# bench_stream.py
+"""
+เปรียบเทียบ throughput (MB/s) และ CPU ของ server ต่อ stream ระหว่างโหมดส่งไฟล์
+(STREAM_TRANSFER_MODE = generator / file_wrapper)
+
+ตัวอย่าง:
+    python bench_stream.py --size-mb 512 --streams 8
+    python bench_stream.py --server gunicorn --modes generator file_wrapper
+    python bench_stream.py --server uvicorn --modes generator --streams 200   (โหมด ASGI ใน asgi.py)
+
+- server รันเป็น process แยก (ไม่ปน CPU กับฝั่ง client) แล้ววัด CPU ของ process นั้นหลังปิด
+- ใช้ไฟล์ทดสอบชั่วคราว ไม่แตะโฟลเดอร์วิดีโอจริง
+- วัด CPU ได้เฉพาะบนระบบที่มีโมดูล resource (Linux/macOS)
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HERE = Path(__file__).resolve().parent
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(server: str, port: int):
+    """ส่วนที่รันใน process ลูก: เปิด app ด้วย server ที่เลือก"""
+    sys.path.insert(0, str(HERE))
+    from app import app
+
+    if server == 'uvicorn':
+        import uvicorn
+        uvicorn.run('asgi:application', host='127.0.0.1', port=port, app_dir=str(HERE), log_level='warning')
+        return
+    if server == 'gunicorn':
+        from gunicorn.app.base import BaseApplication
+
+        class _App(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'127.0.0.1:{port}')
+                self.cfg.set('workers', 1)
+                self.cfg.set('threads', 64)
+                self.cfg.set('worker_class', 'gthread')
+
+            def load(self):
+                return app
+
+        _App().run()
+    elif server == 'waitress':
+        from waitress import serve as waitress_serve
+        waitress_serve(app, host='127.0.0.1', port=port, threads=64)
+    else:
+        from werkzeug.serving import make_server
+        make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def _wait_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server did not start on port {port}')
+
+
+def _fetch(port, path, range_header, out):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    headers = {'Range': range_header} if range_header else {}
+    conn.request('GET', path, headers=headers)
+    resp = conn.getresponse()
+    n = 0
+    buf = bytearray(1024 * 1024)
+    while True:
+        got = resp.readinto(buf)
+        if not got:
+            break
+        n += got
+    conn.close()
+    out.append((resp.status, n))
+
+
+def run_mode(mode, args, video_dir, processed_dir, relpath, size):
+    port = _free_port()
+    env = dict(os.environ, VIDEO_FOLDER=str(video_dir), PROCESSED_FOLDER=str(processed_dir),
+               STREAM_TRANSFER_MODE=mode)
+    before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    proc = subprocess.Popen([sys.executable, __file__, '--serve', args.server, '--port', str(port)],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_port(port)
+        # request อุ่นเครื่อง (index, page cache)
+        _fetch(port, f'/api/video_path/{relpath}', 'bytes=0-1023', [])
+
+        results = []
+        range_header = f'bytes={args.range_start}-' if args.range_start else None
+        threads = [threading.Thread(target=_fetch, args=(port, f'/api/video_path/{relpath}', range_header, results))
+                   for _ in range(args.streams)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - t0
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    total = sum(n for _, n in results)
+    expected = (size - args.range_start) * args.streams
+    row = {
+        'mode': mode,
+        'streams': args.streams,
+        'statuses': sorted({s for s, _ in results}),
+        'ok': total == expected,
+        'MB/s': total / wall / 1e6,
+        'wall_s': wall,
+    }
+    if before is not None:
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        row['server_cpu_s'] = cpu
+        row['cpu_s_per_stream'] = cpu / args.streams
+        row['cpu_s_per_GB'] = cpu / (total / 1e9) if total else 0.0
+    return row
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--modes', nargs='+', default=['generator', 'file_wrapper'])
+    ap.add_argument('--server', default='werkzeug', choices=['werkzeug', 'gunicorn', 'waitress', 'uvicorn'])
+    ap.add_argument('--size-mb', type=int, default=256)
+    ap.add_argument('--streams', type=int, default=4)
+    ap.add_argument('--range-start', type=int, default=0, help='> 0 = ส่ง Range: bytes=N- (ทดสอบ 206)')
+    ap.add_argument('--serve', help=argparse.SUPPRESS)
+    ap.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        video_dir = Path(tmp) / 'video'
+        processed_dir = Path(tmp) / 'processed'
+        video_dir.mkdir()
+        processed_dir.mkdir()
+        sample = video_dir / 'bench.mp4'
+        size = args.size_mb * 1024 * 1024
+        with open(sample, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        print(f"server={args.server} file={args.size_mb}MB streams={args.streams} range_start={args.range_start}")
+        for mode in args.modes:
+            row = run_mode(mode, args, video_dir, processed_dir, sample.name, size)
+            print('  '.join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in row.items()))
+
+
+if __name__ == '__main__':
+    main()
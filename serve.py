@@ -0,0 +1,60 @@
+# serve.py
+"""
+ตัวเปิด server สำหรับใช้งานจริง (แทน app.run(debug=True) ของ Flask)
+
+    python serve.py                          # uvicorn + asgi.py (asyncio, stream พร้อมกันได้หลายพัน)
+    python serve.py --server waitress        # WSGI แบบ thread pool (Windows ใช้ได้ ไม่ต้องมี uvicorn)
+    python serve.py --server gunicorn        # WSGI + sendfile (Linux)
+    python serve.py --port 8000 --workers 2
+
+- ค่าเริ่มต้นฟังที่ 127.0.0.1 (ให้ Apache/nginx reverse proxy เข้ามา) เปลี่ยนด้วย --host
+- หลาย worker ใช้ได้: คิว transcode / metadata เก็บใน SQLite ที่แชร์กันระหว่าง process
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--server', default='uvicorn', choices=['uvicorn', 'waitress', 'gunicorn'])
+    ap.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    ap.add_argument('--port', type=int, default=int(os.environ.get('PORT', '5000')))
+    ap.add_argument('--workers', type=int, default=1, help='จำนวน process (uvicorn/gunicorn)')
+    ap.add_argument('--threads', type=int, default=64, help='thread ต่อ process (waitress/gunicorn)')
+    args = ap.parse_args()
+    sys.path.insert(0, str(HERE))
+
+    if args.server == 'uvicorn':
+        import uvicorn
+        uvicorn.run('asgi:application', host=args.host, port=args.port, workers=args.workers,
+                    app_dir=str(HERE), lifespan='on', log_level='warning', timeout_keep_alive=30)
+    elif args.server == 'waitress':
+        from waitress import serve
+        from app import app, video_processor
+        video_processor.queue.start()  # ทำงานที่ค้างจากการรันครั้งก่อนต่อทันที ไม่รอ request แรก
+        serve(app, host=args.host, port=args.port, threads=args.threads)
+    else:
+        from gunicorn.app.base import BaseApplication
+
+        class _App(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'{args.host}:{args.port}')
+                self.cfg.set('workers', args.workers)
+                self.cfg.set('threads', args.threads)
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('timeout', 0)  # stream ยาวๆ ไม่ให้ถูกฆ่า
+
+            def load(self):
+                from app import app, video_processor
+                video_processor.queue.start()  # ต่อ worker process (หลัง fork)
+                return app
+
+        _App().run()
+
+
+if __name__ == '__main__':
+    main()
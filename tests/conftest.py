@@ -0,0 +1,50 @@
+# tests/conftest.py
+# ให้ app ใช้โฟลเดอร์ชั่วคราว (metadata/jobs DB, ดัชนีไฟล์) ก่อน import ครั้งแรก
+import json
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+_tmp = Path(tempfile.mkdtemp(prefix='videostream-test-'))
+os.environ['VIDEO_FOLDER'] = str(_tmp / 'video')
+os.environ['PROCESSED_FOLDER'] = str(_tmp / 'processed')
+(_tmp / 'video').mkdir()
+(_tmp / 'processed').mkdir()
+sys.path.insert(0, str(ROOT))
+
+import app as webapp  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return webapp.app.test_client()
+
+
+@pytest.fixture
+def processed():
+    """ต้นฉบับใน VIDEO_FOLDER + manifest.json/mp4/ ใน PROCESSED_FOLDER -> make(relpath, renditions, sizes)"""
+    made = []
+
+    def make(relpath, renditions, sizes):
+        source = Path(webapp.app.config['VIDEO_FOLDER']) / relpath
+        source.parent.mkdir(parents=True, exist_ok=True)
+        source.write_bytes(b'\0' * sizes.pop('original'))
+        out = Path(webapp.app.config['PROCESSED_FOLDER']) / webapp._safe_id_from_relpath(relpath)
+        (out / 'mp4').mkdir(parents=True, exist_ok=True)
+        (out / 'manifest.json').write_text(json.dumps({'renditions': renditions}), encoding='utf-8')
+        for name, size in sizes.items():
+            (out / 'mp4' / f'{name}.mp4').write_bytes(b'\0' * size)
+        made.append((source, out))
+        webapp.rendition_cache.invalidate()
+        return source, out
+
+    yield make
+    for source, out in made:
+        source.unlink(missing_ok=True)
+        shutil.rmtree(out, ignore_errors=True)
+    webapp.rendition_cache.invalidate()
@@ -0,0 +1,106 @@
+# tests/test_abr.py
+import uuid
+from pathlib import Path
+
+import pytest
+from werkzeug.datastructures import Headers
+
+import app as webapp
+
+
+@pytest.fixture
+def clip():
+    name = f"abr-{uuid.uuid4().hex[:8]}.mp4"
+    path = Path(webapp.app.config['VIDEO_FOLDER']) / name
+    path.write_bytes(b'\0' * 1024)
+    yield name
+    path.unlink()
+
+
+@pytest.mark.parametrize('quality', ['</script><script>alert(1)</script>', '"; alert(1); "', '999p', ''])
+def test_player_rejects_unknown_quality(client, clip, quality):
+    resp = client.get(f'/player_path/{clip}', query_string={'quality': quality})
+    assert resp.status_code == 400
+    assert b'<script>alert' not in resp.data
+
+
+@pytest.mark.parametrize('quality', ['auto', '480p', 'source'])
+def test_player_embeds_quality_as_js_string(client, clip, quality):
+    resp = client.get(f'/player_path/{clip}', query_string={'quality': quality})
+    assert resp.status_code == 200
+    assert f'let current = "{quality}";' in resp.get_data(as_text=True)
+
+
+def test_pace_session_needs_sid(monkeypatch):
+    monkeypatch.setattr(webapp, 'adaptive', webapp.AdaptiveQuality(sample_interval=10))
+    headers = Headers()
+    session = webapp._abr_session(headers, '10.0.0.1', {}, {}, 'auto')
+    assert session == '10.0.0.1'  # quality=auto ยังได้ session (sticky rendition) ...
+    assert webapp._pace_session(session, {}, {}) is None  # ... แต่ไม่วัด -> sendfile
+    assert webapp._abr_session(headers, '10.0.0.1', {}, {}, '480p') is None
+
+
+def test_pace_session_samples_once_per_interval(monkeypatch):
+    monkeypatch.setattr(webapp, 'adaptive', webapp.AdaptiveQuality(sample_interval=10))
+    args = {'sid': 'tab1'}
+    session = webapp._abr_session(Headers(), '10.0.0.1', args, {}, 'auto')
+    assert session == 'sid:tab1'
+    assert webapp._pace_session(session, args, {}) == session
+    assert webapp._pace_session(session, args, {}) is None
+    assert webapp._pace_session('sid:tab2', {'sid': 'tab2'}, {}) == 'sid:tab2'
+    webapp.adaptive.sample_interval = 0
+    assert webapp._pace_session(session, args, {}) == session
+
+
+def test_ladder_is_cached_until_version_changes(monkeypatch):
+    version = [1]
+    cache = webapp.RenditionCache(10, lambda: version[0])
+    monkeypatch.setattr(webapp, 'rendition_cache', cache)
+    built = []
+
+    def ladder(key):
+        built.append(key)
+        return [{'name': '480p', 'bandwidth': 1_096_000}]
+
+    monkeypatch.setattr(webapp, '_rendition_ladder', ladder)
+    for _ in range(3):
+        assert webapp._cached_ladder('k')[0]['name'] == '480p'
+    assert built == ['k']
+    version[0] = 2
+    webapp._cached_ladder('k')
+    assert built == ['k', 'k']
+    cache.invalidate()
+    webapp._cached_ladder('k')
+    assert len(built) == 3
+    assert cache.stats()['ladder_hits'] == 2
+
+
+def test_auto_ladder_includes_original_source_rung(client, processed, monkeypatch):
+    monkeypatch.setattr(webapp, 'adaptive', webapp.AdaptiveQuality())
+    renditions = [
+        {'name': '480p', 'width': 854, 'height': 480, 'video_bitrate': '1000k', 'audio_bitrate': '96k', 'copy': False},
+        {'name': 'source', 'width': 1280, 'height': 720, 'video_bitrate': '5000k', 'audio_bitrate': '128k',
+         'copy': True, 'remux': False},
+    ]
+    processed('course/abr720.mp4', renditions, {'original': 7000, '480p': 2000})
+
+    data = client.get('/api/abr/course/abr720.mp4', query_string={'downlink': 50}).get_json()
+    assert [r['name'] for r in data['renditions']] == ['480p', 'source']
+    assert data['renditions'][1]['bandwidth'] == 5_128_000
+    assert data['quality'] == 'source'
+
+    resp = client.get('/api/video_path/course/abr720.mp4', query_string={'quality': 'auto', 'sid': 'fast', 'downlink': 50})
+    assert len(resp.data) == 7000  # source -> ไฟล์ต้นฉบับ
+    resp = client.get('/api/video_path/course/abr720.mp4', query_string={'quality': 'auto', 'sid': 'slow', 'downlink': 1})
+    assert len(resp.data) == 2000
+
+
+def test_unknown_source_bitrate_uses_nearest_ladder_rung():
+    rung = {'name': 'source', 'height': 720, 'video_bitrate': '0k', 'audio_bitrate': '128k', 'copy': True}
+    assert webapp._rung_bandwidth(rung) == (2500 + 128) * 1000
+
+
+def test_unmeasured_session_falls_back_to_source_at_720p():
+    ladder = [{'name': '480p', 'bandwidth': 1_096_000, 'height': 480},
+              {'name': 'source', 'bandwidth': 5_128_000, 'height': 720}]
+    assert webapp.AdaptiveQuality().recommend(ladder, None) == 'source'
@@ -0,0 +1,24 @@
+# tests/test_batch.py
+import app as webapp
+
+
+def test_cancel_unknown_batch_is_404(client):
+    assert client.post('/api/batch/nope/cancel').status_code == 404
+
+
+def test_cancel_batch_with_no_jobs_is_ok(client):
+    # ทุกไฟล์ถูกข้าม (nothing_to_do) -> batch มีอยู่แต่ไม่มีงาน
+    webapp.video_processor.queue.store.create_batch('emptybatch', {'order': 'path'}, [], 3, 0)
+    resp = client.post('/api/batch/emptybatch/cancel')
+    assert resp.status_code == 200
+    assert resp.get_json() == {'batch_id': 'emptybatch', 'cancelled': 0}
+    assert client.get('/api/batch/emptybatch').status_code == 200
+
+
+def test_bad_priority_is_400_with_readable_message(client):
+    for priority in ('abc', 1.5, True):
+        resp = client.post('/api/batch', json={'prefix': '', 'priority': priority})
+        assert resp.status_code == 400
+        assert resp.get_json() == {'error': 'priority must be an integer'}
+    resp = client.get('/api/batch', query_string={'priority': 'x'})
+    assert resp.get_json() == {'error': 'priority must be an integer'}
@@ -0,0 +1,26 @@
+# tests/test_browse.py
+from pathlib import Path
+
+import pytest
+
+import app as webapp
+
+
+@pytest.fixture(scope='module', autouse=True)
+def folders():
+    (Path(webapp.app.config['VIDEO_FOLDER']) / 'browse-sub' / 'inner').mkdir(parents=True, exist_ok=True)
+
+
+@pytest.mark.parametrize('path, cwd, parent', [
+    ('', '', None),
+    ('browse-sub', 'browse-sub', '.'),       # ชั้นแรก: parent ต้องเป็นค่า truthy ให้ปุ่ม Up ใช้ได้
+    ('browse-sub/inner', 'browse-sub/inner', 'browse-sub'),
+    ('.', '', None),
+])
+def test_browse_parent(client, path, cwd, parent):
+    data = client.get('/api/browse', query_string={'path': path}).get_json()
+    assert (data['cwd'], data['parent']) == (cwd, parent)
+
+
+def test_browse_traversal_is_403(client):
+    assert client.get('/api/browse', query_string={'path': '../..'}).status_code == 403
@@ -0,0 +1,32 @@
+# tests/test_events.py
+import app as webapp
+
+
+def test_events_unknown_key_is_404(client):
+    resp = client.get('/api/events', query_string={'key': 'no-such-job'})
+    assert resp.status_code == 404
+    assert resp.get_json()['unknown'] == ['no-such-job']
+
+
+def test_events_reports_unknown_and_ends_when_known_jobs_finish(client, tmp_path):
+    store = webapp.video_processor.queue.store
+    store.submit('events-test', tmp_path / 'x.mp4', True, False, 0, None, 1000)
+    store.cancel('events-test')
+
+    resp = client.get('/api/events', query_string={'key': ['events-test', 'no-such-job']})
+    assert resp.status_code == 200
+    body = resp.get_data(as_text=True)  # stream จบเอง (งานที่รู้จักจบแล้วทั้งหมด)
+    assert 'event: error\ndata: {"unknown": ["no-such-job"]}' in body
+    assert '"key": "events-test"' in body
+    assert body.rstrip().endswith('event: done\ndata: {}')
+
+
+def test_events_stream_has_lifetime_cap(client, tmp_path, monkeypatch):
+    store = webapp.video_processor.queue.store
+    store.submit('events-cap', tmp_path / 'y.mp4', True, False, -10**9, None, 1000)
+    monkeypatch.setattr(webapp, 'SSE_MAX_SECONDS', 0)
+    try:
+        body = client.get('/api/events', query_string={'key': 'events-cap'}).get_data(as_text=True)
+        assert body.rstrip().endswith('event: timeout\ndata: {}')
+    finally:
+        store.cancel('events-cap')
@@ -0,0 +1,124 @@
+# tests/test_hls_playlist.py
+from pathlib import Path
+
+import pytest
+
+import app as webapp
+
+INIT = 800
+
+
+def _playlist(durations, sizes=None, uri='media.mp4', offsets=None):
+    """playlist แบบที่ ffmpeg -hls_flags single_file เขียน (ตัดทุก part)"""
+    sizes = sizes or [1000] * len(durations)
+    lines = ['#EXTM3U', '#EXT-X-VERSION:7', f'#EXT-X-TARGETDURATION:{max(int(d + 0.999) for d in durations)}',
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD',
+             f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{INIT}@0"']
+    offset = INIT
+    for i, (dur, size) in enumerate(zip(durations, sizes)):
+        if offsets is not None:
+            offset = offsets[i]
+        lines += [f'#EXTINF:{dur:.6f},', f'#EXT-X-BYTERANGE:{size}@{offset}',
+                  uri if isinstance(uri, str) else uri[i]]
+        offset += size
+    return '\n'.join(lines + ['#EXT-X-ENDLIST']) + '\n'
+
+
+def _segments(text):
+    _, refs = webapp._media_refs(text)
+    durations = [float(line[len('#EXTINF:'):].rstrip(',')) for line in text.splitlines() if line.startswith('#EXTINF:')]
+    return [(round(d, 3), uri, rng) for d, (uri, rng) in zip(durations, refs)]
+
+
+def _target(text):
+    return next(int(line.split(':')[1]) for line in text.splitlines() if line.startswith('#EXT-X-TARGETDURATION:'))
+
+
+def test_startup_parts_kept_then_merged_to_segment_length():
+    text = webapp._merge_byterange_playlist(_playlist([2.0] * 10), 6, 2)
+    assert _segments(text) == [
+        (2.0, 'media.mp4', (800, 1000)),
+        (2.0, 'media.mp4', (1800, 1000)),
+        (6.0, 'media.mp4', (2800, 3000)),
+        (6.0, 'media.mp4', (5800, 3000)),
+        (4.0, 'media.mp4', (8800, 2000)),
+    ]
+    assert _target(text) == 6
+
+
+def test_header_init_and_endlist_are_preserved():
+    text = webapp._merge_byterange_playlist(_playlist([2.0] * 5), 6, 2)
+    lines = text.splitlines()
+    assert lines[:6] == ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-TARGETDURATION:6', '#EXT-X-MEDIA-SEQUENCE:0',
+                         '#EXT-X-PLAYLIST-TYPE:VOD', f'#EXT-X-MAP:URI="media.mp4",BYTERANGE="{INIT}@0"']
+    assert lines[-1] == '#EXT-X-ENDLIST'
+    init, _ = webapp._media_refs(text)
+    assert init == ('media.mp4', (0, INIT))
+
+
+def test_irregular_parts_do_not_exceed_segment_length():
+    # keyframe ไม่ตรงทุก 2 วินาที -> รวมได้ไม่เกิน segment_seconds + 0.5
+    text = webapp._merge_byterange_playlist(_playlist([2.0, 2.0, 2.4, 2.4, 2.4, 1.0]), 6, 2)
+    assert [d for d, _, _ in _segments(text)] == [2.0, 2.0, 4.8, 3.4]
+    assert _target(text) == 5
+
+
+def test_target_duration_rounds_up():
+    text = webapp._merge_byterange_playlist(_playlist([2.0, 2.0, 2.0, 2.0, 2.2]), 6, 2)
+    assert [d for d, _, _ in _segments(text)] == [2.0, 2.0, 6.2]
+    assert _target(text) == 7
+
+
+def test_non_contiguous_ranges_are_not_merged():
+    offsets = [800, 1800, 2800, 5000, 6000]
+    text = webapp._merge_byterange_playlist(_playlist([2.0] * 5, offsets=offsets), 6, 2)
+    assert _segments(text) == [
+        (2.0, 'media.mp4', (800, 1000)),
+        (2.0, 'media.mp4', (1800, 1000)),
+        (2.0, 'media.mp4', (2800, 1000)),
+        (4.0, 'media.mp4', (5000, 2000)),
+    ]
+
+
+def test_different_files_are_not_merged():
+    uris = ['a.mp4', 'a.mp4', 'a.mp4', 'b.mp4', 'b.mp4']
+    text = webapp._merge_byterange_playlist(_playlist([2.0] * 5, uri=uris, offsets=[0, 1000, 2000, 3000, 4000]), 6, 2)
+    assert [(d, u) for d, u, _ in _segments(text)] == [(2.0, 'a.mp4'), (2.0, 'a.mp4'), (2.0, 'a.mp4'), (4.0, 'b.mp4')]
+
+
+@pytest.mark.parametrize('startup', [0, 3])
+def test_startup_parts_count(startup):
+    text = webapp._merge_byterange_playlist(_playlist([2.0] * 9), 6, startup)
+    durations = [d for d, _, _ in _segments(text)]
+    assert durations[:startup] == [2.0] * startup
+    assert sum(durations) == pytest.approx(18.0)
+    assert sum(rng[1] for _, _, rng in _segments(text)) == 9000
+
+
+def test_media_refs_offsetless_byterange_follows_previous():
+    text = '\n'.join(['#EXTM3U', '#EXTINF:2.0,', '#EXT-X-BYTERANGE:100@50', 'a.mp4',
+                      '#EXTINF:2.0,', '#EXT-X-BYTERANGE:200', 'a.mp4', '#EXTINF:2.0,', 'seg2.ts'])
+    assert webapp._media_refs(text) == (None, [('a.mp4', (50, 100)), ('a.mp4', (150, 200)), ('seg2.ts', None)])
+
+
+def _hls_dir(key, variant_playlist, files):
+    base = Path(webapp.app.config['PROCESSED_FOLDER']) / key / 'hls'
+    (base / '480p').mkdir(parents=True, exist_ok=True)
+    (base / 'master.m3u8').write_text('#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1096000\n480p/index.m3u8\n')
+    (base / '480p' / 'index.m3u8').write_text(variant_playlist)
+    for name in files:
+        (base / '480p' / name).write_bytes(b'\0' * 16)
+
+
+def test_startup_preload_only_for_split_files():
+    _hls_dir('startup-single', _playlist([2.0] * 4), ['media.mp4'])
+    startup = webapp._hls_startup('startup-single')
+    assert startup['preload'] == []  # byte-range: Link preload ใส่ Range ไม่ได้
+    assert '/hls/startup-single/480p/index.m3u8' in startup['inline']
+
+    split = '\n'.join(['#EXTM3U', '#EXT-X-MAP:URI="init.mp4"', '#EXTINF:2.0,', 'seg0.m4s', '#EXTINF:2.0,', 'seg1.m4s',
+                       '#EXTINF:2.0,', 'seg2.m4s', '#EXT-X-ENDLIST'])
+    _hls_dir('startup-split', split, ['init.mp4', 'seg0.m4s', 'seg1.m4s', 'seg2.m4s'])
+    startup = webapp._hls_startup('startup-split')
+    assert startup['preload'] == ['/hls/startup-split/480p/init.mp4', '/hls/startup-split/480p/seg0.m4s',
+                                  '/hls/startup-split/480p/seg1.m4s']
@@ -0,0 +1,49 @@
+# tests/test_jobs.py
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import pytest
+
+import app as webapp
+
+NODE = platform.node()
+OWNER = f"{NODE}:{os.getpid()}"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return webapp.JobStore(tmp_path / 'jobs.sqlite3', stale_seconds=60)
+
+
+def _processing(store, key, owner, heartbeat_age=0.0):
+    store.submit(key, f'/v/{key}.mp4', True, False, 0, None, 1000)
+    with webapp.contextlib.closing(store._connect()) as db:
+        db.execute("UPDATE jobs SET state = 'processing', owner = ?, heartbeat = ? WHERE key = ?",
+                   (owner, time.time() - heartbeat_age, key))
+
+
+def _dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def test_requeue_stale_and_own_owner(store):
+    _processing(store, 'stale', 'otherhost:1', heartbeat_age=120)
+    _processing(store, 'alive', 'otherhost:1', heartbeat_age=1)
+    _processing(store, 'mine', OWNER, heartbeat_age=1)  # pid เดิมหลังรีสตาร์ต (เช่น container)
+    assert sorted(store.requeue_interrupted(OWNER)) == ['mine', 'stale']
+    assert store.get('stale')['state'] == 'queued' and store.get('stale')['owner'] is None
+    assert store.get('alive')['state'] == 'processing'
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='ตรวจ pid ไม่ได้บน Windows')
+def test_requeue_dead_local_process_without_waiting_for_heartbeat(store):
+    _processing(store, 'dead', f"{NODE}:{_dead_pid()}", heartbeat_age=1)
+    _processing(store, 'live', f"{NODE}:{os.getppid()}", heartbeat_age=1)
+    assert store.requeue_interrupted(OWNER) == ['dead']
+    assert store.get('live')['state'] == 'processing'
+
@@ -0,0 +1,101 @@
+# tests/test_ladder.py
+import pytest
+
+import app as webapp
+
+
+@pytest.fixture
+def vp():
+    return webapp.video_processor
+
+
+@pytest.fixture
+def src(tmp_path):
+    # ไฟล์ที่ไม่ใช่ MP4 จริง: _mp4_faststart -> None -> source ต้อง remux
+    path = tmp_path / 'src.mp4'
+    path.write_bytes(b'\0' * 64)
+    return path
+
+
+def _info(width, height, kbps, codec='h264', pix_fmt='yuv420p', audio='aac'):
+    return {'width': width, 'height': height, 'video_bitrate': kbps * 1000, 'video_codec': codec,
+            'pix_fmt': pix_fmt, 'audio_codec': audio, 'format_name': 'mov,mp4,m4a,3gp,3g2,mj2'}
+
+
+def _names(plan):
+    return [r['name'] for r in plan]
+
+
+def test_unprobed_source_gets_full_16x9_ladder(vp, src):
+    plan = vp._plan_ladder(src, None)
+    assert _names(plan) == ['480p', '720p', '1080p']
+    assert [r['width'] for r in plan] == [854, 1280, 1920]
+    assert not any(r['copy'] for r in plan)
+
+
+def test_no_upscale_and_source_copy_replaces_same_height(vp, src):
+    plan = vp._plan_ladder(src, _info(1280, 720, 5000))
+    assert _names(plan) == ['480p', 'source']
+    source = plan[-1]
+    assert source['copy'] and source['remux']
+    assert (source['width'], source['height']) == (1280, 720)
+
+
+def test_non_web_codec_is_encoded_without_source(vp, src):
+    plan = vp._plan_ladder(src, _info(1920, 1080, 8000, codec='hevc'))
+    assert _names(plan) == ['480p', '720p', '1080p']
+    assert not any(r['copy'] for r in plan)
+
+
+def test_allow_copy_false_encodes_every_rung(vp, src):
+    plan = vp._plan_ladder(src, _info(1920, 1080, 8000), allow_copy=False)
+    assert _names(plan) == ['480p', '720p', '1080p']
+
+
+def test_low_bitrate_source_caps_first_starved_rung(vp, src):
+    plan = vp._plan_ladder(src, _info(1920, 1080, 1800, codec='hevc'))
+    assert _names(plan) == ['480p', '720p']
+    assert plan[1]['video_bitrate'] == '1800k'
+
+
+def test_low_bitrate_with_source_copy_stops_before_starved_rung(vp, src):
+    plan = vp._plan_ladder(src, _info(1920, 1080, 1800))
+    assert _names(plan) == ['480p', 'source']
+
+
+def test_tiny_source_gets_single_rung_at_source_height(vp, src):
+    plan = vp._plan_ladder(src, _info(320, 240, 400, codec='mpeg4'))
+    assert _names(plan) == ['240p']
+    rung = plan[0]
+    assert (rung['width'], rung['height'], rung['video_bitrate']) == (320, 240, '400k')
+
+
+def test_width_follows_source_aspect_ratio(vp, src):
+    plan = vp._plan_ladder(src, _info(1920, 800, 8000, codec='hevc'))
+    assert [(r['width'], r['height']) for r in plan] == [(1152, 480), (1728, 720)]
+
+
+def test_folder_ladder_longest_match_wins(vp, monkeypatch):
+    folder = webapp.video_processor.video_folder / 'lectures' / 'math'
+    folder.mkdir(parents=True, exist_ok=True)
+    clip = folder / 'a.mp4'
+    clip.write_bytes(b'\0' * 64)
+    monkeypatch.setitem(webapp.app.config, 'RENDITION_LADDERS',
+                        {'lectures': ['480p'], 'lectures/math': ['480p', '720p']})
+    plan = vp._plan_ladder(clip, _info(1920, 1080, 8000, codec='hevc'))
+    assert _names(plan) == ['480p', '720p']
+
+
+@pytest.mark.parametrize('encode', [None, {'name': 'source', 'height': 720, 'video_bitrate': '0k',
+                                           'audio_bitrate': '128k', 'copy': True}])
+def test_package_hls_encodes_copy_rung_with_forced_keyframes(vp, src, tmp_path, monkeypatch, encode):
+    cmds = []
+    monkeypatch.setattr(vp, '_run_ffmpeg', lambda cmd, *a, **kw: cmds.append(cmd) or False)
+    assert vp._package_hls(src, tmp_path / 'hls' / 'source', encode=encode) is False
+    cmd = cmds[0]
+    if encode is None:
+        assert cmd[cmd.index('-map') + 1:cmd.index('-map') + 4] == ['0', '-c', 'copy']
+        assert '-force_key_frames' not in cmd
+    else:
+        assert cmd[cmd.index('-force_key_frames') + 1] == f'expr:gte(t,n_forced*{webapp.HLS_PART_SECONDS})'
+        assert cmd[cmd.index('-maxrate') + 1] == '2500k'  # บิตเรตต้นฉบับไม่รู้ -> rung 720p
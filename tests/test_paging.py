@@ -0,0 +1,103 @@
+# tests/test_paging.py
+import base64
+import json
+
+import pytest
+
+import app as webapp
+
+KEYS = [(1.0, 'a.mp4'), (2.0, 'b.mp4'), (2.0, 'c.mp4'), (3.0, 'd.mp4'), (5.0, 'e.mp4')]
+
+
+def _token(parts) -> str:
+    raw = json.dumps(parts).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def test_keyset_first_page_and_next_key():
+    rels, last = webapp._keyset_page(KEYS, None, 2)
+    assert rels == ['a.mp4', 'b.mp4']
+    assert last == (2.0, 'b.mp4')
+
+
+def test_keyset_walks_all_pages_without_gaps_or_duplicates():
+    seen, after = [], None
+    while True:
+        rels, after = webapp._keyset_page(KEYS, after, 2)
+        seen += rels
+        if after is None:
+            break
+    assert seen == [k[1] for k in KEYS]
+
+
+def test_keyset_descending():
+    rels, last = webapp._keyset_page(KEYS, None, 2, descending=True)
+    assert rels == ['e.mp4', 'd.mp4']
+    rels, last = webapp._keyset_page(KEYS, last, 2, descending=True)
+    assert rels == ['c.mp4', 'b.mp4']
+    rels, last = webapp._keyset_page(KEYS, last, 2, descending=True)
+    assert (rels, last) == (['a.mp4'], None)
+
+
+def test_keyset_filter_skips_rejected_and_exact_last_page():
+    rels, last = webapp._keyset_page(KEYS, None, 2, accept=lambda r: r != 'b.mp4')
+    assert rels == ['a.mp4', 'c.mp4']
+    rels, last = webapp._keyset_page(KEYS, last, 2, accept=lambda r: r != 'b.mp4')
+    assert (rels, last) == (['d.mp4', 'e.mp4'], None)
+
+
+def test_keyset_cursor_after_removed_key_continues_in_order():
+    rels, _ = webapp._keyset_page(KEYS, (2.5, 'gone.mp4'), 10)
+    assert rels == ['d.mp4', 'e.mp4']
+
+
+def test_cursor_round_trip():
+    token = webapp._encode_cursor('created', 'desc', 12.5, 'a/b.mp4')
+    assert webapp._decode_cursor(token, str, str, webapp._NUMBER, str) == ['created', 'desc', 12.5, 'a/b.mp4']
+
+
+@pytest.mark.parametrize('token', [
+    'not base64 !!',
+    _token({'a': 1}),
+    _token(['', 'a.mp4']),
+    _token(['', None, 'a.mp4']),
+    _token(['', ['x'], 'a.mp4']),
+    _token(['', 'a.mp4', 1]),
+    _token(['', True, 'a.mp4']),
+])
+def test_decode_cursor_rejects_bad_shape_and_types(token):
+    with pytest.raises(ValueError):
+        webapp._decode_cursor(token, str, str, str)
+
+
+@pytest.mark.parametrize('parts', [['', None, 'a.mp4'], ['', ['x'], 'a.mp4'], ['', 'a.mp4', 1], ['', 'a.mp4']])
+def test_browse_bad_cursor_is_400(client, parts):
+    resp = client.get('/api/browse', query_string={'cursor': _token(parts)})
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize('sort', list(webapp.LibraryIndex.SORT_FIELDS))
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+@pytest.mark.parametrize('value', [None, ['x'], 'a.mp4', 1.5, True])
+def test_videos_cursor_type_mismatch_is_400(client, sort, order, value):
+    expected = webapp._CURSOR_VALUE_TYPES[sort]
+    if value is not True and isinstance(value, expected):
+        pytest.skip('well-typed cursor')
+    token = _token([sort, order, value, 'a.mp4'])
+    resp = client.get('/api/videos', query_string={'sort': sort, 'order': order, 'cursor': token})
+    assert resp.status_code == 400
+
+
+def test_videos_well_typed_cursor_is_accepted(client):
+    token = _token(['size', 'asc', 10, 'a.mp4'])
+    resp = client.get('/api/videos', query_string={'sort': 'size', 'order': 'asc', 'cursor': token})
+    assert resp.status_code == 200
+
+
+@pytest.mark.parametrize('url', ['/api/browse', '/api/videos'])
+@pytest.mark.parametrize('limit, message', [('abc', 'limit must be an integer'), ('1.5', 'limit must be an integer'),
+                                            ('0', 'limit must be >= 1')])
+def test_bad_limit_is_400_with_readable_message(client, url, limit, message):
+    resp = client.get(url, query_string={'limit': limit})
+    assert resp.status_code == 400
+    assert resp.get_json() == {'error': message}
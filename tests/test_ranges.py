@@ -0,0 +1,167 @@
+# tests/test_ranges.py
+import os
+
+import pytest
+from werkzeug.datastructures import Headers
+from werkzeug.http import http_date
+
+import app as webapp
+
+ETAG = '"10-abc"'
+MTIME = 1_700_000_000.0
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=100-', [(100, 999)]),
+    ('bytes=-100', [(900, 999)]),
+    ('bytes=-5000', [(0, 999)]),
+    ('bytes=500-5000', [(500, 999)]),
+    ('bytes=0-9, 20-29', [(0, 9), (20, 29)]),
+    ('bytes=20-29,0-9', [(0, 9), (20, 29)]),
+    ('bytes=0-9,10-19,5-12', [(0, 19)]),       # ซ้อน/ติดกัน -> รวม
+    (' BYTES = 0-0 ', [(0, 0)]),
+    ('bytes=1000-', []),                        # เริ่มเลยท้ายไฟล์ -> 416
+    ('bytes=-0', []),
+    ('bytes=1000-1001, 2000-', []),
+    ('bytes=0-0,1000-', [(0, 0)]),              # ช่วงที่ใช้ไม่ได้ถูกข้าม
+])
+def test_parse_range(header, expected):
+    assert webapp._parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', [
+    'items=0-10', 'bytes=', 'bytes=abc', 'bytes=5-1', 'bytes=-', 'bytes=0-1-2', 'bytes=1',
+    'bytes=' + ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(webapp.MAX_RANGES + 1)),
+])
+def test_parse_range_unusable_is_none(header):
+    assert webapp._parse_range(header, 1000) is None
+
+
+def test_parse_range_empty_file():
+    assert webapp._parse_range('bytes=-10', 0) == []
+    assert webapp._parse_range('bytes=0-', 0) == []
+
+
+def _h(**kw):
+    return Headers({k.replace('_', '-'): v for k, v in kw.items()})
+
+
+@pytest.mark.parametrize('headers, method, expected', [
+    (_h(), 'GET', None),
+    (_h(If_None_Match=ETAG), 'GET', 304),
+    (_h(If_None_Match='W/"10-abc"'), 'GET', 304),          # If-None-Match เทียบแบบ weak
+    (_h(If_None_Match='*'), 'HEAD', 304),
+    (_h(If_None_Match=ETAG), 'POST', 412),
+    (_h(If_None_Match='"other"'), 'GET', None),
+    (_h(If_Match=ETAG), 'GET', None),
+    (_h(If_Match='"other"'), 'GET', 412),
+    (_h(If_Match='W/"10-abc"'), 'GET', 412),                # If-Match เทียบแบบ strong
+    (_h(If_Unmodified_Since=http_date(MTIME - 10)), 'GET', 412),
+    (_h(If_Unmodified_Since=http_date(MTIME)), 'GET', None),
+    (_h(If_Modified_Since=http_date(MTIME)), 'GET', 304),
+    (_h(If_Modified_Since=http_date(MTIME - 10)), 'GET', None),
+    (_h(If_Modified_Since=http_date(MTIME)), 'POST', None),
+    # If-Match มาก่อน -> ไม่ดู If-Unmodified-Since
+    (_h(If_Match=ETAG, If_Unmodified_Since=http_date(MTIME - 10)), 'GET', None),
+    # If-None-Match มี -> ไม่ดู If-Modified-Since
+    (_h(If_None_Match='"other"', If_Modified_Since=http_date(MTIME)), 'GET', None),
+    (_h(If_Match='"other"', If_None_Match=ETAG), 'GET', 412),
+])
+def test_precondition_status(headers, method, expected):
+    assert webapp._precondition_status(headers, method, ETAG, MTIME) == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    (ETAG, True),
+    ('"other"', False),
+    ('W/"10-abc"', False),
+    (http_date(MTIME), True),
+    (http_date(MTIME - 1), False),
+    ('garbage', False),
+])
+def test_if_range(value, expected):
+    assert webapp._if_range_matches(value, ETAG, MTIME) is expected
+
+
+def test_select_ranges_if_range_mismatch_sends_whole_file():
+    headers = _h(Range='bytes=0-9', If_Range='"other"')
+    assert webapp._select_ranges(headers, 100, ETAG, MTIME) is None
+    headers = _h(Range='bytes=0-9', If_Range=ETAG)
+    assert webapp._select_ranges(headers, 100, ETAG, MTIME) == [(0, 9)]
+
+
+@pytest.fixture
+def media(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    data = os.urandom(1000)
+    path.write_bytes(data)
+    return path, data
+
+
+def _body(path, plan):
+    return b''.join(webapp._plan_iter(path, plan.parts))
+
+
+def test_plan_full_file(media):
+    path, data = media
+    plan = webapp._plan_file_response(path, _h(), 'GET', max_age=60)
+    assert plan.status == 200
+    assert plan.headers['Content-Length'] == '1000'
+    assert plan.headers['Content-Type'] == 'video/mp4'
+    assert plan.headers['Accept-Ranges'] == 'bytes'
+    assert plan.headers['Cache-Control'] == 'public, max-age=60'
+    assert _body(path, plan) == data
+
+
+def test_plan_single_range(media):
+    path, data = media
+    plan = webapp._plan_file_response(path, _h(Range='bytes=-100'), 'GET')
+    assert plan.status == 206
+    assert plan.headers['Content-Range'] == 'bytes 900-999/1000'
+    assert plan.headers['Content-Length'] == '100'
+    assert _body(path, plan) == data[900:]
+
+
+def test_plan_multipart(media):
+    path, data = media
+    plan = webapp._plan_file_response(path, _h(Range='bytes=0-9,500-509'), 'GET')
+    assert plan.status == 206
+    ctype = plan.headers['Content-Type']
+    assert ctype.startswith('multipart/byteranges; boundary=')
+    boundary = ctype.split('boundary=')[1]
+    body = _body(path, plan)
+    assert len(body) == int(plan.headers['Content-Length'])
+    assert body.endswith(f'\r\n--{boundary}--\r\n'.encode())
+    assert b'Content-Range: bytes 0-9/1000\r\n\r\n' + data[:10] in body
+    assert b'Content-Range: bytes 500-509/1000\r\n\r\n' + data[500:510] in body
+
+
+def test_plan_unsatisfiable(media):
+    path, _ = media
+    plan = webapp._plan_file_response(path, _h(Range='bytes=5000-'), 'GET')
+    assert plan.status == 416
+    assert plan.headers['Content-Range'] == 'bytes */1000'
+    assert plan.parts == []
+
+
+def test_plan_not_modified_and_precondition_failed(media):
+    path, _ = media
+    etag = webapp._ResolvedFile(path, path.stat()).etag
+    plan = webapp._plan_file_response(path, _h(If_None_Match=etag, Range='bytes=0-9'), 'GET')
+    assert plan.status == 304
+    assert plan.headers['ETag'] == etag
+    assert plan.parts == []
+    plan = webapp._plan_file_response(path, _h(If_Match='"nope"'), 'GET')
+    assert plan.status == 412
+
+
+def test_plan_missing_file(tmp_path):
+    assert webapp._plan_file_response(tmp_path / 'nope.mp4', _h(), 'GET') is None
+
+
+def test_plan_empty_file(tmp_path):
+    path = tmp_path / 'empty.mp4'
+    path.write_bytes(b'')
+    plan = webapp._plan_file_response(path, _h(), 'GET')
+    assert (plan.status, plan.headers['Content-Length'], plan.parts) == (200, '0', [])
@@ -0,0 +1,38 @@
+# tests/test_renditions.py
+import app as webapp
+
+LADDER_720_SOURCE = [
+    {'name': '480p', 'width': 854, 'height': 480, 'video_bitrate': '1000k', 'audio_bitrate': '96k', 'copy': False},
+    {'name': 'source', 'width': 1280, 'height': 720, 'video_bitrate': '5000k', 'audio_bitrate': '128k',
+     'copy': True, 'remux': False},
+]
+
+
+def test_original_source_rung_is_ready_and_default(client, processed):
+    source, out = processed('course/lec1.mp4', LADDER_720_SOURCE, {'original': 7000, '480p': 2000})
+    key = out.name
+    assert webapp._renditions(key) == ['480p', 'source']
+    assert webapp._pick_rendition(key) is None  # 'source' 720p อยู่ตำแหน่ง '720p' -> ส่งต้นฉบับ
+    resp = client.get('/api/video_path/course/lec1.mp4')
+    assert resp.status_code == 200 and len(resp.data) == 7000
+    resp = client.get('/api/video_path/course/lec1.mp4', query_string={'quality': '480p'})
+    assert len(resp.data) == 2000
+    resp = client.get('/api/video_path/course/lec1.mp4', query_string={'quality': 'source'})
+    assert len(resp.data) == 7000
+
+
+def test_remuxed_source_needs_file(processed):
+    ladder = [dict(LADDER_720_SOURCE[0]), dict(LADDER_720_SOURCE[1], remux=True)]
+    _, out = processed('course/lec2.mkv', ladder, {'original': 7000, '480p': 2000})
+    assert webapp._renditions(out.name) == ['480p']  # source.mp4 ยังไม่เสร็จ
+    (out / 'mp4' / 'source.mp4').write_bytes(b'\0' * 6000)
+    assert webapp._pick_rendition(out.name) == out / 'mp4' / 'source.mp4'
+
+
+def test_fallback_prefers_720p_then_480p(processed):
+    ladder = [{'name': n, 'height': h, 'video_bitrate': '1000k', 'audio_bitrate': '96k', 'copy': False}
+              for n, h in (('480p', 480), ('720p', 720), ('1080p', 1080))]
+    _, out = processed('course/lec3.mp4', ladder, {'original': 10, '480p': 1, '720p': 2, '1080p': 3})
+    assert webapp._pick_rendition(out.name).name == '720p.mp4'
+    (out / 'mp4' / '720p.mp4').unlink()
+    assert webapp._pick_rendition(out.name).name == '480p.mp4'